@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import os.path
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import main
+from bulkload import bulkLoadPatients
+from synthdata import generatePatientsFile, generateVisits
+from vitalstats import statsEngineOf
+
+
+# dataset sizes in visits that can be selected with --sizes
+SIZES = {'10k': 10_000, '1m': 1_000_000, '50m': 50_000_000}
+
+VISITS_PER_PATIENT = 10
+
+
+def currentRss():
+    """
+    Returns the resident set size of this process in kilobytes.
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(setup, run):
+    """
+    Times one operation and records the peak memory it needed.
+
+    setup: A function called before the clock starts, whose result is passed to run.
+    run: The operation; it returns the number of items it processed.
+    return: A dictionary with the wall time, item count, throughput and peak RSS in kilobytes.
+    """
+    state = setup()
+    before = currentRss()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        items = run(state)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'seconds': round(seconds, 6), 'items': items,
+            'throughput': round(items / seconds, 1) if seconds > 0 else None,
+            'peakRssKb': peak, 'extraRssKb': max(peak - before, 0)}
+
+
+def runIsolated(setup, run):
+    """
+    Runs measure in a forked child process, so every operation starts from the same loaded
+    store and its peak memory is not hidden by earlier operations.
+    """
+    if not hasattr(os, 'fork'):
+        return measure(setup, run)
+    read, write = os.pipe()
+    child = os.fork()
+    if child == 0:
+        os.close(read)
+        try:
+            result = measure(setup, run)
+        except Exception as error:
+            result = {'error': repr(error)}
+        os.write(write, json.dumps(result).encode())
+        os._exit(0)
+    os.close(write)
+    data = b''
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    os.waitpid(child, 0)
+    return json.loads(data) if data else {'error': "the benchmark process exited without a result"}
+
+
+def operations(patients, fileName, scratch):
+    """
+    Returns the (name, setup, run) of every benchmarked operation.
+
+    patients: The VisitStore loaded from fileName.
+    fileName: The generated patients file.
+    scratch: A file that additions and deletions are written to, so fileName stays unchanged.
+    """
+    ids = list(patients)[:1000]
+    newVisits = [(int(line.split(",")[0]), *line.split(",")[1:]) for line in
+                 generateVisits(patients=10000, visitsPerPatient=10, seed=1)]
+
+    def nothing():
+        return None
+
+    def withStats():
+        statsEngineOf(patients)
+        return None
+
+    return [
+        ('readPatientsFromFile', nothing, lambda _: main.readPatientsFromFile(fileName).rowCount),
+        ('bulkLoadPatients', nothing, lambda _: bulkLoadPatients(fileName)[0].rowCount),
+        ('displayStats', nothing, lambda _: (main.displayStats(patients, 0), patients.rowCount)[1]),
+        ('displayStats (cached)', withStats,
+         lambda _: sum((main.displayStats(patients, id), 1)[1] for id in [0] + ids)),
+        ('findVisitsByDate', nothing,
+         lambda _: sum(sum(1 for _ in main.findVisitsByDate(patients, year, month))
+                       for year, month in [(2022, None), (None, 6), (2023, 3), (None, None)])),
+        ('findPatientsWhoNeedFollowUp', nothing,
+         lambda _: (main.findPatientsWhoNeedFollowUp(patients), patients.rowCount)[1]),
+        ('displayPatientData', nothing, lambda _: (main.displayPatientData(patients), patients.rowCount)[1]),
+        ('addPatientData', nothing,
+         lambda _: sum((main.addPatientData(patients, id, '2025-01-02', 37.0, 72, 16, 120, 80, 97, scratch), 1)[1]
+                       for id in ids)),
+        ('addPatientVisits', nothing, lambda _: main.addPatientVisits(patients, newVisits, scratch)[0]),
+        ('deleteAllVisitsOfPatient', nothing,
+         lambda _: sum((main.deleteAllVisitsOfPatient(patients, id, scratch), 1)[1] for id in ids)),
+    ]
+
+
+def runBenchmarks(sizes, directory, invalidRate=0.01, seed=0):
+    """
+    Generates a dataset for every size and benchmarks every operation on it.
+
+    sizes: The names of the dataset sizes, see SIZES.
+    directory: The directory the generated files are written to.
+    invalidRate: The share of invalid lines in the generated files.
+    seed: The seed of the generator.
+    return: A list of result dictionaries.
+    """
+    results = []
+    for size in sizes:
+        visits = SIZES[size]
+        fileName = os.path.join(directory, f"patients-{size}.txt")
+        scratch = os.path.join(directory, f"scratch-{size}.txt")
+        if not os.path.isfile(fileName):
+            print(f"Generating {visits} visits in '{fileName}'...", file=sys.stderr)
+            generatePatientsFile(fileName, visits // VISITS_PER_PATIENT, VISITS_PER_PATIENT,
+                                 invalidRate=invalidRate, seed=seed)
+        patients, _ = bulkLoadPatients(fileName)
+        for name, setup, run in operations(patients, fileName, scratch):
+            result = {'size': size, 'visits': visits, 'operation': name}
+            result.update(runIsolated(setup, run))
+            results.append(result)
+            print(formatResult(result), file=sys.stderr)
+        del patients
+    return results
+
+
+def formatResult(result):
+    if 'error' in result:
+        return f"{result['size']:>4} {result['operation']:<28} error: {result['error']}"
+    return (f"{result['size']:>4} {result['operation']:<28} {result['seconds']:>10.4f} s "
+            f"{result['throughput'] or 0:>14.1f} items/s {result['peakRssKb'] / 1024:>9.1f} MB peak")
+
+
+def compareResults(results, baseline, tolerance):
+    """
+    Returns the operations that got slower than the baseline by more than the tolerance.
+
+    results: The current results.
+    baseline: The results of an earlier run.
+    tolerance: The allowed slowdown, e.g. 0.2 for 20%.
+    return: A list of (size, operation, baseline seconds, current seconds) tuples.
+    """
+    earlier = {(item['size'], item['operation']): item for item in baseline if 'seconds' in item}
+    regressions = []
+    for item in results:
+        before = earlier.get((item['size'], item['operation']))
+        if before and 'seconds' in item and item['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append((item['size'], item['operation'], before['seconds'], item['seconds']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks every operation of the Health Information System.")
+    parser.add_argument('--sizes', default='10k,1m', help="comma separated dataset sizes: 10k, 1m, 50m")
+    parser.add_argument('--dir', help="directory for the generated datasets (default: a temporary directory)")
+    parser.add_argument('--invalid', type=float, default=0.01, help="share of invalid lines in the datasets")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="file to write the JSON results to")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    sizes = [size.strip().lower() for size in args.sizes.split(",")]
+    for size in sizes:
+        if size not in SIZES:
+            parser.error(f"unknown size: {size}")
+
+    with contextlib.ExitStack() as stack:
+        directory = args.dir or stack.enter_context(tempfile.TemporaryDirectory())
+        results = runBenchmarks(sizes, directory, args.invalid, args.seed)
+
+    report = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compareResults(results, json.load(file)['results'], args.tolerance)
+        for size, operation, before, after in regressions:
+            print(f"Regression: {operation} on {size} took {after:.4f} s, was {before:.4f} s", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,232 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import os.path
+
+from dateindex import dateIndexOf
+import metrics
+from patientlog import parseTombstone
+from visitstore import VisitStore, InvalidVisit, LIMITS, TYPECODES, parseVisit, toDay
+
+
+# size of the newline aligned pieces the file is split into for the worker processes
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# number of lines converted together; a block with an invalid line is parsed again line by line
+BLOCK_LINES = 8192
+
+
+class RejectsReport:
+    """
+    Collects the lines that were rejected while loading a patients file.
+
+    Every rejected line is kept as a (line number, reason, message) tuple, where reason is the
+    name of the failed check (see InvalidVisit) and message is the text readPatientsFromFile prints.
+    """
+
+    def __init__(self):
+        self.rejects = []
+
+    def __len__(self):
+        return len(self.rejects)
+
+    def __iter__(self):
+        return iter(self.rejects)
+
+    def add(self, lineNumber, reason, message):
+        self.rejects.append((lineNumber, reason, message))
+
+    def counts(self):
+        """
+        Returns the number of rejected lines for every reason.
+        """
+        counts = {}
+        for _, reason, _ in self.rejects:
+            counts[reason] = counts.get(reason, 0) + 1
+        return counts
+
+    def summary(self):
+        """
+        Returns a short human readable summary of the rejected lines.
+        """
+        if not self.rejects:
+            return "No invalid lines found."
+        parts = [f"{reason}: {count}" for reason, count in sorted(self.counts().items())]
+        return f"{len(self.rejects)} invalid lines ({', '.join(parts)})"
+
+    def write(self, fileName):
+        """
+        Writes the rejected lines to a file, one 'lineNumber,reason,message' line per reject.
+
+        fileName: The name of the file to write the report to.
+        """
+        with open(fileName, 'w') as file:
+            for lineNumber, reason, message in self.rejects:
+                file.write(f"{lineNumber},{reason},{message.strip()}\n")
+
+
+def chunkBounds(fileName, chunkSize=CHUNK_SIZE):
+    """
+    Splits a file into byte ranges that start and end on line boundaries.
+
+    fileName: The name of the file to split.
+    chunkSize: The approximate size of every range in bytes.
+    return: A list of (start, stop) tuples covering the whole file.
+    """
+    size = os.path.getsize(fileName)
+    if size == 0:
+        return []
+    bounds = []
+    with open(fileName, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            stop = min(start + chunkSize, size)
+            if stop < size:
+                newline = data.find(b'\n', stop - 1)
+                stop = size if newline == -1 else newline + 1
+            bounds.append((start, stop))
+            start = stop
+    return bounds
+
+
+def convertBlock(lines):
+    """
+    Converts a block of lines column by column, without per line error handling.
+
+    lines: The lines to convert.
+    return: A tuple of column arrays, or None if any line is invalid.
+    """
+    fields = [line.strip().split(",") for line in lines]
+    if any(len(field) != 8 for field in fields):
+        return None
+    try:
+        columns = list(zip(*fields))
+        pid = array('q', map(int, columns[0]))
+        vitals = [list(map(float, columns[2]))] + [list(map(int, column)) for column in columns[3:]]
+        for values, (_, low, high, _) in zip(vitals, LIMITS):
+            # every value is checked on its own, min() and max() don't see a NaN among the values
+            if not all(low <= value <= high for value in values):
+                return None
+        # visits cluster on a few dates, so every distinct date is converted once
+        days = {date: toDay(date) for date in set(columns[1])}
+        day = array('i', map(days.__getitem__, columns[1]))
+    except (ValueError, OverflowError):
+        return None
+    return (pid, day, array('f', vitals[0])) + tuple(array('B', values) for values in vitals[1:])
+
+
+def parseChunk(fileName, start, stop, skipBlank=False):
+    """
+    Parses and validates the lines in one byte range of a patients file.
+
+    fileName: The name of the file to read.
+    start, stop: The byte range to parse, as returned by chunkBounds.
+    skipBlank: True to skip empty lines instead of rejecting them.
+    return: A (lineCount, columns, tombstones, rejects) tuple, where columns holds one array per column,
+    tombstones holds (number of rows before the tombstone, patientId) tuples and rejects holds
+    (line number within the chunk, reason, message) tuples.
+    """
+    with open(fileName, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # a byte that isn't UTF-8 only spoils its own line, which is then rejected like any other
+        text = data[start:stop].decode(errors='replace')
+    # reading the lines the same way a text mode file would
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line + '\n' for line in text.split('\n')]
+    if text.endswith('\n'):
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+
+    columns = [array(typecode) for typecode in TYPECODES]
+    rejects = []
+    tombstones = []
+    for first in range(0, len(lines), BLOCK_LINES):
+        block = lines[first:first + BLOCK_LINES]
+        converted = convertBlock(block)
+        if converted is not None:
+            for column, values in zip(columns, converted):
+                column.extend(values)
+            continue
+        # checking the block line by line to report every invalid line
+        for number, line in enumerate(block, first + 1):
+            if skipBlank and not line.strip():
+                continue
+            # remembering where a tombstone falls between the parsed rows
+            try:
+                deleted = parseTombstone(line)
+            except ValueError:
+                rejects.append((number, 'patient_id', f"Invalid patient ID in line: {line}"))
+                continue
+            if deleted is not None:
+                tombstones.append((len(columns[0]), deleted))
+                continue
+            try:
+                visit = parseVisit(line)
+            except InvalidVisit as error:
+                rejects.append((number, error.reason, error.message))
+                continue
+            for column, value in zip(columns, visit):
+                column.append(value)
+    return len(lines), columns, tombstones, rejects
+
+
+def applyChunk(patients, columns, tombstones):
+    """
+    Adds the visits parsed from a chunk to a store and applies its tombstones between them.
+
+    patients: The VisitStore to add to.
+    columns, tombstones: The columns and tombstones returned by parseChunk.
+    """
+    # deleting patients between the rows that came before and after their tombstones
+    start = 0
+    for stop, deleted in tombstones:
+        patients.extend(*(column[start:stop] for column in columns))
+        patients.deletePatient(deleted)
+        start = stop
+    patients.extend(*(column[start:] for column in columns) if start else columns)
+
+
+@metrics.timed('bulkLoadPatients')
+def bulkLoadPatients(fileName, workers=None, chunkSize=CHUNK_SIZE):
+    """
+    Loads a patients file by parsing newline aligned chunks in parallel worker processes.
+
+    fileName: The name of the file to read patient data from.
+    workers: The number of worker processes. If None, one per CPU is used.
+    chunkSize: The approximate size of the chunks in bytes.
+    return: A (VisitStore, RejectsReport) tuple. Lines are validated exactly like readPatientsFromFile does.
+    """
+    patients = VisitStore()
+    report = RejectsReport()
+
+    if not os.path.isfile(fileName):
+        raise FileNotFoundError(f"The file '{fileName}' could not be found.")
+
+    bounds = chunkBounds(fileName, chunkSize)
+    if workers == 1 or len(bounds) <= 1:
+        results = (parseChunk(fileName, start, stop) for start, stop in bounds)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(parseChunk, [fileName] * len(bounds), *zip(*bounds))
+
+    # merging the chunks in file order
+    try:
+        lineCount = 0
+        for lines, columns, tombstones, rejects in results:
+            applyChunk(patients, columns, tombstones)
+            for number, reason, message in rejects:
+                report.add(lineCount + number, reason, message)
+            lineCount += lines
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    metrics.count('read.lines', lineCount)
+    if metrics.enabled:
+        for reason, number in report.counts().items():
+            metrics.count('read.rejected.' + reason, number)
+    with metrics.span('bulkLoadPatients.dateIndex'):
+        dateIndexOf(patients)
+    return patients, report
@@ -0,0 +1,340 @@
+import re
+
+from followup import NONZERO, OPERATORS
+from dateindex import dateIndexOf
+from visitstore import VITALS, float32, toDay, typecodeOf
+
+
+# below this share of all rows the planner tests the remaining predicates row by row on the
+# rows it looked up, instead of evaluating them as masks over whole columns
+ROW_BY_ROW = 1 / 16
+
+TOKENS = re.compile(r'\(|\)|[<>!=]=?|[^\s()<>!=]+')
+
+
+class Vital:
+    """
+    Predicate that holds for a visit when "<vital> <op> <value>" holds, e.g. Vital('spo2', '<', 92).
+    """
+
+    def __init__(self, vital, op, value):
+        if vital not in VITALS:
+            raise ValueError(f"Unknown vital sign: {vital}")
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator: {op}")
+        self.vital = vital
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f"{self.vital} {self.op} {self.value}"
+
+    def mask(self, store):
+        test = OPERATORS[self.op]
+        column = getattr(store, self.vital)
+        if column.itemsize == 1:
+            # a byte column is mapped through a 256 entry lookup table in a single translate call
+            return column.tobytes().translate(bytes(test(value, self.value) for value in range(256)))
+        value = float32(self.value) if typecodeOf(column) == 'f' else self.value
+        return bytes(test(item, value) for item in column)
+
+    def test(self, store, row):
+        column = getattr(store, self.vital)
+        value = float32(self.value) if typecodeOf(column) == 'f' else self.value
+        return OPERATORS[self.op](column[row], value)
+
+    def sql(self):
+        return f"{self.vital} {self.op} ?", [self.value]
+
+
+class PatientRange:
+    """
+    Predicate that holds for the visits of the patients with IDs from first to last, inclusive.
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+
+    def __repr__(self):
+        return f"patient {self.first} {self.last}"
+
+    def patientIds(self, store):
+        """
+        Returns the IDs of the patients of the store in the range, in ascending order.
+        """
+        return sorted(patientId for patientId in store.index if self.first <= patientId <= self.last)
+
+    def mask(self, store):
+        mask = bytearray(len(store.pid))
+        for patientId in self.patientIds(store):
+            for start, stop in store.index[patientId]:
+                mask[start:stop] = b'\x01' * (stop - start)
+        return bytes(mask)
+
+    def test(self, store, row):
+        return self.first <= store.pid[row] <= self.last
+
+    def sql(self):
+        return "patient_id BETWEEN ? AND ?", [self.first, self.last]
+
+
+class DateRange:
+    """
+    Predicate that holds for the visits from the first to the last date, inclusive.
+    """
+
+    def __init__(self, first, last):
+        """
+        first, last: Dates in 'yyyy-mm-dd' format.
+        """
+        self.first = first
+        self.last = last
+        self.firstDay = toDay(first)
+        self.lastDay = toDay(last)
+
+    def __repr__(self):
+        return f"date {self.first} {self.last}"
+
+    def mask(self, store):
+        first, last = self.firstDay, self.lastDay
+        return bytes(first <= day <= last for day in store.day)
+
+    def test(self, store, row):
+        return self.firstDay <= store.day[row] <= self.lastDay
+
+    def sql(self):
+        return "day BETWEEN ? AND ?", [self.firstDay, self.lastDay]
+
+
+class And:
+    """
+    Predicate that holds when all of its terms hold.
+    """
+
+    combine = staticmethod(int.__and__)
+    keyword = 'AND'
+
+    def __init__(self, *terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return "(" + f" {self.keyword.lower()} ".join(map(repr, self.terms)) + ")"
+
+    def mask(self, store):
+        length = len(store.pid)
+        if not self.terms:
+            return b'\x01' * length if self.keyword == 'AND' else bytes(length)
+        combined = int.from_bytes(self.terms[0].mask(store), 'little')
+        for term in self.terms[1:]:
+            combined = self.combine(combined, int.from_bytes(term.mask(store), 'little'))
+        return combined.to_bytes(length, 'little')
+
+    def test(self, store, row):
+        return all(term.test(store, row) for term in self.terms)
+
+    def sql(self):
+        if not self.terms:
+            return ("1" if self.keyword == 'AND' else "0"), []
+        conditions, parameters = [], []
+        for term in self.terms:
+            condition, values = term.sql()
+            conditions.append(f"({condition})")
+            parameters.extend(values)
+        return f" {self.keyword} ".join(conditions), parameters
+
+
+class Or(And):
+    """
+    Predicate that holds when any of its terms holds.
+    """
+
+    combine = staticmethod(int.__or__)
+    keyword = 'OR'
+
+    def test(self, store, row):
+        return any(term.test(store, row) for term in self.terms)
+
+
+def conjuncts(query):
+    """
+    Returns the terms that all have to hold for a query to hold.
+    """
+    return list(query.terms) if type(query) is And else [query]
+
+
+def dateRangeOf(query):
+    """
+    Returns the DateRange every result of a query lies in, or None if the query doesn't limit the dates.
+    """
+    ranges = [term for term in conjuncts(query) if isinstance(term, DateRange)]
+    if not ranges:
+        return None
+    first = max(ranges, key=lambda term: term.firstDay)
+    last = min(ranges, key=lambda term: term.lastDay)
+    return DateRange(first.first, last.last)
+
+
+def parseQuery(text):
+    """
+    Parses a query such as "date 2024-01-01 2024-03-31 and spo2 < 92 and patient 1000 5000".
+
+    Terms are "<vital> <op> <number>", "patient <first ID> <last ID>" and "date <first> <last>";
+    they are combined with 'and', 'or' and parentheses, and 'and' binds tighter than 'or'.
+    text: The query.
+    return: The predicate. Raises ValueError for an invalid query.
+    """
+    tokens = TOKENS.findall(text.lower())
+    position = 0
+
+    def take():
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError("Incomplete query.")
+        position += 1
+        return tokens[position - 1]
+
+    def parseOr():
+        terms = [parseAnd()]
+        while position < len(tokens) and tokens[position] == 'or':
+            take()
+            terms.append(parseAnd())
+        return terms[0] if len(terms) == 1 else Or(*terms)
+
+    def parseAnd():
+        terms = [parseTerm()]
+        while position < len(tokens) and tokens[position] == 'and':
+            take()
+            terms.append(parseTerm())
+        return terms[0] if len(terms) == 1 else And(*terms)
+
+    def parseTerm():
+        token = take()
+        if token == '(':
+            term = parseOr()
+            if take() != ')':
+                raise ValueError("Missing closing parenthesis.")
+            return term
+        if token == 'patient':
+            return PatientRange(int(take()), int(take()))
+        if token == 'date':
+            return DateRange(take(), take())
+        if token in VITALS:
+            op = take()
+            return Vital(token, '==' if op == '=' else op, float(take()))
+        raise ValueError(f"Unexpected word in query: {token}")
+
+    query = parseOr()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected word in query: {tokens[position]}")
+    return query
+
+
+class CohortView:
+    """
+    Lazy sequence of the (patientId, Visit) tuples of a VisitStore that match a query.
+
+    The planner picks an access path from the terms every result has to satisfy: a date range is
+    looked up in the date index and a patient range in the patient index, whichever touches fewer
+    rows, and the whole store is scanned otherwise. The remaining terms are then evaluated as
+    masks over whole columns, or row by row when the access path only touches a few rows.
+    Results come in date order when the query limits the dates and by patient ID otherwise;
+    nothing is evaluated until the view is iterated.
+    """
+
+    def __init__(self, store, query):
+        self.store = store
+        self.query = query
+
+    def plan(self):
+        """
+        Returns the chosen access path: ('date', lo, hi, residual), ('patient', patientIds, residual)
+        or ('scan', patientIds, residual), where residual is the predicate still to be evaluated.
+        """
+        store = self.store
+        terms = conjuncts(self.query)
+        paths = []
+        dates = dateRangeOf(self.query)
+        if dates is not None:
+            lo, hi = dateIndexOf(store).span(dates.firstDay, dates.lastDay + 1)
+            residual = [term for term in terms if not isinstance(term, DateRange)]
+            paths.append((hi - lo, ('date', lo, hi, And(*residual))))
+        for term in terms:
+            if isinstance(term, PatientRange):
+                patientIds = term.patientIds(store)
+                rows = sum(store.visitCount(patientId) for patientId in patientIds)
+                residual = [other for other in terms if other is not term]
+                paths.append((rows, ('patient', patientIds, And(*residual))))
+        if paths:
+            return min(paths, key=lambda path: path[0])[1]
+        return ('scan', sorted(store.index), self.query)
+
+    def explain(self):
+        """
+        Returns a readable description of the plan.
+        """
+        path = self.plan()
+        residual = path[-1]
+        rest = "" if type(residual) is And and not residual.terms else f", then {residual!r}"
+        if path[0] == 'date':
+            return f"date index, {path[2] - path[1]} rows{rest}"
+        return f"{path[0]} of {len(path[1])} patients{rest}"
+
+    def rows(self):
+        """
+        Generates the row numbers of the matching visits, skipping deleted rows.
+        """
+        store = self.store
+        path = self.plan()
+        residual = path[-1]
+        if path[0] == 'date':
+            candidates = path[2] - path[1]
+        else:
+            candidates = sum(store.visitCount(patientId) for patientId in path[1])
+        trivial = type(residual) is And and not residual.terms
+        rowByRow = not trivial and candidates < len(store.pid) * ROW_BY_ROW
+        mask = None if trivial or rowByRow else residual.mask(store)
+
+        if path[0] == 'date':
+            alive = store.alive
+            for row in dateIndexOf(store).rows[path[1]:path[2]]:
+                if alive[row] and (trivial or (residual.test(store, row) if rowByRow else mask[row])):
+                    yield row
+            return
+        matches = self.patientRows(path[1], residual, trivial, rowByRow, mask)
+        if dateRangeOf(self.query) is not None:
+            # the patient range was the cheaper access path, and its few rows are put in date order
+            day = store.day
+            yield from sorted(matches, key=lambda row: (day[row], row))
+        else:
+            yield from matches
+
+    def patientRows(self, patientIds, residual, trivial, rowByRow, mask):
+        """
+        Generates the row numbers of the visits of some patients that match the residual predicate.
+        """
+        store = self.store
+        # the patient index only holds live rows, so only the residual has to be checked
+        for patientId in patientIds:
+            for start, stop in store.index[patientId]:
+                if trivial:
+                    yield from range(start, stop)
+                elif rowByRow:
+                    for row in range(start, stop):
+                        if residual.test(store, row):
+                            yield row
+                else:
+                    for match in NONZERO.finditer(mask, start, stop):
+                        yield match.start()
+
+    def __iter__(self):
+        store = self.store
+        for row in self.rows():
+            visit = store.visit(row)
+            yield visit.patientId, visit
+
+    def __len__(self):
+        return sum(1 for _ in self.rows())
+
+    def __bool__(self):
+        return next(self.rows(), None) is not None
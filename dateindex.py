@@ -0,0 +1,205 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import datetime
+
+
+def firstDay(year, month=1):
+    """
+    Returns the day ordinal of the first day of a month, rolling over to the next year after December.
+
+    year: The year.
+    month: The month, 1 to 13.
+    """
+    if month > 12:
+        year, month = year + 1, 1
+    if year > datetime.MAXYEAR:
+        return datetime.date.max.toordinal() + 1
+    return datetime.date(year, month, 1).toordinal()
+
+
+class DateIndex:
+    """
+    Sorted index of the visit dates of a VisitStore.
+
+    days holds the day ordinal of every indexed row in ascending order and rows holds the
+    matching row numbers, so all visits of a year or a month are one bisect away. The index is
+    registered as a listener of the store and stays up to date as visits are added and deleted;
+    rows of deleted patients are skipped until the store is compacted.
+    """
+
+    def __init__(self, store, days=None, rows=None):
+        """
+        store: The VisitStore to index.
+        days, rows: The already sorted day ordinals and row numbers, e.g. read from a snapshot.
+        If None, the index is built by sorting the rows of the store.
+        """
+        self.store = store
+        if days is None:
+            self.rebuild()
+        else:
+            self.days, self.rows = days, rows
+
+    def rebuild(self):
+        """
+        Sorts every row of the store by date.
+        """
+        store = self.store
+        day = store.day
+        order = sorted((row for start, stop in store.ranges() for row in range(start, stop)),
+                       key=day.__getitem__)
+        self.rows = array('q', order)
+        self.days = array('i', (day[row] for row in order))
+
+    def visitsAdded(self, store, start, stop):
+        # copying read-only snapshot views into arrays before changing them
+        if not isinstance(self.days, array):
+            self.days = array('i', self.days.tobytes())
+            self.rows = array('q', self.rows.tobytes())
+        days, rows = self.days, self.rows
+        day = store.day
+        if stop - start > 16:
+            self.merge(sorted(range(start, stop), key=day.__getitem__))
+            return
+        for row in range(start, stop):
+            # new visits are usually the latest ones, which only need an append
+            if not days or day[row] >= days[-1]:
+                days.append(day[row])
+                rows.append(row)
+            else:
+                position = bisect_right(days, day[row])
+                days.insert(position, day[row])
+                rows.insert(position, row)
+
+    def merge(self, new):
+        """
+        Merges a batch of rows, sorted by date, into the index with one copy of the arrays.
+
+        new: The row numbers to add, sorted by their day ordinal.
+        """
+        day = self.store.day
+        days, rows = array('i'), array('q')
+        last = 0
+        for row in new:
+            position = bisect_right(self.days, day[row], last)
+            days.extend(self.days[last:position])
+            rows.extend(self.rows[last:position])
+            days.append(day[row])
+            rows.append(row)
+            last = position
+        days.extend(self.days[last:])
+        rows.extend(self.rows[last:])
+        self.days, self.rows = days, rows
+
+    def patientDeleted(self, store, patientId, ranges):
+        # the rows stay in the index and are skipped through store.alive
+        pass
+
+    def storeCompacted(self, store):
+        self.rebuild()
+
+    def span(self, startDay, stopDay):
+        """
+        Returns the (lo, hi) positions of the visits between two day ordinals.
+
+        startDay: The first day to include.
+        stopDay: The first day to exclude.
+        """
+        return bisect_left(self.days, startDay), bisect_left(self.days, stopDay)
+
+    def spans(self, year=None, month=None):
+        """
+        Returns the (lo, hi) positions of the visits of a year, a month of every year, or both.
+
+        year: The year to filter by, or None for every year.
+        month: The month to filter by, or None for every month.
+        """
+        if not self.days or (year is not None and not datetime.MINYEAR <= year <= datetime.MAXYEAR):
+            return []
+        if year is not None and month is not None:
+            return [self.span(firstDay(year, month), firstDay(year, month + 1))]
+        if year is not None:
+            return [self.span(firstDay(year), firstDay(year + 1))]
+        if month is None:
+            return [(0, len(self.days))]
+        first = datetime.date.fromordinal(self.days[0]).year
+        last = datetime.date.fromordinal(self.days[-1]).year
+        return [self.span(firstDay(y, month), firstDay(y, month + 1)) for y in range(first, last + 1)]
+
+    def find(self, year=None, month=None):
+        """
+        Returns a lazy view of the visits of a year, a month of every year, or both.
+
+        year: The year to filter by, or None for every year.
+        month: The month to filter by, or None for every month.
+        """
+        return DateView(self, self.spans(year, month))
+
+
+class DateView:
+    """
+    Lazy, read-only sequence of (patientId, Visit) tuples for some spans of a DateIndex.
+
+    Visits are produced in date order when the view is iterated; nothing is copied up front.
+    """
+
+    def __init__(self, index, spans):
+        self.index = index
+        self.spans = spans
+
+    def rows(self):
+        """
+        Generates the row numbers of the visits in the view, skipping deleted rows.
+        """
+        alive = self.index.store.alive
+        rows = self.index.rows
+        for lo, hi in self.spans:
+            for row in rows[lo:hi]:
+                if alive[row]:
+                    yield row
+
+    def __iter__(self):
+        store = self.index.store
+        for row in self.rows():
+            visit = store.visit(row)
+            yield visit.patientId, visit
+
+    def __len__(self):
+        if not self.index.store.dead:
+            return sum(hi - lo for lo, hi in self.spans)
+        return sum(1 for _ in self.rows())
+
+    def __bool__(self):
+        return next(self.rows(), None) is not None
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        store = self.index.store
+        # without deleted rows the position can be found from the span lengths
+        if not store.dead:
+            for lo, hi in self.spans:
+                if position < hi - lo:
+                    row = self.index.rows[lo + position]
+                    visit = store.visit(row)
+                    return visit.patientId, visit
+                position -= hi - lo
+            raise IndexError("visit index out of range")
+        for row in self.rows():
+            if position == 0:
+                visit = self.index.store.visit(row)
+                return visit.patientId, visit
+            position -= 1
+        raise IndexError("visit index out of range")
+
+
+def dateIndexOf(store):
+    """
+    Returns the date index of a VisitStore, building and registering it on first use.
+
+    store: The VisitStore to index.
+    """
+    index = store.findListener(DateIndex)
+    if index is None:
+        index = DateIndex(store)
+        store.addListener(index)
+    return index
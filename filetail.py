@@ -0,0 +1,165 @@
+from collections import namedtuple
+import os
+
+from bulkload import RejectsReport, applyChunk, bulkLoadPatients, parseChunk
+from patientlog import fileLock, rewritesOf, unwatchFile, watchFile
+
+
+# the outcome of one poll: visits added, tombstones applied, a RejectsReport of the invalid new
+# lines, and whether the file had been truncated or rewritten and was loaded again in full
+TailResult = namedtuple('TailResult', ['visits', 'tombstones', 'rejects', 'reloaded'])
+
+# number of bytes before the read offset that are compared on every poll to detect a rewrite
+MARK_SIZE = 64
+
+
+def lastLineEnd(fd, start, stop):
+    """
+    Returns the offset just after the last line ending in a byte range of a file, or start if
+    the range holds no complete line.
+    """
+    position = stop
+    while position > start:
+        size = min(65536, position - start)
+        block = os.pread(fd, size, position - size)
+        newline = block.rfind(b'\n')
+        if newline != -1:
+            return position - size + newline + 1
+        position -= size
+    return start
+
+
+def isCovered(start, stop, ranges):
+    """
+    Returns True if the (start, stop) ranges cover every byte from start to stop.
+    """
+    position = start
+    for first, last in sorted(ranges):
+        if first > position:
+            break
+        position = max(position, last)
+    return position >= stop
+
+
+class PatientFileTail:
+    """
+    Follows a patients file that other processes append to, and merges only the newly appended
+    lines into a VisitStore and its indexes.
+
+    The tail remembers the inode of the file and the offset up to which it has been read.
+    Records this process appended itself are already in the store and are skipped. When this
+    process rewrote the file itself, e.g. by a compaction or a bulk delete, the tail moves on to
+    the new file as long as it had read everything the rewrite dropped. When the file was
+    truncated or replaced otherwise, the store is loaded again in full.
+    """
+
+    def __init__(self, fileName, patients, offset=None):
+        """
+        fileName: The name of the patients file.
+        patients: The VisitStore that was loaded from the file.
+        offset: The offset up to which the file was loaded. If None, the store is assumed to
+        hold everything up to the current end of the file.
+        """
+        self.fileName = fileName
+        self.patients = patients
+        self.ownWrites = watchFile(fileName)
+        self.rewrites = rewritesOf(fileName)
+        stat = os.stat(fileName)
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.offset = stat.st_size if offset is None else offset
+        self.mark = self.readMark()
+
+    def close(self):
+        unwatchFile(self.fileName)
+
+    def readMark(self):
+        with open(self.fileName, 'rb') as file:
+            start = max(self.offset - MARK_SIZE, 0)
+            return os.pread(file.fileno(), self.offset - start, start)
+
+    def reload(self):
+        """
+        Loads the whole file again and swaps its visits into the store.
+        """
+        with fileLock:
+            del self.ownWrites[:]
+            del self.rewrites[:]
+        stat = os.stat(self.fileName)
+        patients, report = bulkLoadPatients(self.fileName)
+        self.patients.replace(patients)
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.offset = stat.st_size
+        self.mark = self.readMark()
+        return TailResult(patients.rowCount, 0, report, True)
+
+    def poll(self):
+        """
+        Reads the lines appended since the last poll and adds their visits to the store.
+
+        A trailing line without a line ending is left for the next poll.
+        return: A TailResult.
+        """
+        try:
+            stat = os.stat(self.fileName)
+        except FileNotFoundError:
+            return TailResult(0, 0, RejectsReport(), False)
+        # checked first, since a rewrite can hand the inode of an earlier file to the new one
+        if self.rewrites:
+            if not self.followRewrites():
+                return self.reload()
+            self.mark = self.readMark()
+        if (stat.st_dev, stat.st_ino) != self.inode or stat.st_size < self.offset or self.readMark() != self.mark:
+            return self.reload()
+        if stat.st_size == self.offset:
+            return TailResult(0, 0, RejectsReport(), False)
+
+        with open(self.fileName, 'rb') as file:
+            end = lastLineEnd(file.fileno(), self.offset, stat.st_size)
+        if end == self.offset:
+            return TailResult(0, 0, RejectsReport(), False)
+
+        # the byte ranges between the records this process appended itself
+        pieces = []
+        position = self.offset
+        for start, stop in sorted(self.ownWrites):
+            if stop <= position or start >= end:
+                continue
+            if start > position:
+                pieces.append((position, start))
+            position = max(position, stop)
+        if position < end:
+            pieces.append((position, end))
+        self.ownWrites[:] = [(start, stop) for start, stop in self.ownWrites if stop > end]
+
+        visits = tombstones = 0
+        report = RejectsReport()
+        for start, stop in pieces:
+            # a line ending that completes a line of an older writer leaves an empty line
+            lines, columns, deleted, rejects = parseChunk(self.fileName, start, stop, skipBlank=True)
+            applyChunk(self.patients, columns, deleted)
+            visits += len(columns[0])
+            tombstones += len(deleted)
+            for reject in rejects:
+                report.add(*reject)
+        self.offset = end
+        self.mark = self.readMark()
+        return TailResult(visits, tombstones, report, False)
+
+    def followRewrites(self):
+        """
+        Moves the read offset into the files this process rewrote since the last poll.
+
+        A rewrite only drops records whose deletion the store already holds, so the store matches
+        the new file up to where the rewrite copied the rest of the old file, provided the tail had
+        read, or this process had appended, every record the rewrite filtered.
+        return: True if the tail now follows the latest rewritten file, False if it has to reload.
+        """
+        with fileLock:
+            rewrites = self.rewrites[:]
+            del self.rewrites[:]
+        for rewrite in rewrites:
+            if rewrite.before != self.inode or not isCovered(self.offset, rewrite.end, rewrite.ownWrites):
+                return False
+            self.inode = rewrite.after
+            self.offset = rewrite.newEnd
+        return True
@@ -0,0 +1,143 @@
+from collections import namedtuple
+import operator
+import re
+
+from visitstore import float32, fromDay, typecodeOf
+
+
+# a follow-up rule fires for a visit when "<vital> <op> <threshold>" holds, e.g. ('hr', '<', 60)
+Rule = namedtuple('Rule', ['name', 'vital', 'op', 'threshold'])
+
+# a patient that needs a follow-up, with the (date, rule names) of the visits that fired a rule
+FollowUp = namedtuple('FollowUp', ['patientId', 'findings'])
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+             '==': operator.eq, '!=': operator.ne}
+
+DEFAULT_RULES = (
+    Rule('low heart rate', 'hr', '<', 60),
+    Rule('high heart rate', 'hr', '>', 100),
+    Rule('high systolic blood pressure', 'sbp', '>', 140),
+    Rule('high diastolic blood pressure', 'dbp', '>', 90),
+    Rule('low oxygen saturation', 'spo2', '<', 90),
+)
+
+# the visits a policy looks at: every visit, only the latest visit, or the last M visits
+POLICIES = ('any', 'latest', 'last')
+
+NONZERO = re.compile(b'[^\x00]')
+
+
+def ruleMask(store, rule, bit):
+    """
+    Evaluates a rule over a whole column at once.
+
+    store: The VisitStore to evaluate.
+    rule: The Rule to evaluate.
+    bit: The bit that is set in the mask for every visit the rule fires on.
+    return: A bytes mask with one byte per row of the store.
+    """
+    test = OPERATORS[rule.op]
+    column = getattr(store, rule.vital)
+    if column.itemsize == 1:
+        # a byte column is mapped through a 256 entry lookup table in a single translate call
+        table = bytes(1 << bit if test(value, rule.threshold) else 0 for value in range(256))
+        return column.tobytes().translate(table)
+    # the temperatures are stored as float32, so the threshold is rounded the same way
+    threshold = float32(rule.threshold) if typecodeOf(column) == 'f' else rule.threshold
+    return bytes(1 << bit if test(value, threshold) else 0 for value in column)
+
+
+def combineMasks(masks, length):
+    """
+    Returns the bitwise OR of several byte masks of the same length.
+    """
+    combined = 0
+    for mask in masks:
+        combined |= int.from_bytes(mask, 'little')
+    return combined.to_bytes(length, 'little')
+
+
+class FollowUpEngine:
+    """
+    Screens the visits of a VisitStore against a set of follow-up rules.
+
+    Every rule is turned into a boolean mask over its vital sign column, the masks of up to eight
+    rules are packed into one byte per visit, and every patient is then reduced with a search for
+    the first non-zero byte in its row ranges, which stops at the first visit that fires a rule.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES, policy='any', n=1, m=1):
+        """
+        rules: The Rule tuples to screen against.
+        policy: 'any' to look at every visit, 'latest' to look at the latest visit only, or
+        'last' to require n of the last m visits to fire a rule.
+        n, m: The number of visits that have to fire a rule out of the last m visits for 'last'.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown follow-up policy: {policy}")
+        for rule in rules:
+            if rule.op not in OPERATORS:
+                raise ValueError(f"Unknown operator in rule {rule.name}: {rule.op}")
+        self.rules = tuple(rules)
+        self.policy = policy
+        self.n = n
+        self.m = m
+
+    def masks(self, store):
+        """
+        Returns one byte mask per group of eight rules; bit k of a byte is set when rule k of
+        the group fires on that row.
+        """
+        length = len(store.pid)
+        groups = [self.rules[i:i + 8] for i in range(0, len(self.rules), 8)]
+        return [combineMasks([ruleMask(store, rule, bit) for bit, rule in enumerate(group)], length)
+                for group in groups]
+
+    def firedRules(self, masks, row):
+        """
+        Returns the names of the rules that fired on a row.
+        """
+        names = []
+        for group, mask in enumerate(masks):
+            bits = mask[row]
+            for bit in range(8):
+                if bits >> bit & 1:
+                    names.append(self.rules[group * 8 + bit].name)
+        return names
+
+    def screen(self, store):
+        """
+        Returns a FollowUp for every patient that needs a follow-up visit, in store order.
+
+        store: The VisitStore to screen.
+        """
+        results = []
+        if not self.rules or not len(store):
+            return results
+        masks = self.masks(store)
+        fired = masks[0] if len(masks) == 1 else combineMasks(masks, len(store.pid))
+        day = store.day
+
+        for patientId, ranges in store.index.items():
+            if self.policy == 'any':
+                # segmented any(): the first firing row of the patient, if there is one
+                for start, stop in ranges:
+                    match = NONZERO.search(fired, start, stop)
+                    if match:
+                        row = match.start()
+                        results.append(FollowUp(patientId, [(fromDay(day[row]), self.firedRules(masks, row))]))
+                        break
+                continue
+
+            rows = [row for start, stop in ranges for row in range(start, stop)]
+            if self.policy == 'latest':
+                window = [max(rows, key=day.__getitem__)]
+                needed = 1
+            else:
+                window = sorted(rows, key=day.__getitem__)[-self.m:]
+                needed = self.n
+            hits = [row for row in window if fired[row]]
+            if len(hits) >= needed:
+                results.append(FollowUp(patientId, [(fromDay(day[row]), self.firedRules(masks, row)) for row in hits]))
+        return results
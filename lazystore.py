@@ -0,0 +1,473 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import accumulate
+import os
+import os.path
+import struct
+import sys
+
+from bulkload import applyChunk, bulkLoadPatients, chunkBounds, parseChunk
+from cohort import CohortView
+from dateindex import dateIndexOf
+from filetail import MARK_SIZE, lastLineEnd
+from followup import FollowUpEngine
+import metrics
+from patientlog import TOMBSTONE, appendLines, appendTombstone, rewriteWithout, visitLine
+from vitalstats import distributionsOf, statsEngineOf
+from visitstore import VisitStore, COLUMNS, InvalidVisit, parseVisit
+
+
+MAGIC = b'HISIDX01'
+VERSION = 1
+
+# magic, version, whether the indexed part ends with a line ending, device and inode of the
+# patients file, indexed size, number of patients, number of runs, length of the mark, mark
+HEADER = struct.Struct('<8sIIQQQQQI64s')
+
+# default memory cap of the parsed patients that are kept, in bytes
+CACHE_BYTES = 64 * 1024 * 1024
+
+# estimated memory of a per-patient VisitStore apart from its column buffers
+STORE_OVERHEAD = 2048
+
+
+def indexFileName(fileName):
+    """
+    Returns the name of the sidecar index of a patients file, e.g. 'patients.idx' for 'patients.txt'.
+    """
+    return os.path.splitext(fileName)[0] + '.idx'
+
+
+def scanChunk(fileName, start, stop):
+    """
+    Finds the runs of consecutive lines of the same patient in one byte range of a patients file,
+    without parsing the visits.
+
+    Lines without a valid patient ID are left out, like loading the file rejects them.
+    fileName: The name of the file to scan.
+    start, stop: The byte range to scan, starting and ending on line boundaries.
+    return: A (patientIds, starts, stops, tombstones) tuple, where the arrays hold the patient ID
+    and byte range of every run and tombstones holds (number of runs before the tombstone, patientId) tuples.
+    """
+    with open(fileName, 'rb') as file:
+        data = os.pread(file.fileno(), stop - start, start)
+    tombstone = TOMBSTONE.encode()
+    patientIds, starts, stops = array('q'), array('q'), array('q')
+    tombstones = []
+    previous = None
+    position = start
+    for line in data.split(b'\n'):
+        end = min(position + len(line) + 1, stop)
+        comma = line.find(b',')
+        head = line[:comma] if comma > 0 else None
+        if head is not None and head == previous:
+            stops[-1] = end
+        elif head == tombstone:
+            previous = None
+            try:
+                tombstones.append((len(patientIds), int(line[comma + 1:])))
+            except ValueError:
+                pass
+        else:
+            previous = None
+            try:
+                patientId = int(head)
+            except (TypeError, ValueError):
+                pass
+            else:
+                patientIds.append(patientId)
+                starts.append(position)
+                stops.append(end)
+                previous = head
+        position = end
+    return patientIds, starts, stops, tombstones
+
+
+def addRuns(ranges, runs, base):
+    """
+    Adds the runs found by scanChunk to a dictionary of byte ranges by patient, in file order.
+
+    ranges: The dictionary of [start, stop] lists by patient ID to add to.
+    runs: The result of scanChunk.
+    base: A function returning the byte ranges a patient had before, for patients not in ranges yet.
+    return: The set of IDs of the patients that changed.
+    """
+    patientIds, starts, stops, tombstones = runs
+    changed = set()
+    position = 0
+    for before, deleted in tombstones + [(len(patientIds), None)]:
+        for run in range(position, before):
+            patientId = patientIds[run]
+            patient = ranges.get(patientId)
+            if patient is None:
+                patient = ranges[patientId] = base(patientId)
+            # runs that continue each other, e.g. across chunks, are merged into one range
+            if patient and patient[-1][1] == starts[run]:
+                patient[-1][1] = stops[run]
+            else:
+                patient.append([starts[run], stops[run]])
+            changed.add(patientId)
+        if deleted is not None:
+            # a tombstone deletes every earlier visit of the patient
+            ranges[deleted] = []
+            changed.add(deleted)
+        position = before
+    return changed
+
+
+def sizeOf(store):
+    """
+    Returns the estimated memory used by a small VisitStore, in bytes.
+    """
+    return sum(sys.getsizeof(getattr(store, name)) for name in COLUMNS) + sys.getsizeof(store.alive) + STORE_OVERHEAD
+
+
+class LazyStore:
+    """
+    Patients file that is parsed one patient at a time, on first access, as a storage engine next
+    to the VisitStore that is loaded in full.
+
+    At startup only an index of the byte ranges of every patient is read, from a sidecar file
+    next to the patients file, or built by scanning the lines for their patient IDs. A patient is
+    parsed into a small VisitStore of its own when it is first used, and the parsed patients are
+    kept in an LRU cache up to a memory cap. Lines appended to the file are indexed on the next
+    refresh, and the index is built again when the file was rewritten, e.g. by a compaction.
+
+    Operations over all patients, like the date and follow-up queries, load the whole file once
+    and keep it up to date from then on, so their memory is not bounded by the cap.
+    """
+
+    def __init__(self, fileName, cacheBytes=CACHE_BYTES, workers=None):
+        """
+        fileName: The name of the patients file.
+        cacheBytes: The memory cap of the parsed patients in bytes; the patient used last is
+        always kept, even if it is larger.
+        workers: The number of worker processes that scan the file when the index is built.
+        """
+        self.fileName = fileName
+        self.indexName = indexFileName(fileName)
+        self.cacheBytes = cacheBytes
+        self.workers = workers
+        # parsed patients by ID as (VisitStore, estimated bytes), least recently used first
+        self.cache = OrderedDict()
+        self.cached = 0
+        # the whole file, once an operation over all patients needed it
+        self.full = None
+        # byte ranges of the patients that changed since the index was built or read, by patient ID
+        self.changes = {}
+        if not self.readIndex():
+            self.rebuild()
+        self.refresh()
+
+    def close(self):
+        self.writeIndex()
+
+    @metrics.timed('buildPatientIndex')
+    def buildIndex(self):
+        """
+        Scans the whole file for the byte ranges of every patient, in parallel chunks.
+        """
+        bounds = chunkBounds(self.fileName)
+        if self.workers == 1 or len(bounds) <= 1:
+            results = [scanChunk(self.fileName, start, stop) for start, stop in bounds]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(scanChunk, [self.fileName] * len(bounds), *zip(*bounds)))
+        ranges = {}
+        for runs in results:
+            addRuns(ranges, runs, lambda patientId: [])
+        stat = os.stat(self.fileName)
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.end = bounds[-1][1] if bounds else 0
+        with open(self.fileName, 'rb') as file:
+            self.complete = self.end == 0 or os.pread(file.fileno(), 1, self.end - 1) == b'\n'
+        self.mark = self.readMark()
+        self.setRanges(ranges)
+
+    def setRanges(self, ranges):
+        """
+        Replaces the index with the byte ranges of a dictionary by patient ID.
+        """
+        self.patientIds = array('q', sorted(patientId for patientId, patient in ranges.items() if patient))
+        self.counts = array('q', (len(ranges[patientId]) for patientId in self.patientIds))
+        self.firsts = array('q', accumulate(self.counts, initial=0))
+        self.starts = array('q', (start for patientId in self.patientIds for start, _ in ranges[patientId]))
+        self.stops = array('q', (stop for patientId in self.patientIds for _, stop in ranges[patientId]))
+        self.changes = {}
+
+    def readMark(self):
+        with open(self.fileName, 'rb') as file:
+            start = max(self.end - MARK_SIZE, 0)
+            return os.pread(file.fileno(), self.end - start, start)
+
+    def readIndex(self):
+        """
+        Reads the sidecar index if it belongs to the current file; lines appended after it was
+        written are indexed by the next refresh.
+
+        return: True if the index was read.
+        """
+        if not os.path.isfile(self.indexName) or not os.path.isfile(self.fileName):
+            return False
+        with open(self.indexName, 'rb') as file:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, version, complete, device, inode, end, patients, runs, length, mark = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                return False
+            stat = os.stat(self.fileName)
+            self.end = end
+            if (stat.st_dev, stat.st_ino) != (device, inode) or stat.st_size < end or self.readMark() != mark[:length]:
+                return False
+            arrays = [array('q') for _ in range(4)]
+            try:
+                for values, count in zip(arrays, (patients, patients, runs, runs)):
+                    values.fromfile(file, count)
+            except EOFError:
+                return False
+        self.patientIds, self.counts, self.starts, self.stops = arrays
+        self.firsts = array('q', accumulate(self.counts, initial=0))
+        self.inode = (device, inode)
+        self.complete = bool(complete)
+        self.mark = mark[:length]
+        self.changes = {}
+        return True
+
+    def writeIndex(self):
+        """
+        Writes the index to the sidecar file, which is replaced atomically.
+        """
+        if self.changes:
+            self.setRanges({patientId: self.rangesOf(patientId) for patientId in self})
+        temporary = self.indexName + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, self.complete, self.inode[0], self.inode[1], self.end,
+                                   len(self.patientIds), len(self.starts), len(self.mark), self.mark))
+            for values in (self.patientIds, self.counts, self.starts, self.stops):
+                values.tofile(file)
+        os.replace(temporary, self.indexName)
+
+    def rebuild(self):
+        """
+        Builds the index again from the whole file and forgets every parsed patient.
+        """
+        self.cache.clear()
+        self.cached = 0
+        self.full = None
+        self.buildIndex()
+        self.writeIndex()
+
+    def refresh(self):
+        """
+        Indexes the lines appended to the file since the last refresh, or the whole file again if
+        it was truncated or rewritten.
+
+        return: The number of patients whose visits changed, or None if the index was built again.
+        """
+        try:
+            stat = os.stat(self.fileName)
+        except FileNotFoundError:
+            return 0
+        if (stat.st_dev, stat.st_ino) != self.inode or stat.st_size < self.end or self.readMark() != self.mark \
+                or (stat.st_size > self.end and not self.complete):
+            self.rebuild()
+            return None
+        if stat.st_size == self.end:
+            return 0
+        with open(self.fileName, 'rb') as file:
+            end = lastLineEnd(file.fileno(), self.end, stat.st_size)
+        if end == self.end:
+            return 0
+
+        changed = addRuns(self.changes, scanChunk(self.fileName, self.end, end), self.baseRanges)
+        for patientId in changed:
+            if patientId in self.cache:
+                self.cached -= self.cache.pop(patientId)[1]
+        if self.full is not None:
+            _, columns, tombstones, _ = parseChunk(self.fileName, self.end, end)
+            applyChunk(self.full, columns, tombstones)
+        self.end = end
+        self.mark = self.readMark()
+        return len(changed)
+
+    def baseRanges(self, patientId):
+        """
+        Returns the byte ranges of a patient in the index as it was built or read.
+        """
+        position = bisect_left(self.patientIds, patientId)
+        if position == len(self.patientIds) or self.patientIds[position] != patientId:
+            return []
+        first = self.firsts[position]
+        return [[self.starts[run], self.stops[run]] for run in range(first, first + self.counts[position])]
+
+    def rangesOf(self, patientId):
+        """
+        Returns the [start, stop] byte ranges of the lines of a patient, in file order.
+        """
+        if patientId in self.changes:
+            return self.changes[patientId]
+        return self.baseRanges(patientId)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        changes = self.changes
+        indexed = (patientId for patientId in self.patientIds if patientId not in changes)
+        return heapq.merge(indexed, sorted(patientId for patientId, patient in changes.items() if patient))
+
+    def __contains__(self, patientId):
+        return bool(self.rangesOf(patientId))
+
+    def __getitem__(self, patientId):
+        if patientId not in self:
+            raise KeyError(patientId)
+        return self.segmentOf(patientId)[patientId]
+
+    @property
+    def segments(self):
+        return [self.loaded()]
+
+    def parsePatient(self, patientId):
+        """
+        Reads and parses the lines of a patient into a VisitStore of its own; invalid lines are skipped.
+        """
+        store = VisitStore()
+        with open(self.fileName, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            if (stat.st_dev, stat.st_ino) != self.inode:
+                # the file was replaced since the last refresh, so the byte ranges are stale
+                self.refresh()
+                return self.parsePatient(patientId)
+            for start, stop in self.rangesOf(patientId):
+                for line in os.pread(file.fileno(), stop - start, start).decode().splitlines():
+                    try:
+                        visit = parseVisit(line)
+                    except InvalidVisit:
+                        continue
+                    if visit[0] == patientId:
+                        store.append(*visit)
+        return store
+
+    def segmentOf(self, patientId):
+        """
+        Returns the VisitStore of a single patient, parsing it on first use.
+        """
+        entry = self.cache.get(patientId)
+        if entry is not None:
+            self.cache.move_to_end(patientId)
+            metrics.count('lazy.hits')
+            return entry[0]
+        metrics.count('lazy.misses')
+        self.refresh()
+        store = self.parsePatient(patientId)
+        size = sizeOf(store)
+        self.cache[patientId] = (store, size)
+        self.cached += size
+        # evicting the least recently used patients, but never the one just parsed
+        while self.cached > self.cacheBytes and len(self.cache) > 1:
+            _, (_, evicted) = self.cache.popitem(last=False)
+            self.cached -= evicted
+            metrics.count('lazy.evictions')
+        return store
+
+    def loaded(self):
+        """
+        Returns a VisitStore of the whole file, loading it on first use.
+        """
+        self.refresh()
+        if self.full is None:
+            self.full = bulkLoadPatients(self.fileName, self.workers)[0]
+        return self.full
+
+    @property
+    def rowCount(self):
+        return self.loaded().rowCount
+
+    def append(self, patientId, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends a validated visit to the file and indexes it.
+        """
+        appendLines(self.fileName, [visitLine(patientId, day, temp, hr, rr, sbp, dbp, spo2)])
+        self.refresh()
+
+    def extend(self, pid, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends many validated visits to the file in one write and indexes them.
+
+        pid, day, temp, hr, rr, sbp, dbp, spo2: Columns of equal length, as for VisitStore.extend.
+        """
+        if len(pid):
+            appendLines(self.fileName, [visitLine(*visit) for visit in zip(pid, day, temp, hr, rr, sbp, dbp, spo2)])
+            self.refresh()
+
+    def deletePatient(self, patientId):
+        """
+        Appends a tombstone for a patient to the file and indexes it.
+
+        return: The number of visits that were deleted.
+        """
+        if patientId not in self:
+            return 0
+        removed = self.segmentOf(patientId).rowCount
+        appendTombstone(self.fileName, patientId)
+        self.refresh()
+        return removed
+
+    def deletePatients(self, patientIds):
+        """
+        Deletes many patients by rewriting the file once without them.
+
+        return: A (patients, visits, records) tuple with the number of patients and visits deleted
+        and the number of records dropped from the file.
+        """
+        selected = {patientId for patientId in patientIds if patientId in self}
+        if not selected:
+            return 0, 0, 0
+        visits = sum(self.parsePatient(patientId).rowCount for patientId in selected)
+        records = rewriteWithout(self.fileName, selected)[1]
+        full = self.full
+        self.rebuild()
+        if full is not None:
+            full.deletePatients(selected)
+            self.full = full
+        return len(selected), visits, records
+
+    def summary(self, patientId=0):
+        """
+        Returns the Summary of a patient, or of every patient if patientId is 0.
+        """
+        if patientId != 0:
+            return statsEngineOf(self.segmentOf(patientId)).summary(patientId)
+        return statsEngineOf(self.loaded()).summary(0)
+
+    def histogram(self, vital, year=None, month=None):
+        """
+        Returns the merged histogram of a vital sign, see VitalDistributions.histogram.
+        """
+        return distributionsOf(self.loaded()).histogram(vital, year, month)
+
+    def findVisits(self, year=None, month=None):
+        """
+        Returns a lazy view of the visits of a year, a month of every year, or both, in date order.
+        """
+        return dateIndexOf(self.loaded()).find(year, month)
+
+    def followUps(self, rules=None, policy='any', n=1, m=1):
+        """
+        Returns a FollowUp for every patient that needs a follow-up visit.
+
+        rules, policy, n, m: The arguments of FollowUpEngine; rules defaults to its default rules.
+        """
+        engine = FollowUpEngine(policy=policy, n=n, m=m) if rules is None else FollowUpEngine(rules, policy, n, m)
+        return engine.screen(self.loaded())
+
+    def query(self, query):
+        """
+        Returns a lazy view of the visits that match a cohort query.
+        """
+        return CohortView(self.loaded(), query)
@@ -1,15 +1,41 @@
 from typing import List, Dict, Optional
+from collections import namedtuple
+import os
 import os.path
-import datetime
+from array import array
 
+from bulkload import RejectsReport
+from cohort import CohortView, parseQuery
+from dateindex import dateIndexOf
+from filetail import PatientFileTail
+from followup import FollowUpEngine
+from lazystore import LazyStore
+import metrics
+from render import patientRows, writeVisits, writeVisitPairs
+from shards import ShardedStore
+from snapshot import isSnapshotCurrent, loadSnapshot
+from sqlstore import SqliteStore
+from trends import trendsOf
+from patientlog import VisitWriter, appendLines, appendTombstone, parseTombstone, rewriteWithout, visitLine
+from vitalstats import distributionsOf, statsEngineOf
+from visitstore import VisitStore, Visit, InvalidVisit, TYPECODES, checkPatientId, checkVisit, internId, parseVisit, toVisitStore, toDay, fromDay
 
+
+# stores that write their own files and answer statistics, date and follow-up queries themselves
+STORAGE_ENGINES = (ShardedStore, SqliteStore, LazyStore)
+
+# the outcome of a bulk deletion: patients and visits removed from the store, records removed from the file
+BulkDelete = namedtuple('BulkDelete', ['patients', 'visits', 'records'])
+
+
+@metrics.timed('readPatientsFromFile')
 def readPatientsFromFile(fileName):
     """
     Reads patient data from a plaintext file.
 
     fileName: The name of the file to read patient data from.
-    Returns a dictionary of patient IDs, where each patient has a list of visits.
-    The dictionary has the following structure:
+    Returns a VisitStore holding the visits of every patient in typed columns. The store can be
+    used like a dictionary with the following structure:
     {
         patientId (int): [
             [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
@@ -23,7 +49,7 @@ def readPatientsFromFile(fileName):
         ...
     }
     """
-    patients = {}
+    patients = VisitStore()
 
     # checking if the file exist or not
     if not os.path.isfile(fileName):
@@ -31,143 +57,109 @@ def readPatientsFromFile(fileName):
         exit()
 
     # opening file
-    with open(fileName, 'r') as files:
+    lines = 0
+    with open(fileName, 'r', errors='replace') as files:
         try:
             # traversing single line
             for line in files:
-                # spliting data
-                field = line.strip().split(",")
-
-                # Checking number of field
-                if len(field) != 8:
-                    print(f"Invalid number of fields {len(field)} in line: {line}")
-                    continue
-
-                # Check the format of the patient ID
+                lines += 1
+                # applying tombstones of deleted patients
                 try:
-                    patient_id = int(field[0])
+                    deleted = parseTombstone(line)
                 except ValueError:
                     print(f"Invalid patient ID in line: {line}")
+                    metrics.count('read.rejected.patient_id')
+                    continue
+                if deleted is not None:
+                    patients.deletePatient(deleted)
+                    metrics.count('read.tombstones')
                     continue
 
-                # Check the format of the other data values
+                # spliting and validating data
                 try:
-                    date = field[1]
-                    temp = float(field[2])
-                    hr = int(field[3])
-                    rr = int(field[4])
-                    systolic = int(field[5])
-                    diastolic = int(field[6])
-                    oxsat = int(field[7])
-                    #implementing condtion to find the invalid data
-                    if temp < 35 or temp > 42:
-                        print(f"Invalid temperature value ({temp}) in line: {line}")
-                        continue
-                    if hr < 30 or hr > 180:
-                        print(f"Invalid heart rate value ({hr}) in line: {line}")
-                        continue
-                    if rr < 5 or rr > 40:
-                        print(f"Invalid respiratory rate value ({rr}) in line: {line}")
-                        continue
-                    if systolic < 70 or systolic > 200:
-                        print(f"Invalid systolic blood pressure value ({systolic}) in line: {line}")
-                        continue
-                    if diastolic < 40 or diastolic > 120:
-                        print(f"Invalid diastolic blood pressure value ({diastolic}) in line: {line}")
-                        continue
-                    if oxsat < 70 or oxsat > 100:
-                        print(f"Invalid oxygen saturation value ({oxsat}) in line: {line}")
-                        continue
-                    # adding data to dict
-                    if patient_id in patients:
-                        datatoappent = [date, temp, hr, rr, systolic, diastolic, oxsat]
-                        patients[patient_id].append(datatoappent)
-                    else:
-                        datatoappent = [date, temp, hr, rr, systolic, diastolic, oxsat]
-                        patients[patient_id] = [datatoappent[0:]]
-
-
-
-                except ValueError:
-                    print(f"Invalid data type in line: {line}")
+                    visit = parseVisit(line)
+                except InvalidVisit as error:
+                    print(error.message)
+                    metrics.count('read.rejected.' + error.reason)
                     continue
+                # adding data to the columns
+                patients.append(*visit)
 
         except:
             print("An unexpected error occurred while reading the file.")
 
+    metrics.count('read.lines', lines)
+    with metrics.span('readPatientsFromFile.dateIndex'):
+        dateIndexOf(patients)
     return patients
 
 
-def displayPatientData(patients, patientId=0):
+@metrics.timed('displayPatientData')
+def displayPatientData(patients, patientId=0, fmt='text', offset=0, limit=None, out=None):
     """
     Displays patient data for a given patient ID.
 
-    patients: A dictionary of patient dictionaries, where each patient has a list of visits.
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
     patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+    fmt: 'text' for the readable layout, or 'csv' or 'jsonl' for machine readable output.
+    offset: The number of visits to skip, for paging through the output.
+    limit: The maximum number of visits to display, or None for all of them.
+    out: The file to write to. If None, the data is written to standard output.
     """
     #######################
     #### PUT YOUR CODE HERE
     #######################
+    if not isinstance(patients, STORAGE_ENGINES):
+        patients = toVisitStore(patients)
 
-    if patientId == 0:
-        #dispalying all data from the dic
-        for id in patients:
-            patient_data = patients[id]
-            print(f"Patient ID: {id}")
-            for visit in patient_data:
-                print(f"Visit date: {visit[0]}")
-                print(f"Temperature: {visit[1]}C")
-                print(f"Heart rate: {visit[2]}bpm")
-                print(f"Respiratory rate: {visit[3]}bpm")
-                print(f"Systolic blood pressure: {visit[4]}mmHg")
-                print(f"Diastolic blood pressure: {visit[5]}mmHg")
-                print(f"Oxygen saturation: {visit[6]}%")
-                print(" ")
-            print("")
-    else:
-        #displaying specific data from the dict
-        if patientId not in patients:
-            print("No data found for patient id: ", patientId)
-            return
-    
-        patient_data = patients[patientId]
-        print(f"Patient ID: {patientId}")
-        for visit in patient_data:
-            print(f"Visit date: {visit[0]}")
-            print(f"Temperature: {visit[1]}C")
-            print(f"Heart rate: {visit[2]}bpm")
-            print(f"Respiratory rate: {visit[3]}bpm")
-            print(f"Systolic blood pressure: {visit[4]}mmHg")
-            print(f"Diastolic blood pressure: {visit[5]}mmHg")
-            print(f"Oxygen saturation: {visit[6]}%")
-            print(" ")
-        print("")
+    #displaying specific data from the store
+    if patientId != 0 and patientId not in patients:
+        print("No data found for patient id: ", patientId)
+        return
+
+    # a sharded store is written one segment after another, a database one chunk of patients after another;
+    # a lazily loaded file parses only the patient that is displayed
+    if isinstance(patients, STORAGE_ENGINES):
+        if isinstance(patients, SqliteStore):
+            segments = patients.chunks(patientId)
+        else:
+            segments = [patients.segmentOf(patientId)] if patientId != 0 else patients.segments
+        header = True
+        for segment in segments:
+            if offset >= segment.rowCount:
+                offset -= segment.rowCount
+                continue
+            header = not writeVisits(segment, patientRows(segment, patientId), fmt, offset, limit, out,
+                                     header=header) and header
+            if limit is not None:
+                limit -= min(segment.rowCount - offset, limit)
+                if limit == 0:
+                    break
+            offset = 0
+        return
 
+    # the visits are formatted in batches and written with one write per batch
+    writeVisits(patients, patientRows(patients, patientId), fmt, offset, limit, out)
     return
 
 
+@metrics.timed('displayStats')
 def displayStats(patients, patientId=0):
     """
     Prints the average of each vital sign for all patients or for the specified patient.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
     patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
     """
     #######################
     #### PUT YOUR CODE HERE
     #######################
 
-    if type(patients)!=dict:
+    if not isinstance(patients, (dict, VisitStore) + STORAGE_ENGINES):
         print("Error: 'patients' should be a dictionary.")
         return
-    # initilizing all values with 0 so that we can take avg
-    tempsum = 0.0
-    hrsum = 0
-    rrsum = 0
-    sys = 0
-    dia = 0
-    oxs = 0
-    length = 0
+    if not isinstance(patients, STORAGE_ENGINES):
+        patients = toVisitStore(patients)
     try:
         patientId = int(patientId)
     except:
@@ -176,59 +168,100 @@ def displayStats(patients, patientId=0):
 
     if patientId == 0:
         print(f"\nVital Signs for All Patients ")
-        for id in patients:
-            patient_data = patients[id]
-            if len(patient_data) == 0:
-                print("No data found for patient id: ", id)
-                continue
-            for visit in patient_data:
-                # adding all values with their previous values
-                tempsum += visit[1]
-                hrsum += visit[2]
-                rrsum += visit[3]
-                sys += visit[4]
-                dia += visit[5]
-                oxs += visit[6]
-                length += 1
-
-        print("Average temperature:", "%.2f" % (tempsum / length), "C")
-        print("Average heart rate:","%.2f" % (hrsum / length),"bpm")
-        print("Average respiratory rate: ","%.2f" %(rrsum / length),"bpm")
-        print("Average systolic blood pressure:", "%.2f" %(sys / length),"mmHg")
-        print("Average diastolic blood pressure:","%.2f" % (dia / length),"mmHg")
-        print("Average oxygen saturation:", "%.2f" %(oxs / length),"mmHg")
-        print(" ")
     else:
         if patientId not in patients:
             print("No data found for patient id: ", patientId)
             return
-
-        patient_data = patients[patientId]
-        for visit in patient_data:
-            #adding all values with their previous values
-            tempsum += visit[1]
-            hrsum += visit[2]
-            rrsum += visit[3]
-            sys += visit[4]
-            dia += visit[5]
-            oxs += visit[6]
-            length += 1
-
         print(f"\nVital Signs for patients id: ",patientId)
-        print("Average temperature:", "%.2f" % (tempsum / length), "C")
-        print("Average heart rate:","%.2f" % (hrsum / length),"bpm")
-        print("Average respiratory rate: ","%.2f" %(rrsum / length),"bpm")
-        print("Average systolic blood pressure:", "%.2f" %(sys / length),"mmHg")
-        print("Average diastolic blood pressure:","%.2f" % (dia / length),"mmHg")
-        print("Average oxygen saturation:", "%.2f" %(oxs / length),"mmHg")
+
+    # the running aggregates are kept up to date by the stats engine, so nothing is rescanned;
+    # the aggregates of the shards of a sharded store are merged, a database computes them itself
+    if isinstance(patients, STORAGE_ENGINES):
+        summary = patients.summary(patientId)
+    else:
+        summary = statsEngineOf(patients).summary(patientId)
+    if summary is None or summary.count == 0:
+        print("No visits found.")
         print(" ")
+        return
+
+    sums = summary.total
+    length = summary.count
+    print("Average temperature:", "%.2f" % (sums[0] / length), "C")
+    print("Average heart rate:","%.2f" % (sums[1] / length),"bpm")
+    print("Average respiratory rate: ","%.2f" %(sums[2] / length),"bpm")
+    print("Average systolic blood pressure:", "%.2f" %(sums[3] / length),"mmHg")
+    print("Average diastolic blood pressure:","%.2f" % (sums[4] / length),"mmHg")
+    print("Average oxygen saturation:", "%.2f" %(sums[5] / length),"mmHg")
+    print(" ")
 
 
+@metrics.timed('displayDistribution')
+def displayDistribution(patients, vital, year=None, month=None, above=None):
+    """
+    Prints the 50th, 90th and 99th percentile of a vital sign over all patients, for all visits
+    or for a year, a month of every year, or both.
+
+    patients: A VisitStore, a storage engine or a dictionary of patient IDs, where each patient has a list of visits.
+    vital: The vital sign: 'temp', 'hr', 'rr', 'sbp', 'dbp' or 'spo2'.
+    year: The year to filter by.
+    month: The month to filter by.
+    above: If given, the share of visits with a value above it is printed as well.
+    """
+    # a storage engine merges the histograms of its parts, and the monthly histograms of a
+    # VisitStore are kept up to date on every change, so nothing is rescanned
+    if isinstance(patients, STORAGE_ENGINES):
+        histogram = patients.histogram(vital, year, month)
+    else:
+        histogram = distributionsOf(toVisitStore(patients)).histogram(vital, year, month)
+    if histogram.count == 0:
+        print("No visits found.")
+        return
+    percentiles = {q: histogram.percentile(q) for q in (50, 90, 99)}
+    period = "all visits" if year is None and month is None else \
+        "-".join(str(part) if part is not None else "*" for part in (year, month))
+    print(f"\nDistribution of {vital} ({period})")
+    print("p50:", percentiles[50], " p90:", percentiles[90], " p99:", percentiles[99])
+    if above is not None:
+        print(f"Visits above {above}:", "%.2f" % (histogram.countBetween(above, None) / histogram.count * 100), "%")
+    print(" ")
+
+
+def displayTrends(patients, patientId, visits=3, days=None):
+    """
+    Prints the trend of each vital sign of a patient over their latest visits.
+
+    patients: A VisitStore, a storage engine or a dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display trends for.
+    visits: The number of latest visits to look at, or None for every visit.
+    days: Only look at visits within this many days of the latest visit, or None for no limit.
+    """
+    if patientId not in patients:
+        print("No data found for patient id: ", patientId)
+        return
+    # a storage engine hands out the visits of the patient as a small VisitStore of their own
+    if isinstance(patients, STORAGE_ENGINES):
+        patients = patients.segmentOf(patientId)
+    else:
+        patients = toVisitStore(patients)
+
+    # the timelines are kept in date order by the trend engine, so only the window is read
+    labels = ("Temperature", "Heart rate", "Respiratory rate", "Systolic blood pressure",
+              "Diastolic blood pressure", "Oxygen saturation")
+    units = ("C", "bpm", "bpm", "mmHg", "mmHg", "%")
+    print(f"\nTrends for patients id: ", patientId)
+    for trend, label, unit in zip(trendsOf(patients).trends(patientId, visits, days), labels, units):
+        print(f"{label}: mean {trend.mean:.2f} {unit}, change {trend.change:+.2f} {unit} over "
+              f"{trend.count} visits ({trend.slope:+.3f} {unit}/day), {trend.delta:+.2f} {unit} from baseline")
+    print(" ")
+
+
+@metrics.timed('addPatientData')
 def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
     """
     Adds new patient data to the patient list.
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
+    patients: The VisitStore or dictionary of patient IDs, where each patient has a list of visits, to add data to.
     patientId: The ID of the patient to add data for.
     date: The date of the patient visit in the format 'yyyy-mm-dd'.
     temp: The patient's body temperature.
@@ -243,83 +276,104 @@ def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, file
     #### PUT YOUR CODE HERE
     #######################
     try:
-
-
-        # Checking if date format is valid
-        date_str = date
-        try:
-            date23 = datetime.datetime.strptime(date_str, '%Y-%m-%d')
-        except ValueError:
-            print("Invalid date format. Please enter date in the format 'yyyy-mm-dd'.")
-            return
-
-        # Checking if date is valid
+        # Checking the date and every vital sign
         try:
-            datetime.date(date23.year, date23.month, date23.day)
-        except ValueError:
-            print("Invalid date. Please enter a valid date.")
+            visit = checkVisit(date, temp, hr, rr, sbp, dbp, spo2)
+        except InvalidVisit as error:
+            print(error.message)
             return
 
-        # Checking temperature
-        temperature = float(temp)
-        if temperature < 35.0 or temperature > 42.0:
-            print("Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.")
+        # Add data to patient's record; a sharded store writes to the file of its shard
+        # and a database stores the visit itself
+        if isinstance(patients, STORAGE_ENGINES):
+            patients.append(patientId, *visit)
             return
+        if isinstance(patients, VisitStore):
+            patients.append(patientId, *visit)
+        else:
+            visitdata = Visit(internId(patientId), fromDay(visit[0]), *visit[1:])
+            if patientId in patients:
+                patients[patientId].append(visitdata)
+            else:
+                patients[patientId] = [visitdata]
 
-        # Checking heart rate
-        heart_rate = int(hr)
-        if heart_rate < 30 or heart_rate > 180:
-            print("Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.")
-            return
+        # the record is appended as one whole line
+        appendLines(fileName, [visitLine(patientId, *visit)])
 
-        # Checking respiratory rate
-        respiratory_rate = int(rr)
-        if respiratory_rate < 5 or respiratory_rate > 40:
-            print("Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.")
-            return
+    except Exception:
+        print("An unexpected error occurred while adding new data.")
 
-        # Checking systolic blood pressure
-        systolic_bp = int(sbp)
-        if systolic_bp < 70 or systolic_bp > 200:
-            print("Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.")
-            return
 
-        # Checking diastolic blood pressure
-        diastolic_bp = int(dbp)
-        if diastolic_bp < 40 or diastolic_bp > 120:
-            print("Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.")
-            return
+def commitBatch(patients, writer, columns, lines):
+    """
+    Writes a validated batch of visits and adds it to the store.
 
-        # Checking oxygen saturation level
-        oxygen_saturation = int(spo2)
-        if oxygen_saturation < 70 or oxygen_saturation > 100:
-            print("Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.")
-            return
+    patients: The VisitStore or storage engine to add the visits to.
+    writer: The VisitWriter of the patients file, or None for a storage engine, which writes the visits itself.
+    columns: The columns of the visits.
+    lines: The records of the visits.
+    return: The number of visits added.
+    """
+    if writer is None:
+        patients.extend(*columns)
+        return len(lines)
+    writer.write(lines)
+    added = writer.commit()
+    patients.extend(*columns)
+    return added
 
-        # Add data to patient's record
 
-        # Checking if patient_id exists in patients
-        if patientId not in patients:
-            patients[patientId] = []
-            return
-        datatoappent = [date, temp, hr, rr, sbp, dbp, spo2]
-        patients[patientId].append(datatoappent)
+@metrics.timed('addPatientVisits')
+def addPatientVisits(patients, visits, fileName, fsync='batch', batchSize=10000):
+    """
+    Adds many visits at once, e.g. from a device feed.
+
+    patients: The VisitStore or storage engine to add data to.
+    visits: An iterable of (patientId, date, temp, hr, rr, sbp, dbp, spo2) tuples.
+    fileName: The name of the file to append new data to; storage engines write to their own files.
+    fsync: 'batch' to fsync after every batch, 'interval' to fsync about once a second, or 'none'.
+    batchSize: The number of visits validated and written together in one group commit.
+    return: A (number of visits added, RejectsReport) tuple. Visits are numbered from 1 in the report.
+    """
+    report = RejectsReport()
+    added = 0
+    # a sharded store writes every batch to the files of its shards, a database inserts it
+    writer = None if isinstance(patients, STORAGE_ENGINES) else VisitWriter(fileName, fsync)
+    try:
+        columns = [array(typecode) for typecode in TYPECODES]
+        lines = []
+        for number, (patientId, *values) in enumerate(visits, 1):
+            # validating the whole batch before anything is written
+            try:
+                visit = (checkPatientId(patientId),) + checkVisit(*values)
+            except InvalidVisit as error:
+                report.add(number, error.reason, error.message)
+                continue
+            for column, value in zip(columns, visit):
+                column.append(value)
+            lines.append(visitLine(*visit))
 
-        with open(fileName, 'a') as file:
-            file.write(f'\n{patientId},{date},{temp},{hr},{rr},{sbp},{dbp},{spo2}')
+            if len(lines) >= batchSize:
+                added += commitBatch(patients, writer, columns, lines)
+                columns = [array(typecode) for typecode in TYPECODES]
+                lines = []
 
-    except Exception:
-        print("An unexpected error occurred while adding new data.")
+        added += commitBatch(patients, writer, columns, lines)
+    finally:
+        if writer is not None:
+            writer.close()
+    return added, report
 
 
+@metrics.timed('findVisitsByDate')
 def findVisitsByDate(patients, year=None, month=None):
     """
     Find visits by year, month, or both.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
     year: The year to filter by.
     month: The month to filter by.
-    return: A list of tuples containing patient ID and visit that match the filter.
+    return: A lazy sequence of tuples containing patient ID and visit that match the filter, in date order.
     """
     visits12 = []
     #######################
@@ -328,129 +382,74 @@ def findVisitsByDate(patients, year=None, month=None):
     if not bool(patients):
         print("The dictionary is empty.")
         return  visits12
-    #starting a loop that will run if year and month are none
-    if month==None and year==None:
-        #taking values from dictionary
-        for patient_id, visits in patients.items():
-            for visit in visits:
-                try:
-                    data = [visit[0], float(visit[1]), int(visit[2]), int(visit[3]), int(visit[4]), int(visit[5]),
-                            int(visit[6])]
-                    dataadd = (patient_id, data)
-                    #appending value in list
-                    visits12.append(dataadd)
-                except ValueError:
-                    print("Value Error")
-                    continue
 
+    if month is not None and (month<1 or month>12):
         return visits12
 
-    # starting a loop that will run if year and month are none
-    if month==None:
-        # taking values from dictionary
-        for patient_id, visits in patients.items():
-            for visit in visits:
-                try:
-                    visityear, visitmonth, visitdate = str(visit[0]).split('-')
-                    # checking if the year from user and dict matches
-                    if year != int(visityear):
-                        continue
-                    data = [visit[0], float(visit[1]), int(visit[2]), int(visit[3]), int(visit[4]), int(visit[5]),
-                            int(visit[6])]
-                    # appending value in list
-                    dataadd = (patient_id, data)
-                    visits12.append(dataadd)
-                except ValueError:
-                    print("Value Error")
-                    continue
-
-        return visits12
+    # querying every shard of a sharded store in parallel, or the day index of a database
+    if isinstance(patients, STORAGE_ENGINES):
+        return patients.findVisits(year, month)
 
+    # looking the visits up in the sorted date index instead of scanning every visit
+    visits = dateIndexOf(toVisitStore(patients)).find(year, month)
+    if metrics.enabled:
+        metrics.count('findVisitsByDate.scanned', sum(hi - lo for lo, hi in visits.spans))
+        metrics.count('findVisitsByDate.matched', len(visits))
+    return visits
 
-    if month<0 or month>12:
-        return visits12
-
-
-    if year==None:
-        for patient_id, visits in patients.items():
-            for visit in visits:
-                try:
-                    #separating the date
-                    visityear, visitmonth, visitdate = str(visit[0]).split('-')
-                    #checking if the month from user and dict matches
-                    if month != int(visitmonth):
-                        continue
-                    data = [visit[0], float(visit[1]), int(visit[2]), int(visit[3]), int(visit[4]), int(visit[5]),
-                            int(visit[6])]
-                    dataadd = (patient_id, data)
-                    visits12.append(dataadd)
-                except ValueError:
-                    print("Value Error")
-                    continue
-
-        return visits12
 
-    for patient_id, visits in patients.items():
-        for visit in visits:
-            try:
-                #separting the date
-                visityear, visitmonth,visitdate  = str(visit[0]).split('-')
-                #checking if the year and month matches
-                if year != int(visityear):
-                    continue
-                if month != int(visitmonth):
-                    continue
-                data=[visit[0],float(visit[1]),int(visit[2]),int(visit[3]),int(visit[4]),int(visit[5]),int(visit[6])]
-                dataadd=(patient_id,data)
-                visits12.append(dataadd)
-            except ValueError:
-                print("Value Error")
-                continue
+@metrics.timed('queryVisits')
+def queryVisits(patients, query):
+    """
+    Find visits that match a combination of patient ID, date and vital sign ranges.
 
-    return visits12
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    query: A predicate from the cohort module, or a query such as
+    "date 2024-01-01 2024-03-31 and spo2 < 92 and patient 1000 5000", see cohort.parseQuery.
+    return: A lazy sequence of tuples containing patient ID and visit that match the query, in date
+    order when the query limits the dates and by patient ID otherwise.
+    """
+    if isinstance(query, str):
+        query = parseQuery(query)
+    # a database evaluates the query in SQL, a sharded store queries every shard in parallel
+    if isinstance(patients, STORAGE_ENGINES):
+        return patients.query(query)
+    return CohortView(toVisitStore(patients), query)
 
 
+@metrics.timed('findPatientsWhoNeedFollowUp')
 def findPatientsWhoNeedFollowUp(patients):
     """
     Find patients who need follow-up visits based on abnormal vital signs.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
     return: A list of patient IDs that need follow-up visits to to abnormal health stats.
     """
     followup_patients = []
     #######################
     #### PUT YOUR CODE HERE
     #######################
-    con=False
-    for patientid,visits in patients.items():
-        for vist in visits:
-            #saving values
-            hr=vist[2]
-            sys=vist[4]
-            dia=vist[5]
-            oxs=vist[6]
-            #setting condition for follow ups
-            if hr<60 or hr>100:
-                con=True
-            if sys>140:
-                con=True
-            if dia>90:
-                con=True
-            if oxs<90:
-                con=True
-
-        if con:
-            followup_patients.append(patientid)
+    # screening every patient against the default follow-up rules
+    if isinstance(patients, STORAGE_ENGINES):
+        followup_patients = [followup.patientId for followup in patients.followUps()]
+    else:
+        for followup in FollowUpEngine().screen(toVisitStore(patients)):
+            followup_patients.append(followup.patientId)
+    if metrics.enabled:
+        # counting the patients of an engine is a query of its own
+        metrics.count('followup.screened', len(patients))
+        metrics.count('followup.flagged', len(followup_patients))
     return followup_patients
 
 
+@metrics.timed('deleteAllVisitsOfPatient')
 def deleteAllVisitsOfPatient(patients, patientId, filename):
     """
     Delete all visits of a particular patient.
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
+    patients: The VisitStore or dictionary of patient IDs, where each patient has a list of visits, to delete data from.
     patientId: The ID of the patient to delete data for.
-    filename: The name of the file to save the updated patient data.
+    filename: The name of the file to append the deletion to. The file is compacted in the background.
     return: None
     """
     #######################
@@ -458,30 +457,72 @@ def deleteAllVisitsOfPatient(patients, patientId, filename):
     #######################
     #checking if the ide exist or not
     if patientId not in patients:
-        patients[patientId] = []
         print(f"No data found for patient with ID {patientId}")
         return
 
-    writedict={}
-    #starting loop to delete a given id values
-    for patientid,visits in patients.items():
-        #deleting specific id values
-        if patientid==patientId:
-            print(f'Data for patient {patientId} has been deleted.')
-            continue
-        #traversing in values of the dict
-        for visit in visits:
-            #add data to new dict so that we can write that dict in the file
-            if patientid in writedict:
-                datatoappent = [visit[0], visit[1], visit[2], visit[3], visit[4], visit[5], visit[6]]
-                writedict[patientid].append(datatoappent)
-            else:
-                datatoappent = [visit[0], visit[1], visit[2], visit[3], visit[4], visit[5], visit[6]]
-                writedict[patientid] = [datatoappent[0:]]
-    with open(filename, 'w') as file:
-        for patientID, visits in writedict.items():
-            for visit in visits:
-                    file.write(f'\n{patientID},{visit[0]},{visit[1]},{visit[2]},{visit[3]},{visit[4]},{visit[5]},{visit[6]}')
+    #deleting the rows of the patient and logging a tombstone instead of rewriting the file;
+    #a sharded store only touches the file of the shard that owns the patient, a database deletes the rows
+    if isinstance(patients, STORAGE_ENGINES):
+        patients.deletePatient(patientId)
+    else:
+        if isinstance(patients, VisitStore):
+            patients.deletePatient(patientId)
+        else:
+            del patients[patientId]
+        appendTombstone(filename, patientId)
+    print(f'Data for patient {patientId} has been deleted.')
+
+
+def lastVisitBefore(date):
+    """
+    Returns a predicate for deletePatients that selects the patients whose last visit was before a date.
+
+    date: The date in 'yyyy-mm-dd' format.
+    """
+    day = toDay(date)
+
+    def predicate(patients, patientId):
+        if isinstance(patients, STORAGE_ENGINES):
+            patients = patients.segmentOf(patientId)
+        if isinstance(patients, VisitStore):
+            # reading the day column instead of building the visits of every patient
+            return patients.lastDay(patientId) < day
+        return max(toDay(visit[0]) for visit in patients[patientId]) < day
+    return predicate
+
+
+@metrics.timed('deletePatients')
+def deletePatients(patients, filename, patientIds=(), predicate=None):
+    """
+    Delete all visits of many patients at once, e.g. to apply a retention policy.
+
+    Unlike calling deleteAllVisitsOfPatient for every patient, the file is rewritten in a single
+    streaming pass and the store and its indexes are updated in place, without reloading.
+    patients: The VisitStore, dictionary or storage engine to delete data from.
+    filename: The name of the file to remove the records of the patients from.
+    patientIds: The IDs of the patients to delete.
+    predicate: A function of the patients and a patient ID; the patients it returns True for are deleted as well.
+    return: A BulkDelete with the number of patients, visits and file records that were removed.
+    """
+    selected = {patientId for patientId in patientIds if patientId in patients}
+    if predicate is not None:
+        selected.update(patientId for patientId in patients if predicate(patients, patientId))
+    if not selected:
+        print("No patients to delete.")
+        return BulkDelete(0, 0, 0)
+
+    if isinstance(patients, STORAGE_ENGINES):
+        result = BulkDelete(*patients.deletePatients(selected))
+    else:
+        if isinstance(patients, VisitStore):
+            deleted, removed = patients.deletePatients(selected)
+        else:
+            deleted = len(selected)
+            removed = sum(len(patients.pop(patientId)) for patientId in selected)
+        records = rewriteWithout(filename, selected)[1] if os.path.isfile(filename) else 0
+        result = BulkDelete(deleted, removed, records)
+    print(f"Deleted {result.visits} visits of {result.patients} patients.")
+    return result
 
 
 
@@ -494,7 +535,37 @@ def deleteAllVisitsOfPatient(patients, patientId, filename):
 ###########################################################################
 
 def main():
-    patients = readPatientsFromFile('patients.txt')
+    # HIS_METRICS=1 collects metrics from the start, HIS_PROFILE=<operation> also profiles it
+    if os.environ.get('HIS_METRICS') or os.environ.get('HIS_PROFILE'):
+        metrics.enable()
+    if os.environ.get('HIS_PROFILE'):
+        metrics.profile(os.environ['HIS_PROFILE'])
+    # a database created with 'python sqlstore.py migrate' replaces the text file, and a binary
+    # snapshot that is newer than the text file loads without parsing
+    patients = None
+    if os.path.isfile('patients.db'):
+        patients = SqliteStore('patients.db')
+    elif isSnapshotCurrent('patients.snap', 'patients.txt'):
+        # a damaged snapshot is skipped, the text file has every visit as well
+        try:
+            patients = loadSnapshot('patients.snap', verify=True)
+        except (OSError, ValueError) as error:
+            print(error)
+            print("Reading 'patients.txt' instead.")
+    elif os.environ.get('HIS_SHARDS') and os.path.isfile('patients.txt'):
+        # HIS_SHARDS=<n> splits the file into n shard files on first use and answers queries
+        # over all patients from one worker process per shard
+        patients = ShardedStore('patients.txt', int(os.environ['HIS_SHARDS']))
+    elif os.environ.get('HIS_LAZY') and os.path.isfile('patients.txt'):
+        # HIS_LAZY=1 only reads the patient index at startup and parses patients when they are
+        # first used, keeping at most HIS_CACHE_MB megabytes of them
+        patients = LazyStore('patients.txt', int(os.environ.get('HIS_CACHE_MB', 64)) * 1024 * 1024)
+    if patients is None:
+        patients = readPatientsFromFile('patients.txt')
+    # following what kiosks and device bridges append to the file while the menu is open
+    tail = None
+    if isinstance(patients, VisitStore) and os.path.isfile('patients.txt'):
+        tail = PatientFileTail('patients.txt', patients)
     while True:
         print("\n\nWelcome to the Health Information System\n\n")
         print("1. Display all patient data")
@@ -504,9 +575,19 @@ def main():
         print("5. Find visits by year, month, or both")
         print("6. Find patients who need follow-up")
         print("7. Delete all visits of a particular patient")
-        print("8. Quit\n")
-
-        choice = input("Enter your choice (1-8): ")
+        print("8. Quit")
+        print("9. Performance metrics")
+        print("10. Find visits by patient, date and vital sign ranges\n")
+
+        choice = input("Enter your choice (1-10): ")
+        if tail is not None:
+            result = tail.poll()
+            for _, _, message in result.rejects:
+                print(message)
+            if result.reloaded:
+                print("The file 'patients.txt' was rewritten and has been loaded again.")
+        elif isinstance(patients, LazyStore):
+            patients.refresh()
         if choice == '1':
             displayPatientData(patients)
         elif choice == '2':
@@ -533,16 +614,10 @@ def main():
             month = input("Enter month (MM) (or 0 for all months): ")
             visits = findVisitsByDate(patients, int(year) if year != '0' else None,
                                       int(month) if month != '0' else None)
-            if visits:
-                for visit in visits:
-                    print("Patient ID:", visit[0])
-                    print(" Visit Date:", visit[1][0])
-                    print("  Temperature:", "%.2f" % visit[1][1], "C")
-                    print("  Heart Rate:", visit[1][2], "bpm")
-                    print("  Respiratory Rate:", visit[1][3], "bpm")
-                    print("  Systolic Blood Pressure:", visit[1][4], "mmHg")
-                    print("  Diastolic Blood Pressure:", visit[1][5], "mmHg")
-                    print("  Oxygen Saturation:", visit[1][6], "%")
+            if visits and isinstance(patients, STORAGE_ENGINES):
+                writeVisitPairs(visits)
+            elif visits:
+                writeVisits(patients, visits.rows(), 'visits')
             else:
                 print("No visits found for the specified year/month.")
         elif choice == '6':
@@ -556,10 +631,33 @@ def main():
         elif choice == '7':
             patientID = input("Enter patient ID: ")
             deleteAllVisitsOfPatient(patients, int(patientID), "patients.txt")
-            patients = readPatientsFromFile('patients.txt')
         elif choice == '8':
+            if isinstance(patients, STORAGE_ENGINES):
+                patients.close()
             print("Goodbye!")
             break
+        elif choice == '9':
+            if not metrics.enabled:
+                metrics.enable()
+                print("Collecting performance metrics from now on.")
+            else:
+                print(metrics.report())
+                fileName = input("File to write the metrics to (.json or .prom, empty to skip): ")
+                if fileName:
+                    metrics.dump(fileName)
+        elif choice == '10':
+            print("e.g. date 2024-01-01 2024-03-31 and spo2 < 92 and (patient 1000 5000 or hr > 120)")
+            try:
+                visits = queryVisits(patients, input("Enter query: "))
+            except ValueError as error:
+                print("Invalid query:", error)
+                continue
+            if isinstance(patients, STORAGE_ENGINES):
+                found = writeVisitPairs(visits)
+            else:
+                found = writeVisits(patients, visits.rows(), 'visits')
+            if not found:
+                print("No visits found for the query.")
         else:
             print("Invalid choice. Please try again.\n")
 
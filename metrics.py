@@ -0,0 +1,205 @@
+from contextlib import nullcontext
+import cProfile
+import functools
+import json
+import os
+import time
+
+
+# nothing is recorded until enable() is called; every entry point checks this flag first
+enabled = False
+
+# event counts by name, e.g. 'read.lines' or 'read.rejected.temp'
+counters = {}
+
+# [calls, total seconds, longest call in seconds] of every timed operation by name
+timings = {}
+
+# [every, calls, directory] of the operations that are profiled with cProfile, see profile()
+profiled = {}
+
+# True while a cProfile capture is running, since captures can't be nested
+profiling = False
+
+# the context manager returned by span() while metrics are disabled
+DISABLED = nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """
+    Forgets every counter and timing recorded so far.
+    """
+    counters.clear()
+    timings.clear()
+
+
+def count(name, amount=1):
+    """
+    Adds to a counter.
+
+    name: The name of the counter.
+    amount: The number to add.
+    """
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+
+class Span:
+    """
+    Times one call of an operation and records it under the name of the operation.
+
+    If the operation is being profiled and the call is sampled, the call also runs under cProfile
+    and its statistics are written to '<name>.<call>.prof' in the chosen directory.
+    """
+
+    __slots__ = ('name', 'start', 'profiler', 'call')
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        global profiling
+        sampling = profiled.get(self.name)
+        if sampling is not None and not profiling:
+            sampling[1] += 1
+            self.call = sampling[1]
+            if self.call % sampling[0] == 0:
+                profiling = True
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global profiling
+        elapsed = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            profiling = False
+            directory = profiled[self.name][2]
+            self.profiler.dump_stats(os.path.join(directory, f"{self.name}.{self.call}.prof"))
+            self.profiler = None
+        timing = timings.get(self.name)
+        if timing is None:
+            timings[self.name] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            if elapsed > timing[2]:
+                timing[2] = elapsed
+        return False
+
+
+def span(name):
+    """
+    Returns a context manager that times the code it wraps, or a shared no-op one while disabled.
+
+    name: The name of the operation.
+    """
+    if not enabled:
+        return DISABLED
+    return Span(name)
+
+
+def timed(name):
+    """
+    Decorator that times every call of a function as the operation name.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def profile(name, every=1, directory='.'):
+    """
+    Runs sampled calls of an operation under cProfile; the statistics can be read with pstats.
+
+    name: The name of the timed operation.
+    every: Profile one call out of this many.
+    directory: The directory the '.prof' files are written to.
+    """
+    profiled[name] = [every, 0, directory]
+
+
+def stopProfiling(name=None):
+    """
+    Stops profiling an operation, or every operation if name is None.
+    """
+    if name is None:
+        profiled.clear()
+    else:
+        profiled.pop(name, None)
+
+
+def snapshot():
+    """
+    Returns the counters and timings recorded so far as a dictionary.
+    """
+    return {'counters': dict(sorted(counters.items())),
+            'timings': {name: {'calls': calls, 'seconds': round(total, 6), 'max': round(longest, 6)}
+                        for name, (calls, total, longest) in sorted(timings.items())}}
+
+
+def prometheusText():
+    """
+    Returns the counters and timings in the Prometheus text exposition format.
+    """
+    lines = ["# TYPE his_operation_seconds summary"]
+    for name, (calls, total, _) in sorted(timings.items()):
+        lines.append(f'his_operation_seconds_count{{operation="{name}"}} {calls}')
+        lines.append(f'his_operation_seconds_sum{{operation="{name}"}} {total:.6f}')
+    lines.append("# TYPE his_operation_seconds_max gauge")
+    for name, (_, _, longest) in sorted(timings.items()):
+        lines.append(f'his_operation_seconds_max{{operation="{name}"}} {longest:.6f}')
+    lines.append("# TYPE his_events_total counter")
+    for name, value in sorted(counters.items()):
+        lines.append(f'his_events_total{{event="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def report():
+    """
+    Returns a readable table of the timings and counters recorded so far.
+    """
+    if not timings and not counters:
+        return "No metrics recorded."
+    lines = [f"{'Operation':<32}{'Calls':>8}{'Total s':>12}{'Mean ms':>12}{'Max ms':>12}"]
+    for name, (calls, total, longest) in sorted(timings.items()):
+        lines.append(f"{name:<32}{calls:>8}{total:>12.4f}{total / calls * 1000:>12.3f}{longest * 1000:>12.3f}")
+    if counters:
+        lines.append("")
+        lines.append(f"{'Counter':<44}{'Value':>12}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name:<44}{value:>12}")
+    return "\n".join(lines)
+
+
+def dump(fileName):
+    """
+    Writes the metrics to a file, in the Prometheus text format if the name ends with '.prom'
+    and as JSON otherwise.
+
+    fileName: The name of the file to write.
+    """
+    with open(fileName, 'w') as file:
+        if fileName.endswith('.prom'):
+            file.write(prometheusText())
+        else:
+            json.dump(snapshot(), file, indent=2)
@@ -0,0 +1,413 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
+import os
+import os.path
+import sys
+import threading
+import time
+
+import metrics
+from visitstore import fromDay
+
+
+# first field of the record that deletes all earlier visits of a patient: 'DELETE,patientId'
+TOMBSTONE = 'DELETE'
+
+# number of tombstones appended to a file before it is compacted in the background
+COMPACT_AFTER = 1000
+
+# serializes appends and compactions of the patients files within this process
+fileLock = threading.RLock()
+
+# number of tombstones appended to every file since it was last compacted
+pendingTombstones = {}
+
+# the (start, stop) byte ranges this process appended to every watched file, see watchFile
+ownWrites = {}
+
+# a rewrite of a watched file by this process: the (device, inode) of the file before and after,
+# the offset up to which the old file was filtered, the offset the copied rest starts at in the new
+# file, and the (start, stop) ranges this process had appended to the old file
+Rewrite = namedtuple('Rewrite', ['before', 'after', 'end', 'newEnd', 'ownWrites'])
+
+# the rewrites of every watched file this process made since its reader last looked, see rewriteFile
+ownRewrites = {}
+
+
+def tombstoneLine(patientId):
+    """
+    Returns the record that marks all earlier visits of a patient as deleted.
+
+    patientId: The ID of the deleted patient.
+    """
+    return f"{TOMBSTONE},{patientId}"
+
+
+def parseTombstone(line):
+    """
+    Returns the patient ID of a tombstone record, or None if the line is not a tombstone.
+
+    line: A line of the patients file. Raises ValueError for a tombstone with an invalid patient ID.
+    """
+    if not line.startswith(TOMBSTONE + ","):
+        return None
+    return int(line[len(TOMBSTONE) + 1:])
+
+
+# how often VisitWriter fsyncs the file: after every commit, at most once per interval, or never
+FSYNC_POLICIES = ('batch', 'interval', 'none')
+
+
+def openForAppend(fileName):
+    """
+    Opens a patients file for appending and makes sure it ends with a line ending.
+
+    fileName: The name of the file to open.
+    return: The file descriptor, opened with O_APPEND so every write lands at the end of the file.
+    """
+    fd = os.open(fileName, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    # older writers leave the last record without a line ending
+    size = os.fstat(fd).st_size
+    if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+        writeAll(fd, b'\n')
+        recordOwnWrite(fileName, fd, 1)
+    return fd
+
+
+@contextmanager
+def lockedFile(fileName, exclusive=False):
+    """
+    Holds the advisory lock of a patients file across processes: appenders take it shared and
+    rewrites take it exclusively, so nothing is appended while a rewrite replaces the file.
+
+    The lock is taken on a separate '.lock' file, because a rewrite gives the patients file a new inode.
+    fileName: The name of the patients file.
+    exclusive: True to lock out every other appender and rewrite.
+    """
+    fd = os.open(fileName + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+
+
+def recordOwnWrite(fileName, fd, length):
+    """
+    Records the byte range of the data just appended to a file, if the file is watched.
+
+    fileName: The name of the file.
+    fd: The file descriptor the data was written to, opened with O_APPEND.
+    length: The number of bytes written.
+    """
+    ranges = ownWrites.get(os.path.abspath(fileName))
+    if ranges is not None:
+        # with O_APPEND the file offset is now the end of the data that was just written
+        end = os.lseek(fd, 0, os.SEEK_CUR)
+        ranges.append((end - length, end))
+
+
+def writeAll(fd, data):
+    """
+    Writes a whole buffer to a file descriptor, retrying after short writes.
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class VisitWriter:
+    """
+    Buffered appender for patients files with group commit.
+
+    Records are collected in memory and written by commit() with a single write of whole lines,
+    so a crash loses at most the batches that weren't committed or synced yet. The operating system
+    doesn't make a large write atomic, though, so a crash during one can leave a partial last record
+    behind; the next writer ends it with a line ending before appending its own records.
+    """
+
+    def __init__(self, fileName, fsync='batch', interval=1.0):
+        """
+        fileName: The name of the file to append to.
+        fsync: 'batch' to fsync after every commit, 'interval' to fsync at most once every
+        interval seconds, or 'none' to leave flushing to the operating system.
+        interval: The number of seconds between fsyncs for the 'interval' policy.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.fileName = fileName
+        self.fsync = fsync
+        self.interval = interval
+        self.buffer = []
+        self.lastSync = time.monotonic()
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, lines):
+        """
+        Adds records to the current batch.
+
+        lines: The records to append, without line endings.
+        """
+        self.buffer.extend(lines)
+
+    def commit(self):
+        """
+        Appends the current batch to the file and fsyncs it according to the policy.
+
+        return: The number of records written.
+        """
+        if not self.buffer:
+            return 0
+        data = ''.join(line + '\n' for line in self.buffer).encode()
+        count = len(self.buffer)
+        metrics.count('write.lines', count)
+        metrics.count('write.bytes', len(data))
+        with fileLock, lockedFile(self.fileName), metrics.span('write'):
+            # a rewrite may have replaced the file while this writer waited for the lock
+            if self.fd is not None and self.replaced():
+                os.close(self.fd)
+                self.fd = None
+            if self.fd is None:
+                self.fd = openForAppend(self.fileName)
+            writeAll(self.fd, data)
+            recordOwnWrite(self.fileName, self.fd, len(data))
+            now = time.monotonic()
+            if self.fsync == 'batch' or (self.fsync == 'interval' and now - self.lastSync >= self.interval):
+                os.fsync(self.fd)
+                self.lastSync = now
+        self.buffer = []
+        return count
+
+    def replaced(self):
+        """
+        Returns True if the open file is no longer the one under its name, e.g. after a compaction
+        replaced it, so the next commit has to open the file again.
+        """
+        try:
+            stat = os.stat(self.fileName)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.fd)
+        return (stat.st_dev, stat.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def close(self):
+        """
+        Commits the current batch and closes the file.
+        """
+        self.commit()
+        if self.fd is not None:
+            if self.fsync != 'none':
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+def appendLines(fileName, lines, fsync='none'):
+    """
+    Appends whole records to the end of a patients file.
+
+    fileName: The name of the file to append to.
+    lines: The records to append, without line endings.
+    fsync: The fsync policy, see VisitWriter.
+    """
+    with VisitWriter(fileName, fsync) as writer:
+        writer.write(lines)
+
+
+def watchFile(fileName):
+    """
+    Starts recording the byte ranges this process appends to a file, so a reader that follows
+    the file can skip the records that are already in memory.
+
+    fileName: The name of the patients file.
+    return: The list the (start, stop) ranges are appended to.
+    """
+    with fileLock:
+        ownRewrites.setdefault(os.path.abspath(fileName), [])
+        return ownWrites.setdefault(os.path.abspath(fileName), [])
+
+
+def rewritesOf(fileName):
+    """
+    Returns the list the Rewrites of a watched file are appended to.
+    """
+    with fileLock:
+        return ownRewrites.setdefault(os.path.abspath(fileName), [])
+
+
+def unwatchFile(fileName):
+    with fileLock:
+        ownWrites.pop(os.path.abspath(fileName), None)
+        ownRewrites.pop(os.path.abspath(fileName), None)
+
+
+def visitLine(patientId, day, temp, hr, rr, sbp, dbp, spo2):
+    """
+    Returns the record of a visit as it is stored in the patients file.
+    """
+    return f"{patientId},{fromDay(day)},{temp},{hr},{rr},{sbp},{dbp},{spo2}"
+
+
+def appendTombstone(fileName, patientId):
+    """
+    Appends a tombstone for a patient and compacts the file in the background once enough
+    tombstones have piled up.
+
+    fileName: The name of the patients file.
+    patientId: The ID of the deleted patient.
+    """
+    appendLines(fileName, [tombstoneLine(patientId)])
+    with fileLock:
+        pendingTombstones[fileName] = pendingTombstones.get(fileName, 0) + 1
+        if pendingTombstones[fileName] < COMPACT_AFTER:
+            return
+        pendingTombstones[fileName] = 0
+    compactInBackground(fileName)
+
+
+def patientOf(line):
+    """
+    Returns the patient ID a visit or tombstone record belongs to, or None if it has none.
+
+    line: A line of the patients file.
+    """
+    try:
+        patientId = parseTombstone(line)
+        if patientId is None:
+            patientId = int(line.split(",", 1)[0])
+    except ValueError:
+        return None
+    return patientId
+
+
+def rewriteFile(fileName, keep, suffix, end=None):
+    """
+    Streams a patients file into a temporary file with only the records a predicate keeps, which
+    then atomically replaces the file.
+
+    The caller holds the exclusive lockedFile, so writers that take the lock wait for the new file.
+    Records appended after the given end by writers that don't, even up to the replace, are
+    copied unchanged.
+    fileName: The name of the patients file.
+    keep: A function of a record and its line number that returns True to keep the record.
+    suffix: The suffix of the temporary file.
+    end: The byte offset up to which records are filtered, or None for the current size of the file.
+    return: A (kept, dropped) tuple with the number of records kept and dropped.
+    """
+    kept = dropped = 0
+    temporary = fileName + suffix
+    with fileLock:
+        with open(fileName, 'rb') as file, open(temporary, 'wb') as out:
+            if end is None:
+                end = os.fstat(file.fileno()).st_size
+            number = position = 0
+            while position < end:
+                line = file.readline()
+                position += len(line)
+                number += 1
+                record = line.strip()
+                if not record:
+                    continue
+                # a line that isn't UTF-8 is kept or dropped like any other and copied byte for byte
+                if not keep(record.decode(errors='replace'), number):
+                    dropped += 1
+                    continue
+                out.write(record + b'\n')
+                kept += 1
+
+            newEnd = out.tell()
+            file.seek(end)
+            out.write(file.read())
+            out.flush()
+            os.fsync(out.fileno())
+            before, after = os.fstat(file.fileno()), os.fstat(out.fileno())
+            os.replace(temporary, fileName)
+            # records appended to the old file between copying its rest and replacing it
+            late = file.read()
+            if late:
+                with open(fileName, 'ab') as rest:
+                    rest.write(late)
+                    rest.flush()
+                    os.fsync(rest.fileno())
+
+        ranges = ownWrites.get(os.path.abspath(fileName))
+        if ranges is not None:
+            # the lock keeps this process from appending during the rewrite, so every range it
+            # appended lies before end and is handed over to the reader together with the rewrite
+            ownRewrites[os.path.abspath(fileName)].append(Rewrite(
+                (before.st_dev, before.st_ino), (after.st_dev, after.st_ino), end, newEnd, ranges[:]))
+            del ranges[:]
+
+    return kept, dropped
+
+
+@metrics.timed('compactPatientFile')
+def compactPatientFile(fileName):
+    """
+    Rewrites a patients file without tombstones and without the visits they delete.
+
+    The file is streamed twice and written to a temporary file, which then atomically replaces it.
+    fileName: The name of the patients file.
+    return: A (kept, dropped) tuple with the number of records kept and dropped.
+    """
+    with fileLock, lockedFile(fileName, exclusive=True):
+        # first pass: the line number of the last tombstone of every deleted patient
+        lastTombstone = {}
+        with open(fileName, 'rb') as file:
+            for number, line in enumerate(file, 1):
+                if line.startswith(TOMBSTONE.encode()):
+                    patientId = patientOf(line.decode().strip())
+                    if patientId is not None:
+                        lastTombstone[patientId] = number
+            end = file.tell()
+
+        # second pass: writing every record that no later tombstone deletes
+        def keep(record, number):
+            return not record.startswith(TOMBSTONE) and lastTombstone.get(patientOf(record), -1) < number
+
+        kept, dropped = rewriteFile(fileName, keep, '.compact', end)
+        pendingTombstones[fileName] = 0
+
+    return kept, dropped
+
+
+@metrics.timed('rewriteWithout')
+def rewriteWithout(fileName, patientIds):
+    """
+    Removes every record of some patients from a patients file in a single streaming pass.
+
+    The remaining records are written to a temporary file, which then atomically replaces the file.
+    fileName: The name of the patients file.
+    patientIds: A set of the IDs of the patients to remove.
+    return: A (kept, dropped) tuple with the number of records kept and dropped.
+    """
+    with fileLock, lockedFile(fileName, exclusive=True):
+        return rewriteFile(fileName, lambda record, number: patientOf(record) not in patientIds, '.rewrite')
+
+
+def compactInBackground(fileName):
+    """
+    Compacts a patients file in a background thread.
+
+    fileName: The name of the patients file.
+    return: The started thread.
+    """
+    thread = threading.Thread(target=compactPatientFile, args=(fileName,), daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'compact':
+        print("Usage: python patientlog.py compact <patients file>")
+        sys.exit(1)
+    kept, dropped = compactPatientFile(sys.argv[2])
+    print(f"Kept {kept} records, dropped {dropped} records.")
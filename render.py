@@ -0,0 +1,151 @@
+from itertools import islice
+import json
+import sys
+
+from visitstore import fromDay, toTemp
+
+
+# output formats: the displayPatientData layout, the layout of the visits found by date, CSV and JSON lines
+FORMATS = ('text', 'visits', 'csv', 'jsonl')
+
+TEXT_VISIT = ("Visit date: %s\nTemperature: %sC\nHeart rate: %sbpm\nRespiratory rate: %sbpm\n"
+              "Systolic blood pressure: %smmHg\nDiastolic blood pressure: %smmHg\nOxygen saturation: %s%%\n \n")
+
+DATE_VISIT = ("Patient ID: %s\n Visit Date: %s\n  Temperature: %.2f C\n  Heart Rate: %s bpm\n"
+              "  Respiratory Rate: %s bpm\n  Systolic Blood Pressure: %s mmHg\n"
+              "  Diastolic Blood Pressure: %s mmHg\n  Oxygen Saturation: %s %%\n")
+
+CSV_HEADER = "patientId,date,temp,hr,rr,sbp,dbp,spo2\n"
+
+
+def patientRows(patients, patientId=0):
+    """
+    Generates the row numbers of the visits of a patient, or of every patient if patientId is 0,
+    in store order.
+
+    patients: The VisitStore.
+    patientId: The ID of the patient.
+    """
+    if patientId != 0:
+        yield from patients.rows(patientId)
+        return
+    for id in patients:
+        yield from patients.rows(id)
+
+
+def formatVisits(patients, rows, fmt='text', header=True):
+    """
+    Generates the formatted text of every visit, one string per visit.
+
+    patients: The VisitStore the rows belong to.
+    rows: The row numbers of the visits to format.
+    fmt: One of FORMATS.
+    header: False to leave out the CSV header, e.g. when continuing earlier output.
+    """
+    pid, day, temp = patients.pid, patients.day, patients.temp
+    hr, rr, sbp, dbp, spo2 = patients.hr, patients.rr, patients.sbp, patients.dbp, patients.spo2
+    if fmt == 'text':
+        # the patient header and the blank line after a patient come with the first and last visit
+        previous = None
+        for row in rows:
+            header = ''
+            if pid[row] != previous:
+                header = ("\n" if previous is not None else "") + f"Patient ID: {pid[row]}\n"
+                previous = pid[row]
+            yield header + TEXT_VISIT % (fromDay(day[row]), toTemp(temp[row]), hr[row], rr[row], sbp[row],
+                                         dbp[row], spo2[row])
+        if previous is not None:
+            yield "\n"
+    elif fmt == 'visits':
+        for row in rows:
+            yield DATE_VISIT % (pid[row], fromDay(day[row]), temp[row], hr[row], rr[row], sbp[row], dbp[row],
+                                spo2[row])
+    elif fmt == 'csv':
+        if header:
+            yield CSV_HEADER
+        for row in rows:
+            yield (f"{pid[row]},{fromDay(day[row])},{toTemp(temp[row])},{hr[row]},{rr[row]},{sbp[row]},"
+                   f"{dbp[row]},{spo2[row]}\n")
+    elif fmt == 'jsonl':
+        for row in rows:
+            yield json.dumps({'patientId': pid[row], 'date': fromDay(day[row]), 'temp': toTemp(temp[row]),
+                              'hr': hr[row], 'rr': rr[row], 'sbp': sbp[row], 'dbp': dbp[row],
+                              'spo2': spo2[row]}) + "\n"
+    else:
+        raise ValueError(f"Unknown output format: {fmt}")
+
+
+def renderVisits(patients, rows, fmt='text', offset=0, limit=None, batchSize=1000, header=True):
+    """
+    Generates the formatted visits in batches, each batch joined into a single string.
+
+    patients: The VisitStore the rows belong to.
+    rows: The row numbers of the visits to render.
+    fmt: One of FORMATS.
+    offset: The number of visits to skip.
+    limit: The maximum number of visits to render, or None for all of them.
+    batchSize: The number of visits per batch.
+    header: False to leave out the CSV header.
+    """
+    rows = islice(rows, offset, None if limit is None else offset + limit)
+    chunks = formatVisits(patients, rows, fmt, header)
+    while True:
+        batch = ''.join(islice(chunks, batchSize))
+        if not batch:
+            return
+        yield batch
+
+
+def writeVisits(patients, rows, fmt='text', offset=0, limit=None, out=None, batchSize=1000, header=True):
+    """
+    Writes the formatted visits with one write per batch.
+
+    patients: The VisitStore the rows belong to.
+    rows: The row numbers of the visits to write.
+    fmt: One of FORMATS.
+    offset: The number of visits to skip.
+    limit: The maximum number of visits to write, or None for all of them.
+    out: The file to write to. If None, the visits are written to standard output.
+    batchSize: The number of visits per write.
+    header: False to leave out the CSV header.
+    return: True if anything was written.
+    """
+    out = sys.stdout if out is None else out
+    written = False
+    for batch in renderVisits(patients, rows, fmt, offset, limit, batchSize, header):
+        out.write(batch)
+        written = True
+    out.flush()
+    return written
+
+
+def writeVisitPairs(visits, out=None, batchSize=1000):
+    """
+    Writes (patientId, visit) tuples in the layout of the visits found by date, with one write per batch.
+
+    visits: The (patientId, visit) tuples, e.g. found in a sharded store or a database.
+    out: The file to write to. If None, the visits are written to standard output.
+    batchSize: The number of visits per write.
+    return: True if anything was written.
+    """
+    out = sys.stdout if out is None else out
+    chunks = (DATE_VISIT % (patientId, *visit) for patientId, visit in visits)
+    written = False
+    while True:
+        batch = ''.join(islice(chunks, batchSize))
+        if not batch:
+            break
+        out.write(batch)
+        written = True
+    out.flush()
+    return written
+
+
+def page(number, size):
+    """
+    Returns the (offset, limit) of a page of visits.
+
+    number: The page number, starting at 1.
+    size: The number of visits per page.
+    """
+    return (number - 1) * size, size
@@ -0,0 +1,286 @@
+from contextlib import asynccontextmanager
+import argparse
+import asyncio
+import json
+import socket
+
+from bulkload import bulkLoadPatients
+from cohort import CohortView, parseQuery
+from dateindex import dateIndexOf
+from followup import FollowUpEngine
+import metrics
+from patientlog import appendTombstone, appendLines, rewriteWithout, visitLine
+from snapshot import isSnapshotCurrent, loadSnapshot
+from trends import trendsOf
+from vitalstats import distributionsOf, statsEngineOf
+from visitstore import VITALS, checkVisit, toDay, toTemp
+
+
+class ReadWriteLock:
+    """
+    asyncio lock that lets any number of readers in at once, or a single writer.
+
+    Waiting writers block new readers, so a steady stream of queries can't starve a mutation.
+    """
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waitingWriters = 0
+
+    @asynccontextmanager
+    async def reading(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writer and not self.waitingWriters)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @asynccontextmanager
+    async def writing(self):
+        async with self.condition:
+            self.waitingWriters += 1
+            await self.condition.wait_for(lambda: not self.writer and self.readers == 0)
+            self.waitingWriters -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+def summaryToDict(summary):
+    """
+    Returns the count, mean, minimum, maximum and standard deviation of every vital sign of a Summary.
+    """
+    if summary is None or summary.count == 0:
+        return {'count': 0}
+    result = {'count': summary.count}
+    for vital in VITALS:
+        low, high = summary.minimum(vital), summary.maximum(vital)
+        result[vital] = {'mean': round(summary.mean(vital), 2),
+                         'min': toTemp(low) if vital == 'temp' else low,
+                         'max': toTemp(high) if vital == 'temp' else high,
+                         'stddev': round(summary.stddev(vital), 2)}
+    return result
+
+
+class QueryService:
+    """
+    Request handlers for the operations of the Health Information System menu over one shared
+    in-memory VisitStore.
+
+    Queries run concurrently in worker threads under the read side of a ReadWriteLock, while
+    adding and deleting visits run one at a time under its write side.
+    """
+
+    def __init__(self, patients, fileName):
+        self.patients = patients
+        self.fileName = fileName
+        self.lock = ReadWriteLock()
+        # building the derived indexes up front, so queries never register listeners
+        dateIndexOf(patients)
+        statsEngineOf(patients)
+        trendsOf(patients)
+        distributionsOf(patients)
+        self.handlers = {
+            'display': (self.display, False),
+            'add': (self.add, True),
+            'stats': (self.stats, False),
+            'visits': (self.visits, False),
+            'query': (self.query, False),
+            'followup': (self.followup, False),
+            'trends': (self.trends, False),
+            'metrics': (self.metrics, False),
+            'distribution': (self.distribution, False),
+            'delete': (self.delete, True),
+            'purge': (self.purge, True),
+        }
+
+    async def handle(self, request):
+        """
+        Runs a single request and returns its response.
+
+        request: A dictionary with the name of the operation in 'op' and its parameters.
+        return: {'ok': True, 'result': ...} or {'ok': False, 'error': message}.
+        """
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': "A request must be a JSON object."}
+        op = request.get('op')
+        # any JSON value can arrive as the operation, and lists and objects can't be looked up
+        if not isinstance(op, str) or op not in self.handlers:
+            return {'ok': False, 'error': f"Unknown operation: {op}"}
+        handler, mutates = self.handlers[op]
+        params = {key: value for key, value in request.items() if key != 'op'}
+        loop = asyncio.get_running_loop()
+        try:
+            async with (self.lock.writing() if mutates else self.lock.reading()):
+                result = await loop.run_in_executor(None, lambda: handler(**params))
+        except Exception as error:
+            # a failing request must not take the connection down, whatever the handler raised
+            return {'ok': False, 'error': str(error)}
+        return {'ok': True, 'result': result}
+
+    def display(self, patientId=0):
+        patients = self.patients
+        ids = list(patients) if patientId == 0 else [patientId]
+        return [{'patientId': id, 'visits': [list(visit) for visit in patients[id]]} for id in ids if id in patients]
+
+    def add(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        visit = checkVisit(date, temp, hr, rr, sbp, dbp, spo2)
+        appendLines(self.fileName, [visitLine(patientId, *visit)])
+        self.patients.append(patientId, *visit)
+        return {'added': 1}
+
+    def stats(self, patientId=0):
+        return summaryToDict(statsEngineOf(self.patients).summary(int(patientId)))
+
+    def visits(self, year=None, month=None, limit=None):
+        view = dateIndexOf(self.patients).find(year, month)
+        result = []
+        for patientId, visit in view:
+            if limit is not None and len(result) >= limit:
+                break
+            result.append({'patientId': patientId, 'visit': list(visit)})
+        return result
+
+    def query(self, query, limit=None):
+        result = []
+        for patientId, visit in CohortView(self.patients, parseQuery(query)):
+            if limit is not None and len(result) >= limit:
+                break
+            result.append({'patientId': patientId, 'visit': list(visit)})
+        return result
+
+    def followup(self):
+        return [{'patientId': item.patientId, 'findings': item.findings}
+                for item in FollowUpEngine().screen(self.patients)]
+
+    def trends(self, patientId=0, vital='sbp', visits=3, days=None, minChange=None):
+        if vital not in VITALS:
+            raise ValueError(f"Unknown vital sign: {vital}")
+        engine = trendsOf(self.patients)
+        if patientId != 0:
+            return [trend._asdict() for trend in engine.trends(patientId, visits, days)]
+        return [trend._asdict() for trend in engine.ward(vital, visits, days, minChange=minChange)]
+
+    def distribution(self, vital, year=None, month=None, percentiles=(50, 90, 99), above=None, below=None):
+        if vital not in VITALS:
+            raise ValueError(f"Unknown vital sign: {vital}")
+        sketches = distributionsOf(self.patients)
+        result = {'percentiles': {str(q): value for q, value in
+                                  sketches.percentiles(vital, percentiles, year, month).items()},
+                  'histogram': sketches.histogram(vital, year, month).items()}
+        if above is not None or below is not None:
+            result['share'] = sketches.share(vital, above, below, year, month)
+        return result
+
+    def metrics(self):
+        return metrics.snapshot()
+
+    def delete(self, patientId):
+        if patientId not in self.patients:
+            return {'deleted': 0}
+        appendTombstone(self.fileName, patientId)
+        return {'deleted': self.patients.deletePatient(patientId)}
+
+    def purge(self, patientIds=(), lastVisitBefore=None):
+        selected = {id for id in patientIds if id in self.patients}
+        if lastVisitBefore is not None:
+            day = toDay(lastVisitBefore)
+            selected.update(id for id in self.patients if self.patients.lastDay(id) < day)
+        if not selected:
+            return {'patients': 0, 'visits': 0}
+        deleted, removed = self.patients.deletePatients(selected)
+        rewriteWithout(self.fileName, selected)
+        return {'patients': deleted, 'visits': removed}
+
+    async def serveClient(self, reader, writer):
+        """
+        Answers the JSON requests of one connection, one request and one response per line.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {'ok': False, 'error': "Invalid JSON request."}
+                else:
+                    response = await self.handle(request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(patients, fileName, socketPath=None, host='127.0.0.1', port=None):
+    """
+    Serves the query service until it is cancelled.
+
+    patients: The VisitStore to serve.
+    fileName: The patients file that additions and deletions are appended to.
+    socketPath: The path of the Unix socket to listen on.
+    host, port: The local address to listen on instead, if socketPath is None.
+    """
+    service = QueryService(patients, fileName)
+    if socketPath is not None:
+        server = await asyncio.start_unix_server(service.serveClient, path=socketPath)
+    else:
+        server = await asyncio.start_server(service.serveClient, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def queryService(request, socketPath=None, host='127.0.0.1', port=None):
+    """
+    Sends a single request to a running query service and returns its response.
+
+    request: A dictionary with the name of the operation in 'op' and its parameters.
+    socketPath: The path of the Unix socket of the service.
+    host, port: The local address of the service, if socketPath is None.
+    """
+    if socketPath is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socketPath)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query service for the Health Information System.")
+    parser.add_argument('--file', default='patients.txt', help="patients file to load and append to")
+    parser.add_argument('--snapshot', default='patients.snap', help="binary snapshot to load when it is current")
+    parser.add_argument('--socket', help="Unix socket to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="localhost port to listen on without --socket")
+    args = parser.parse_args()
+
+    store = None
+    if isSnapshotCurrent(args.snapshot, args.file):
+        # a damaged snapshot is skipped, the text file has every visit as well
+        try:
+            store = loadSnapshot(args.snapshot, verify=True)
+        except (OSError, ValueError) as error:
+            print(error)
+    if store is None:
+        store, rejects = bulkLoadPatients(args.file)
+        print(rejects.summary())
+    print(f"Serving {store.rowCount} visits of {len(store)} patients.")
+    try:
+        asyncio.run(serve(store, args.file, args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
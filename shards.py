@@ -0,0 +1,348 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import repeat
+import multiprocessing
+import os
+import os.path
+import sys
+
+from bulkload import bulkLoadPatients
+from cohort import CohortView, dateRangeOf
+from dateindex import dateIndexOf
+from followup import FollowUpEngine
+from patientlog import appendLines, appendTombstone, parseTombstone, rewriteWithout, visitLine
+from vitalstats import Summary, distributionsOf, statsEngineOf
+from visitstore import COLUMNS, TYPECODES, Visit, fromDay, internId, toTemp
+
+
+# the segments a worker process queries; set when the process is forked, see ShardedStore.executor
+segments = None
+
+
+def shardOf(patientId, shards):
+    """
+    Returns the number of the shard that owns a patient.
+
+    patientId: The ID of the patient.
+    shards: The number of shards.
+    """
+    return patientId % shards
+
+
+def shardFileName(fileName, shard, shards):
+    """
+    Returns the name of the file of one shard, e.g. 'patients-3of8.txt' for 'patients.txt'.
+
+    fileName: The name of the unsharded patients file.
+    shard: The number of the shard, starting at 0.
+    shards: The number of shards.
+    """
+    root, extension = os.path.splitext(fileName)
+    return f"{root}-{shard + 1}of{shards}{extension}"
+
+
+def splitPatientsFile(fileName, shards):
+    """
+    Splits a patients file into one file per shard in a single pass.
+
+    Visits and tombstones go to the shard of their patient; lines without a valid patient ID go
+    to the first shard, so loading it still reports them.
+    fileName: The name of the patients file to split.
+    shards: The number of shards.
+    return: The names of the shard files.
+    """
+    names = [shardFileName(fileName, shard, shards) for shard in range(shards)]
+    files = [open(name, 'w') for name in names]
+    try:
+        with open(fileName, 'r') as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                try:
+                    patientId = parseTombstone(line)
+                    if patientId is None:
+                        patientId = int(line.split(",", 1)[0])
+                except ValueError:
+                    patientId = 0
+                files[shardOf(patientId, shards)].write(line if line.endswith("\n") else line + "\n")
+    finally:
+        for file in files:
+            file.close()
+    return names
+
+
+def useSegments(stores):
+    global segments
+    segments = stores
+
+
+def shardSummary(shard):
+    return statsEngineOf(segments[shard]).summary(0)
+
+
+def shardHistogram(shard, vital, year, month):
+    return distributionsOf(segments[shard]).histogram(vital, year, month)
+
+
+def shardVisits(shard, year, month):
+    """
+    Returns the columns of the visits of one shard that match a year and month, in date order.
+    """
+    store = segments[shard]
+    columns = [array(typecode) for typecode in TYPECODES]
+    sources = [getattr(store, name) for name in COLUMNS]
+    for row in dateIndexOf(store).find(year, month).rows():
+        for column, source in zip(columns, sources):
+            column.append(source[row])
+    return columns
+
+
+def shardQuery(shard, query):
+    """
+    Returns the columns of the visits of one shard that match a cohort query, in the order of its CohortView.
+    """
+    store = segments[shard]
+    columns = [array(typecode) for typecode in TYPECODES]
+    sources = [getattr(store, name) for name in COLUMNS]
+    for row in CohortView(store, query).rows():
+        for column, source in zip(columns, sources):
+            column.append(source[row])
+    return columns
+
+
+def shardFollowUps(shard, rules, policy, n, m):
+    return FollowUpEngine(rules, policy, n, m).screen(segments[shard])
+
+
+class ShardedStore:
+    """
+    Visits partitioned by patient ID into several shards, each with its own patients file and
+    in-memory VisitStore segment.
+
+    Queries over all patients run as scatter-gather: every shard is queried in a worker process and
+    the partial results are merged. The workers are forked from this process, so they share the
+    segments and their indexes copy-on-write instead of receiving them; after visits are added or
+    deleted the workers are replaced on the next query. Operations on a single patient only touch
+    the shard that owns the patient.
+    """
+
+    def __init__(self, fileName, shards=8, workers=None):
+        """
+        fileName: The name of the unsharded patients file; the shard files are named after it.
+        If none of the shard files exist yet, fileName is split into them.
+        shards: The number of shards.
+        workers: The number of worker processes, by default one per CPU up to the number of shards.
+        """
+        self.fileName = fileName
+        self.shards = shards
+        self.workers = workers or min(shards, os.cpu_count() or 1)
+        self.fileNames = [shardFileName(fileName, shard, shards) for shard in range(shards)]
+        if not any(os.path.isfile(name) for name in self.fileNames) and os.path.isfile(fileName):
+            splitPatientsFile(fileName, shards)
+        self.segments = []
+        self.rejects = []
+        for name in self.fileNames:
+            if not os.path.isfile(name):
+                open(name, 'a').close()
+            store, report = bulkLoadPatients(name)
+            # building the derived indexes once, so the forked workers inherit them; as listeners
+            # of the segment they are kept up to date here, and every new pool forks them again
+            statsEngineOf(store)
+            dateIndexOf(store)
+            distributionsOf(store)
+            self.segments.append(store)
+            self.rejects.append(report)
+        self.pool = None
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def __iter__(self):
+        for segment in self.segments:
+            yield from segment
+
+    def __contains__(self, patientId):
+        return patientId in self.segmentOf(patientId)
+
+    def __getitem__(self, patientId):
+        return self.segmentOf(patientId)[patientId]
+
+    @property
+    def rowCount(self):
+        return sum(segment.rowCount for segment in self.segments)
+
+    def segmentOf(self, patientId):
+        """
+        Returns the VisitStore segment that owns a patient.
+        """
+        return self.segments[shardOf(patientId, self.shards)]
+
+    def executor(self):
+        """
+        Returns the pool of worker processes, forking it if there is none.
+
+        return: The executor, or None where processes can't be forked; the shards are then
+        queried one after another in this process.
+        """
+        if self.pool is None and self.workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                            initializer=useSegments, initargs=(self.segments,))
+        return self.pool
+
+    def changed(self):
+        # the workers hold a copy of the segments from before the change
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def close(self):
+        self.changed()
+
+    def scatter(self, function, *args):
+        """
+        Runs a function on every shard and returns the results in shard order.
+
+        function: A module level function that takes the shard number and args.
+        """
+        pool = self.executor()
+        if pool is None:
+            useSegments(self.segments)
+            return [function(shard, *args) for shard in range(self.shards)]
+        return list(pool.map(function, range(self.shards), *[[arg] * self.shards for arg in args]))
+
+    def append(self, patientId, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Adds a validated visit to the segment and the file of the shard that owns the patient.
+        """
+        shard = shardOf(patientId, self.shards)
+        appendLines(self.fileNames[shard], [visitLine(patientId, day, temp, hr, rr, sbp, dbp, spo2)])
+        self.segments[shard].append(patientId, day, temp, hr, rr, sbp, dbp, spo2)
+        self.changed()
+
+    def extend(self, pid, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Adds many validated visits, with one append to the file of every shard they belong to.
+
+        pid, day, temp, hr, rr, sbp, dbp, spo2: Columns of equal length, as for VisitStore.extend.
+        """
+        columns = (pid, day, temp, hr, rr, sbp, dbp, spo2)
+        parts = [[array(typecode) for typecode in TYPECODES] for _ in range(self.shards)]
+        for visit in zip(*columns):
+            for column, value in zip(parts[shardOf(visit[0], self.shards)], visit):
+                column.append(value)
+        for shard, part in enumerate(parts):
+            if part[0]:
+                appendLines(self.fileNames[shard], [visitLine(*visit) for visit in zip(*part)])
+                self.segments[shard].extend(*part)
+        self.changed()
+
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient from the segment and the file of the shard that owns it.
+
+        return: The number of visits that were deleted.
+        """
+        shard = shardOf(patientId, self.shards)
+        if patientId not in self.segments[shard]:
+            return 0
+        appendTombstone(self.fileNames[shard], patientId)
+        removed = self.segments[shard].deletePatient(patientId)
+        self.changed()
+        return removed
+
+    def deletePatients(self, patientIds):
+        """
+        Deletes many patients, rewriting the file of every shard that owns one of them once.
+
+        patientIds: The IDs of the patients to delete.
+        return: A (patients, visits, records) tuple with the number of patients and visits deleted
+        from the segments and the number of records dropped from the files.
+        """
+        byShard = {}
+        for patientId in patientIds:
+            byShard.setdefault(shardOf(patientId, self.shards), set()).add(patientId)
+        patients = visits = records = 0
+        for shard, ids in byShard.items():
+            deleted, removed = self.segments[shard].deletePatients(ids)
+            patients += deleted
+            visits += removed
+            records += rewriteWithout(self.fileNames[shard], ids)[1]
+        self.changed()
+        return patients, visits, records
+
+    def summary(self, patientId=0):
+        """
+        Returns the Summary of a patient, or the merged Summary of every shard if patientId is 0.
+
+        return: The Summary, or None if there are no visits.
+        """
+        if patientId != 0:
+            return statsEngineOf(self.segmentOf(patientId)).summary(patientId)
+        total = Summary()
+        for summary in self.scatter(shardSummary):
+            if summary is not None:
+                total.merge(summary)
+        return total if total.count else None
+
+    def histogram(self, vital, year=None, month=None):
+        """
+        Returns the merged histogram of a vital sign over every shard, see VitalDistributions.histogram.
+        """
+        parts = self.scatter(shardHistogram, vital, year, month)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        return merged
+
+    def findVisits(self, year=None, month=None):
+        """
+        Returns the (patientId, Visit) tuples of a year, a month of every year, or both, in date order.
+
+        year: The year to filter by, or None for every year.
+        month: The month to filter by, or None for every month.
+        """
+        parts = self.scatter(shardVisits, year, month)
+        # every shard is already in date order, so the parts only need a k-way merge
+        streams = [zip(part[1], range(len(part[1])), repeat(shard)) for shard, part in enumerate(parts)]
+        visits = []
+        for day, position, shard in heapq.merge(*streams):
+            pid, day, temp, hr, rr, sbp, dbp, spo2 = (column[position] for column in parts[shard])
+            pid = internId(pid)
+            visits.append((pid, Visit(pid, fromDay(day), toTemp(temp), hr, rr, sbp, dbp, spo2)))
+        return visits
+
+    def query(self, query):
+        """
+        Generates the (patientId, Visit) tuples of every shard that match a cohort query, in date
+        order when the query limits the dates and by patient ID otherwise.
+
+        query: A predicate from the cohort module.
+        """
+        parts = self.scatter(shardQuery, query)
+        # every shard is already in that order, so the parts only need a k-way merge
+        key = 1 if dateRangeOf(query) is not None else 0
+        streams = [zip(part[key], range(len(part[key])), repeat(shard)) for shard, part in enumerate(parts)]
+        for _, position, shard in heapq.merge(*streams):
+            pid, day, temp, hr, rr, sbp, dbp, spo2 = (column[position] for column in parts[shard])
+            pid = internId(pid)
+            yield pid, Visit(pid, fromDay(day), toTemp(temp), hr, rr, sbp, dbp, spo2)
+
+    def followUps(self, rules=None, policy='any', n=1, m=1):
+        """
+        Returns a FollowUp for every patient of every shard that needs a follow-up visit, by patient ID.
+
+        rules, policy, n, m: The arguments of FollowUpEngine; rules defaults to its default rules.
+        """
+        if rules is None:
+            rules = FollowUpEngine().rules
+        results = [followup for part in self.scatter(shardFollowUps, rules, policy, n, m) for followup in part]
+        return sorted(results, key=lambda followup: followup.patientId)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'split':
+        print("Usage: python shards.py split <patients file> <number of shards>")
+        sys.exit(1)
+    for name in splitPatientsFile(sys.argv[2], int(sys.argv[3])):
+        print(name)
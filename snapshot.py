@@ -0,0 +1,179 @@
+from array import array
+import mmap
+import os
+import os.path
+import struct
+import sys
+import zlib
+
+from dateindex import DateIndex
+from visitstore import VisitStore, COLUMNS, TYPECODES, fromDay, toTemp
+
+
+MAGIC = b'HISSNAP1'
+VERSION = 1
+
+# magic, version, reserved, number of visits, number of patients, crc32 of everything after the header
+HEADER = struct.Struct('<8sIIQQI28x')
+
+# the sections after the header, each starting on an 8 byte boundary:
+# the patient offset table (IDs, first rows and visit counts), one section per visit column with
+# the visits grouped by patient, and the visits sorted by date (day ordinals and row numbers)
+PATIENT_SECTIONS = (('patientIds', 'q'), ('patientStarts', 'q'), ('patientCounts', 'q'))
+DATE_SECTIONS = (('dateDays', 'i'), ('dateRows', 'q'))
+
+
+def sectionLayout(visits, patients):
+    """
+    Returns the (name, typecode, offset, length) of every section of a snapshot.
+
+    visits: The number of visits in the snapshot.
+    patients: The number of patients in the snapshot.
+    """
+    layout = []
+    offset = HEADER.size
+    sections = [(name, typecode, patients) for name, typecode in PATIENT_SECTIONS]
+    sections += [(name, typecode, visits) for name, typecode in zip(COLUMNS, TYPECODES)]
+    sections += [(name, typecode, visits) for name, typecode in DATE_SECTIONS]
+    for name, typecode, count in sections:
+        length = count * array(typecode).itemsize
+        layout.append((name, typecode, offset, length))
+        offset += (length + 7) // 8 * 8
+    return layout
+
+
+def writeSnapshot(patients, fileName):
+    """
+    Writes a VisitStore to a binary snapshot file.
+
+    The visits are written grouped by patient and without deleted rows, the date order is
+    computed for the written rows, and the file is replaced atomically.
+    patients: The VisitStore to write.
+    fileName: The name of the snapshot file.
+    return: The number of visits written.
+    """
+    sections = {name: array(typecode) for name, typecode in PATIENT_SECTIONS}
+    sections.update({name: array(typecode) for name, typecode in zip(COLUMNS, TYPECODES)})
+    for patientId, ranges in patients.index.items():
+        sections['patientIds'].append(patientId)
+        sections['patientStarts'].append(len(sections['pid']))
+        for start, stop in ranges:
+            for name in COLUMNS:
+                sections[name].extend(getattr(patients, name)[start:stop])
+        sections['patientCounts'].append(len(sections['pid']) - sections['patientStarts'][-1])
+
+    day = sections['day']
+    order = sorted(range(len(day)), key=day.__getitem__)
+    sections['dateRows'] = array('q', order)
+    sections['dateDays'] = array('i', (day[row] for row in order))
+
+    visits, count = len(sections['pid']), len(sections['patientIds'])
+    temporary = fileName + '.tmp'
+    crc = 0
+    with open(temporary, 'wb') as file:
+        file.write(bytes(HEADER.size))
+        for name, typecode, offset, length in sectionLayout(visits, count):
+            data = sections[name].tobytes()
+            padding = bytes(-length % 8)
+            crc = zlib.crc32(padding, zlib.crc32(data, crc))
+            file.write(data + padding)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, 0, visits, count, crc))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, fileName)
+    return visits
+
+
+def loadSnapshot(fileName, verify=False):
+    """
+    Loads a binary snapshot by memory-mapping it, without copying or parsing the visits.
+
+    The columns of the returned VisitStore are read-only views of the mapped file; they are
+    copied into arrays the first time visits are added.
+    fileName: The name of the snapshot file.
+    verify: If True, the checksum of the whole file is checked, which reads every byte.
+    return: A VisitStore with its date index already registered. Raises ValueError for a damaged file.
+    """
+    with open(fileName, 'rb') as file:
+        # an empty file can't be mapped at all
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            raise ValueError(f"'{fileName}' is not a patient snapshot.")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, visits, count, crc = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"'{fileName}' is not a patient snapshot.")
+    layout = sectionLayout(visits, count)
+    name, typecode, offset, length = layout[-1]
+    if len(data) != offset + (length + 7) // 8 * 8:
+        raise ValueError(f"The snapshot '{fileName}' is truncated or has trailing data.")
+    view = memoryview(data)
+    if verify and zlib.crc32(view[HEADER.size:]) != crc:
+        raise ValueError(f"The checksum of the snapshot '{fileName}' does not match.")
+
+    sections = {name: view[offset:offset + length].cast(typecode) for name, typecode, offset, length in layout}
+    patients = VisitStore()
+    for name in COLUMNS:
+        setattr(patients, name, sections[name])
+    patients.mapped = data
+    patients.alive = bytearray(b'\x01') * visits
+    patients.index = {patientId: [[start, start + number]] for patientId, start, number in
+                      zip(sections['patientIds'], sections['patientStarts'], sections['patientCounts'])}
+    patients.addListener(DateIndex(patients, sections['dateDays'], sections['dateRows']))
+    return patients
+
+
+def isSnapshotCurrent(snapshotName, fileName):
+    """
+    Returns True if a snapshot exists and is at least as new as the patients file it was made from.
+
+    snapshotName: The name of the snapshot file.
+    fileName: The name of the patients file.
+    """
+    if not os.path.isfile(snapshotName):
+        return False
+    return not os.path.isfile(fileName) or os.path.getmtime(snapshotName) >= os.path.getmtime(fileName)
+
+
+def writeText(patients, fileName):
+    """
+    Writes every visit of a VisitStore to a plaintext patients file.
+
+    patients: The VisitStore to write.
+    fileName: The name of the file to write.
+    """
+    with open(fileName, 'w') as file:
+        for patientId in patients:
+            for row in patients.rows(patientId):
+                file.write(f"{patientId},{fromDay(patients.day[row])},{toTemp(patients.temp[row])},"
+                           f"{patients.hr[row]},{patients.rr[row]},{patients.sbp[row]},"
+                           f"{patients.dbp[row]},{patients.spo2[row]}\n")
+
+
+if __name__ == '__main__':
+    usage = ("Usage: python snapshot.py fromtext <patients file> <snapshot file>\n"
+             "       python snapshot.py totext <snapshot file> <patients file>\n"
+             "       python snapshot.py verify <snapshot file>")
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(1)
+    command = sys.argv[1]
+    if command == 'fromtext' and len(sys.argv) == 4:
+        from bulkload import bulkLoadPatients
+        store, rejects = bulkLoadPatients(sys.argv[2])
+        print(rejects.summary())
+        print(f"Wrote {writeSnapshot(store, sys.argv[3])} visits to '{sys.argv[3]}'.")
+    elif command == 'totext' and len(sys.argv) == 4:
+        store = loadSnapshot(sys.argv[2], verify=True)
+        writeText(store, sys.argv[3])
+        print(f"Wrote {store.rowCount} visits to '{sys.argv[3]}'.")
+    elif command == 'verify' and len(sys.argv) == 3:
+        try:
+            store = loadSnapshot(sys.argv[2], verify=True)
+        except ValueError as error:
+            print(error)
+            sys.exit(1)
+        print(f"'{sys.argv[2]}' is valid: {store.rowCount} visits of {len(store)} patients.")
+    else:
+        print(usage)
+        sys.exit(1)
@@ -0,0 +1,403 @@
+from array import array
+import datetime
+import os
+import sqlite3
+import sys
+
+from bulkload import RejectsReport
+from cohort import dateRangeOf
+from dateindex import firstDay
+from followup import DEFAULT_RULES, OPERATORS, POLICIES, FollowUp
+from patientlog import parseTombstone
+from vitalstats import Summary, VitalHistogram
+from visitstore import VisitStore, Visit, VITALS, LIMITS, InvalidVisit, TYPECODES, parseVisit, fromDay, internId, toTemp
+
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS visits (id INTEGER PRIMARY KEY, patient_id INTEGER NOT NULL, "
+    "day INTEGER NOT NULL, temp REAL NOT NULL, hr INTEGER NOT NULL, rr INTEGER NOT NULL, "
+    "sbp INTEGER NOT NULL, dbp INTEGER NOT NULL, spo2 INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS visits_patient_day ON visits (patient_id, day)",
+    "CREATE INDEX IF NOT EXISTS visits_day ON visits (day)",
+)
+
+# the statements are constant strings, so sqlite3 prepares each of them once and reuses it
+INSERT_VISIT = "INSERT INTO visits (patient_id, day, temp, hr, rr, sbp, dbp, spo2) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+DELETE_PATIENT = "DELETE FROM visits WHERE patient_id = ?"
+PATIENT_VISITS = ("SELECT day, temp, hr, rr, sbp, dbp, spo2 FROM visits WHERE patient_id = ? "
+                  "ORDER BY day, id")
+ALL_VISITS = "SELECT patient_id, day, temp, hr, rr, sbp, dbp, spo2 FROM visits ORDER BY patient_id, day, id"
+DAY_RANGE = ("SELECT patient_id, day, temp, hr, rr, sbp, dbp, spo2 FROM visits WHERE day >= ? AND day < ? "
+             "ORDER BY day, id")
+HAS_PATIENT = "SELECT 1 FROM visits WHERE patient_id = ? LIMIT 1"
+
+# count, then the sum, sum of squares, minimum and maximum of every vital sign
+AGGREGATES = "SELECT COUNT(*), " + ", ".join(
+    f"TOTAL({vital}), TOTAL({vital} * {vital}), MIN({vital}), MAX({vital})" for vital in VITALS) + " FROM visits"
+
+
+def ruleCondition(rule):
+    """
+    Returns the SQL condition of a follow-up Rule, with a single parameter for its threshold.
+    """
+    if rule.vital not in VITALS:
+        raise ValueError(f"Unknown vital sign in rule {rule.name}: {rule.vital}")
+    if rule.op not in OPERATORS:
+        raise ValueError(f"Unknown operator in rule {rule.name}: {rule.op}")
+    return f"{rule.vital} {rule.op} ?"
+
+
+class SqliteStore:
+    """
+    Visits stored in an SQLite database, as a storage engine next to the in-memory VisitStore.
+
+    Every visit is a row of the visits table, indexed on (patient_id, day) for the visits of a
+    patient and on day for date range scans. Statistics and the follow-up screen are computed by
+    SQLite, so the memory used by queries does not grow with the number of visits.
+    """
+
+    def __init__(self, fileName):
+        """
+        fileName: The name of the database file; it is created if it does not exist.
+        """
+        self.fileName = fileName
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(DISTINCT patient_id) FROM visits").fetchone()[0]
+
+    def __iter__(self):
+        for (patientId,) in self.connection.execute("SELECT DISTINCT patient_id FROM visits ORDER BY patient_id"):
+            yield patientId
+
+    def __contains__(self, patientId):
+        return self.connection.execute(HAS_PATIENT, (patientId,)).fetchone() is not None
+
+    def __getitem__(self, patientId):
+        patientId = internId(patientId)
+        visits = [Visit(patientId, fromDay(day), toTemp(temp), *values) for day, temp, *values in
+                  self.connection.execute(PATIENT_VISITS, (patientId,))]
+        if not visits:
+            raise KeyError(patientId)
+        return visits
+
+    @property
+    def rowCount(self):
+        return self.connection.execute("SELECT COUNT(*) FROM visits").fetchone()[0]
+
+    def append(self, patientId, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Adds a single validated visit in its own transaction.
+        """
+        with self.connection:
+            self.connection.execute(INSERT_VISIT, (patientId, day, temp, hr, rr, sbp, dbp, spo2))
+
+    def extend(self, pid, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Adds many validated visits in a single transaction.
+
+        pid, day, temp, hr, rr, sbp, dbp, spo2: Columns of equal length, as for VisitStore.extend.
+        """
+        with self.connection:
+            self.connection.executemany(INSERT_VISIT, zip(pid, day, temp, hr, rr, sbp, dbp, spo2))
+
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient.
+
+        return: The number of visits that were deleted.
+        """
+        with self.connection:
+            return self.connection.execute(DELETE_PATIENT, (patientId,)).rowcount
+
+    def deletePatients(self, patientIds):
+        """
+        Deletes many patients in a single transaction.
+
+        patientIds: The IDs of the patients to delete.
+        return: A (patients, visits, records) tuple; every deleted visit is one record.
+        """
+        patients = visits = 0
+        with self.connection:
+            for patientId in patientIds:
+                removed = self.connection.execute(DELETE_PATIENT, (patientId,)).rowcount
+                if removed:
+                    patients += 1
+                    visits += removed
+        return patients, visits, visits
+
+    def chunks(self, patientId=0, size=10000):
+        """
+        Generates the visits of a patient, or of every patient, as small VisitStores that can be
+        passed to the render functions; a patient is never split across two of them.
+
+        patientId: The ID of the patient, or 0 for every patient.
+        size: The approximate number of visits per VisitStore.
+        """
+        if patientId != 0:
+            cursor = ((patientId,) + row for row in self.connection.execute(PATIENT_VISITS, (patientId,)))
+        else:
+            cursor = self.connection.execute(ALL_VISITS)
+        columns = [array(typecode) for typecode in TYPECODES]
+        for row in cursor:
+            if len(columns[0]) >= size and row[0] != columns[0][-1]:
+                segment = VisitStore()
+                segment.extend(*columns)
+                yield segment
+                columns = [array(typecode) for typecode in TYPECODES]
+            for column, value in zip(columns, row):
+                column.append(value)
+        if len(columns[0]):
+            segment = VisitStore()
+            segment.extend(*columns)
+            yield segment
+
+    def segmentOf(self, patientId):
+        """
+        Returns the visits of a single patient as a VisitStore, e.g. for the trend engine.
+        """
+        return next(self.chunks(patientId), None) or VisitStore()
+
+    def summary(self, patientId=0):
+        """
+        Returns the Summary of a patient, or of all patients if patientId is 0, computed by SQLite.
+
+        return: The Summary, or None if there are no visits.
+        """
+        if patientId != 0:
+            row = self.connection.execute(AGGREGATES + " WHERE patient_id = ?", (patientId,)).fetchone()
+        else:
+            row = self.connection.execute(AGGREGATES).fetchone()
+        if not row[0]:
+            return None
+        summary = Summary()
+        summary.count = row[0]
+        summary.total = list(row[1::4])
+        summary.squares = list(row[2::4])
+        summary.low = list(row[3::4])
+        summary.high = list(row[4::4])
+        return summary
+
+    def dayRanges(self, year=None, month=None):
+        """
+        Returns the [start, stop) day ordinal ranges of a year, a month of every year, or both.
+        """
+        if year is not None and not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+            return []
+        if year is not None and month is not None:
+            return [(firstDay(year, month), firstDay(year, month + 1))]
+        if year is not None:
+            return [(firstDay(year), firstDay(year + 1))]
+        first, last = self.connection.execute("SELECT MIN(day), MAX(day) FROM visits").fetchone()
+        if first is None:
+            return []
+        if month is None:
+            return [(first, last + 1)]
+        years = range(datetime.date.fromordinal(first).year, datetime.date.fromordinal(last).year + 1)
+        return [(firstDay(y, month), firstDay(y, month + 1)) for y in years]
+
+    def histogram(self, vital, year=None, month=None):
+        """
+        Returns the histogram of a vital sign over a year, a month of every year, both or everything,
+        counted by SQLite.
+
+        vital: The name of the vital sign, one of VITALS.
+        """
+        # the vital is part of the statement, so it is checked against the known columns first
+        i = VITALS.index(vital)
+        name, low, high, _ = LIMITS[i]
+        histogram = VitalHistogram(low, high, 0.1 if name == 'temp' else 1)
+        for start, stop in self.dayRanges(year, month):
+            rows = self.connection.execute(
+                f"SELECT {vital}, COUNT(*) FROM visits WHERE day >= ? AND day < ? GROUP BY {vital}",
+                (start, stop))
+            for value, count in rows:
+                histogram.add(value, count)
+        return histogram
+
+    def findVisits(self, year=None, month=None):
+        """
+        Returns a lazy view of the visits of a year, a month of every year, or both, in date order.
+        """
+        return SqliteDateView(self, self.dayRanges(year, month))
+
+    def query(self, query):
+        """
+        Returns a lazy view of the visits that match a cohort query, evaluated by SQLite.
+
+        query: A predicate from the cohort module.
+        """
+        return SqliteQueryView(self, query)
+
+    def followUps(self, rules=DEFAULT_RULES, policy='any', n=1, m=1):
+        """
+        Returns a FollowUp for every patient that needs a follow-up visit, by patient ID.
+
+        The rules are evaluated by SQLite; the policies are those of FollowUpEngine.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown follow-up policy: {policy}")
+        if not rules:
+            return []
+        rules = tuple(rules)
+        fired = " OR ".join(f"({ruleCondition(rule)})" for rule in rules)
+        thresholds = [rule.threshold for rule in rules]
+        columns = "patient_id, day, " + ", ".join(VITALS)
+        if policy == 'any':
+            # the first visit of every patient that fires a rule
+            query = (f"SELECT {columns}, MIN(id) FROM visits WHERE {fired} "
+                     f"GROUP BY patient_id ORDER BY patient_id")
+            parameters = thresholds
+        else:
+            window = 1 if policy == 'latest' else m
+            needed = 1 if policy == 'latest' else n
+            # visits on the same day are ranked like FollowUpEngine ranks them: 'latest' takes
+            # the first of them and 'last' the ones added last
+            ties = 'ASC' if policy == 'latest' else 'DESC'
+            query = (f"WITH latest AS (SELECT *, ROW_NUMBER() OVER (PARTITION BY patient_id "
+                     f"ORDER BY day DESC, id {ties}) AS position FROM visits), "
+                     f"hits AS (SELECT * FROM latest WHERE position <= ? AND ({fired})) "
+                     f"SELECT {columns}, id FROM hits WHERE patient_id IN "
+                     f"(SELECT patient_id FROM hits GROUP BY patient_id HAVING COUNT(*) >= ?) "
+                     f"ORDER BY patient_id, day, id")
+            parameters = [window] + thresholds + [needed]
+
+        results = []
+        for patientId, day, *values in self.connection.execute(query, parameters):
+            values = dict(zip(VITALS, values))
+            names = [rule.name for rule in rules if OPERATORS[rule.op](values[rule.vital], rule.threshold)]
+            if results and results[-1].patientId == patientId:
+                results[-1].findings.append((fromDay(day), names))
+            else:
+                results.append(FollowUp(patientId, [(fromDay(day), names)]))
+        return results
+
+
+class SqliteQueryView:
+    """
+    Lazy sequence of the (patientId, Visit) tuples that match a cohort query, in date order when
+    the query limits the dates and by patient ID otherwise.
+    """
+
+    def __init__(self, store, query):
+        self.store = store
+        self.condition, self.parameters = query.sql()
+        self.order = "day, id" if dateRangeOf(query) is not None else "patient_id, day, id"
+
+    def __iter__(self):
+        for patientId, day, temp, *values in self.store.connection.execute(
+                f"SELECT patient_id, day, temp, hr, rr, sbp, dbp, spo2 FROM visits WHERE {self.condition} "
+                f"ORDER BY {self.order}", self.parameters):
+            patientId = internId(patientId)
+            yield patientId, Visit(patientId, fromDay(day), toTemp(temp), *values)
+
+    def __len__(self):
+        return self.store.connection.execute(f"SELECT COUNT(*) FROM visits WHERE {self.condition}",
+                                             self.parameters).fetchone()[0]
+
+    def __bool__(self):
+        return self.store.connection.execute(f"SELECT 1 FROM visits WHERE {self.condition} LIMIT 1",
+                                             self.parameters).fetchone() is not None
+
+
+class SqliteDateView:
+    """
+    Lazy sequence of (patientId, Visit) tuples for some day ranges of an SqliteStore, read with
+    range scans of the day index when the view is iterated.
+    """
+
+    def __init__(self, store, ranges):
+        self.store = store
+        self.ranges = ranges
+
+    def __iter__(self):
+        for start, stop in self.ranges:
+            for patientId, day, temp, *values in self.store.connection.execute(DAY_RANGE, (start, stop)):
+                patientId = internId(patientId)
+                yield patientId, Visit(patientId, fromDay(day), toTemp(temp), *values)
+
+    def __len__(self):
+        return sum(self.store.connection.execute("SELECT COUNT(*) FROM visits WHERE day >= ? AND day < ?",
+                                                 (start, stop)).fetchone()[0] for start, stop in self.ranges)
+
+    def __bool__(self):
+        for start, stop in self.ranges:
+            if self.store.connection.execute("SELECT 1 FROM visits WHERE day >= ? AND day < ? LIMIT 1",
+                                             (start, stop)).fetchone():
+                return True
+        return False
+
+
+def migrateFromText(fileName, databaseName, batchSize=10000):
+    """
+    Imports a plaintext patients file into an SQLite database, applying deletions as they are read.
+
+    The database is built in a temporary file that replaces the database once the import succeeded,
+    so running the import again rebuilds the database instead of adding every visit a second time.
+    fileName: The name of the patients file.
+    databaseName: The name of the database file.
+    batchSize: The number of visits inserted per transaction.
+    return: A (number of visits imported, RejectsReport) tuple.
+    """
+    temporary = databaseName + '.tmp'
+    # leftovers of an import that was interrupted
+    for name in (temporary, temporary + '-wal', temporary + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+    store = SqliteStore(temporary)
+    report = RejectsReport()
+    batch = []
+    imported = 0
+    try:
+        with open(fileName, 'r') as file:
+            for number, line in enumerate(file, 1):
+                try:
+                    deleted = parseTombstone(line)
+                except ValueError:
+                    report.add(number, 'patient_id', f"Invalid patient ID in line: {line}")
+                    continue
+                if deleted is not None:
+                    # the visits before the tombstone have to be in the table to be deleted
+                    with store.connection:
+                        store.connection.executemany(INSERT_VISIT, batch)
+                    imported += len(batch) - store.deletePatient(deleted)
+                    batch = []
+                    continue
+                try:
+                    batch.append(parseVisit(line))
+                except InvalidVisit as error:
+                    report.add(number, error.reason, error.message)
+                    continue
+                if len(batch) >= batchSize:
+                    with store.connection:
+                        store.connection.executemany(INSERT_VISIT, batch)
+                    imported += len(batch)
+                    batch = []
+        with store.connection:
+            store.connection.executemany(INSERT_VISIT, batch)
+        imported += len(batch)
+    except BaseException:
+        store.close()
+        os.remove(temporary)
+        raise
+    # closing the last connection checkpoints the write-ahead log into the database file
+    store.close()
+    os.replace(temporary, databaseName)
+    return imported, report
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        print("Usage: python sqlstore.py migrate <patients file> <database file>")
+        sys.exit(1)
+    imported, rejects = migrateFromText(sys.argv[2], sys.argv[3])
+    print(rejects.summary())
+    print(f"Imported {imported} visits into '{sys.argv[3]}'.")
@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import random
+
+
+# the kinds of invalid lines the generator mixes in, one for every check of readPatientsFromFile
+INVALID_KINDS = ('fields', 'patient_id', 'type', 'temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2', 'date')
+
+
+def invalidLine(rng, line, kind):
+    """
+    Breaks a valid line so that it fails one check of readPatientsFromFile.
+
+    rng: The random generator.
+    line: The valid line, without a line ending.
+    kind: One of INVALID_KINDS.
+    """
+    field = line.split(",")
+    if kind == 'fields':
+        return ",".join(field[:rng.randint(1, 7)])
+    if kind == 'patient_id':
+        field[0] = "P" + field[0]
+    elif kind == 'type':
+        field[rng.randint(2, 7)] = "n/a"
+    elif kind == 'date':
+        field[1] = field[1][:5] + "13" + field[1][7:]
+    else:
+        position, value = {'temp': (2, "43.5"), 'hr': (3, "190"), 'rr': (4, "2"), 'sbp': (5, "250"),
+                           'dbp': (6, "30"), 'spo2': (7, "60")}[kind]
+        field[position] = value
+    return ",".join(field)
+
+
+def generateVisits(patients=1000, visitsPerPatient=10, startDate='2020-01-01', endDate='2024-12-31',
+                   invalidRate=0.0, seed=0):
+    """
+    Generates the lines of a synthetic patients file, grouped by patient and sorted by date.
+
+    patients: The number of patients.
+    visitsPerPatient: The average number of visits of a patient.
+    startDate, endDate: The range of the visit dates, in the format 'yyyy-mm-dd'.
+    invalidRate: The share of lines that are made invalid, between 0 and 1.
+    seed: The seed of the random generator; the same arguments always generate the same lines.
+    """
+    rng = random.Random(seed)
+    first = datetime.date.fromisoformat(startDate).toordinal()
+    last = datetime.date.fromisoformat(endDate).toordinal()
+    # most visits fall on a limited set of clinic days, like real intake data
+    clinicDays = sorted(rng.randint(first, last) for _ in range(max((last - first) // 3, 1)))
+    dates = [datetime.date.fromordinal(day).isoformat() for day in clinicDays]
+
+    for patientId in range(1, patients + 1):
+        visits = max(1, round(rng.gauss(visitsPerPatient, visitsPerPatient / 4)))
+        # a few patients have abnormal vital signs and need a follow-up
+        sick = rng.random() < 0.1
+        for position in sorted(rng.randrange(len(dates)) for _ in range(visits)):
+            line = (f"{patientId},{dates[position]},{round(rng.uniform(36.1, 38.4 if sick else 37.6), 1)},"
+                    f"{rng.randint(50, 120) if sick else rng.randint(62, 95)},{rng.randint(12, 24)},"
+                    f"{rng.randint(105, 165) if sick else rng.randint(105, 135)},"
+                    f"{rng.randint(65, 100) if sick else rng.randint(65, 88)},"
+                    f"{rng.randint(84, 99) if sick else rng.randint(92, 100)}")
+            if invalidRate and rng.random() < invalidRate:
+                line = invalidLine(rng, line, rng.choice(INVALID_KINDS))
+            yield line
+
+
+def generatePatientsFile(fileName, patients=1000, visitsPerPatient=10, startDate='2020-01-01',
+                         endDate='2024-12-31', invalidRate=0.0, seed=0):
+    """
+    Writes a synthetic patients file in the format of patients.txt.
+
+    fileName: The name of the file to write.
+    The other arguments are those of generateVisits.
+    return: The number of lines written.
+    """
+    count = 0
+    with open(fileName, 'w') as file:
+        batch = []
+        for line in generateVisits(patients, visitsPerPatient, startDate, endDate, invalidRate, seed):
+            batch.append(line)
+            if len(batch) == 10000:
+                file.write("\n".join(batch) + "\n")
+                count += len(batch)
+                batch = []
+        if batch:
+            file.write("\n".join(batch) + "\n")
+            count += len(batch)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates a synthetic patients file.")
+    parser.add_argument('fileName', help="file to write")
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--visits', type=int, default=10, help="average number of visits per patient")
+    parser.add_argument('--start', default='2020-01-01', help="first visit date")
+    parser.add_argument('--end', default='2024-12-31', help="last visit date")
+    parser.add_argument('--invalid', type=float, default=0.0, help="share of invalid lines")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    lines = generatePatientsFile(args.fileName, args.patients, args.visits, args.start, args.end,
+                                 args.invalid, args.seed)
+    print(f"Wrote {lines} lines to '{args.fileName}'.")
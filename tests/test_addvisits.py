@@ -0,0 +1,24 @@
+import main
+from visitstore import VisitStore
+
+
+def test_invalid_patient_ids_are_rejected_without_losing_the_batch(tmp_path):
+    fileName = str(tmp_path / 'patients.txt')
+    patients = VisitStore()
+    visits = [
+        (1, '2024-01-01', 37.0, 70, 16, 120, 80, 97),
+        ('2', '2024-01-02', 37.0, 70, 16, 120, 80, 97),
+        (2 ** 70, '2024-01-03', 37.0, 70, 16, 120, 80, 97),
+        (True, '2024-01-04', 37.0, 70, 16, 120, 80, 97),
+        (3, '2024-01-05', 37.0, 70, 16, 120, 80, 97),
+        (4, '2024-01-06', 50.0, 70, 16, 120, 80, 97),
+        (5, '2024-01-07', 37.0, 70, 16, 120, 80, 97),
+    ]
+
+    added, report = main.addPatientVisits(patients, visits, fileName, batchSize=2)
+
+    assert added == 3
+    assert sorted((number, reason) for number, reason, _ in report) == \
+        [(2, 'patient_id'), (3, 'patient_id'), (4, 'patient_id'), (6, 'temp')]
+    assert sorted(patients) == [1, 3, 5]
+    assert main.readPatientsFromFile(fileName).items() == patients.items()
@@ -0,0 +1,73 @@
+import pytest
+
+from bulkload import bulkLoadPatients
+import main
+import metrics
+from patientlog import visitLine
+from synthdata import generatePatientsFile
+from visitstore import toDay
+
+
+def contents(patients):
+    return {patientId: [list(visit) for visit in visits] for patientId, visits in patients.items()}
+
+
+def rejectedLines(report):
+    return sorted((lineNumber, reason) for lineNumber, reason, _ in report)
+
+
+def readWithRejects(fileName):
+    """
+    Returns the store readPatientsFromFile builds and the rejects it counts, by reason.
+    """
+    metrics.enable()
+    try:
+        metrics.reset()
+        patients = main.readPatientsFromFile(fileName)
+        counts = {name[len('read.rejected.'):]: value for name, value in metrics.snapshot()['counters'].items()
+                  if name.startswith('read.rejected.')}
+    finally:
+        metrics.disable()
+    return patients, counts
+
+
+@pytest.mark.parametrize('workers, chunkSize', [(1, 8 * 1024 * 1024), (4, 4096)])
+def test_bulk_load_matches_sequential_read_on_synthetic_data(tmp_path, workers, chunkSize):
+    fileName = str(tmp_path / 'patients.txt')
+    generatePatientsFile(fileName, patients=200, visitsPerPatient=15, invalidRate=0.05, seed=7)
+
+    patients, counts = readWithRejects(fileName)
+    loaded, report = bulkLoadPatients(fileName, workers=workers, chunkSize=chunkSize)
+
+    assert contents(loaded) == contents(patients)
+    assert report.counts() == counts
+    assert sum(counts.values()) > 0
+
+
+def test_nan_does_not_hide_out_of_range_values(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text('\n'.join([
+        "1,2024-01-01,nan,70,16,120,80,97",
+        visitLine(1, toDay('2024-01-02'), 37.0, 70, 16, 120, 80, 97),
+        "2,2024-01-03,50,70,16,120,80,97",
+        "3,2024-01-04,37.0,70,16,120,80,nan",
+    ]) + '\n')
+
+    patients = main.readPatientsFromFile(str(path))
+    loaded, report = bulkLoadPatients(str(path), workers=1)
+
+    assert contents(loaded) == contents(patients) == {1: [['2024-01-02', 37.0, 70, 16, 120, 80, 97]]}
+    assert rejectedLines(report) == [(1, 'temp'), (3, 'temp'), (4, 'type')]
+
+
+def test_invalid_utf8_only_rejects_its_line(tmp_path):
+    path = tmp_path / 'patients.txt'
+    good = visitLine(1, toDay('2024-01-01'), 37.0, 70, 16, 120, 80, 97)
+    path.write_bytes(good.encode() + b'\n2,2024-01-02,37.\xff,70,16,120,80,97\n' + good.encode() + b'\n')
+
+    patients = main.readPatientsFromFile(str(path))
+    loaded, report = bulkLoadPatients(str(path), workers=1)
+
+    assert contents(loaded) == contents(patients)
+    assert len(loaded[1]) == 2 and 2 not in loaded
+    assert rejectedLines(report) == [(2, 'type')]
@@ -0,0 +1,56 @@
+import pytest
+
+from cohort import CohortView, parseQuery
+import main
+from patientlog import visitLine
+from snapshot import loadSnapshot, writeSnapshot
+from visitstore import toDay
+
+
+QUERIES = [
+    "temp > 37.5",
+    "temp >= 37.2 and hr < 90",
+    "date 2024-01-01 2024-03-31 and spo2 < 95",
+    "patient 3 7 and (temp <= 36.8 or sbp > 140)",
+    "rr == 16 or dbp >= 90",
+]
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    lines = []
+    for number in range(400):
+        temp = 36.0 + number % 25 / 10
+        date = f"{2023 + number % 2}-{number % 12 + 1:02d}-{number % 28 + 1:02d}"
+        lines.append(visitLine(number % 11 + 1, toDay(date), temp, 60 + number % 50, 12 + number % 9,
+                               110 + number % 45, 70 + number % 30, 90 + number % 11))
+    path = tmp_path / 'patients.txt'
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def results(store, text):
+    return [(patientId, list(visit)) for patientId, visit in CohortView(store, parseQuery(text))]
+
+
+@pytest.mark.parametrize('text', QUERIES)
+def test_snapshot_store_matches_loaded_store(fileName, tmp_path, text):
+    patients = main.readPatientsFromFile(fileName)
+    writeSnapshot(patients, str(tmp_path / 'patients.snap'))
+    mapped = loadSnapshot(str(tmp_path / 'patients.snap'), verify=True)
+
+    expected = results(patients, text)
+    actual = results(mapped, text)
+    assert expected
+    # the snapshot groups the rows by patient, so visits on the same day may come in another order
+    assert sorted(actual) == sorted(expected)
+    if 'date' in text:
+        days = [toDay(visit[0]) for _, visit in actual]
+        assert days == sorted(days)
+
+
+def test_temperature_threshold_matches_stored_values(fileName):
+    patients = main.readPatientsFromFile(fileName)
+    # 37.2 is stored as a float32 slightly above 37.2, so it still equals the threshold
+    matches = results(patients, "temp == 37.2")
+    assert matches and all(visit[1] == 37.2 for _, visit in matches)
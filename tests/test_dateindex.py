@@ -0,0 +1,57 @@
+import pytest
+
+from dateindex import dateIndexOf
+import main
+from synthdata import generatePatientsFile
+from visitstore import toDay
+
+
+FILTERS = [(None, None), (2021, None), (None, 2), (2023, 11), (2019, None), (2021, 13)]
+
+
+def expected(patients, year, month):
+    visits = [(patientId, visit) for patientId, visits in patients.items() for visit in visits
+              if (year is None or int(visit[0][:4]) == year) and (month is None or int(visit[0][5:7]) == month)]
+    return sorted((patientId, list(visit)) for patientId, visit in visits)
+
+
+def check(patients):
+    index = dateIndexOf(patients)
+    for year, month in FILTERS:
+        view = index.find(year, month)
+        found = [(patientId, list(visit)) for patientId, visit in view]
+        assert sorted(found) == expected(patients, year, month)
+        days = [toDay(visit[0]) for _, visit in found]
+        assert days == sorted(days)
+        assert len(view) == len(found)
+        assert [(patientId, list(visit)) for patientId, visit in (view[i] for i in range(len(view)))] == found
+
+
+@pytest.fixture
+def patients(tmp_path):
+    fileName = str(tmp_path / 'patients.txt')
+    generatePatientsFile(fileName, patients=40, visitsPerPatient=8, startDate='2020-01-01', endDate='2023-12-31', seed=5)
+    return main.readPatientsFromFile(fileName)
+
+
+def test_find_matches_a_full_scan(patients):
+    check(patients)
+
+
+def test_index_follows_appends_and_deletes(patients):
+    dateIndexOf(patients)
+    # visits arriving out of date order, and patients deleted in between
+    for number, date in enumerate(['2023-11-05', '2020-02-29', '2021-06-15', '2023-11-01']):
+        patients.append(1000 + number, toDay(date), 37.0, 70, 16, 120, 80, 97)
+    patients.deletePatient(1)
+    patients.deletePatient(1001)
+    patients.deletePatients({2, 3})
+    check(patients)
+
+
+def test_index_survives_compaction(patients):
+    dateIndexOf(patients)
+    for patientId in range(1, 10):
+        patients.deletePatient(patientId, compact=False)
+    patients.compact()
+    check(patients)
@@ -0,0 +1,55 @@
+import pytest
+
+import main
+from patientlog import visitLine
+from sqlstore import SqliteStore, migrateFromText
+from visitstore import VisitStore, toDay
+
+
+def visit(patientId, date):
+    return visitLine(patientId, toDay(date), 37.0, 70, 16, 120, 80, 97)
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text('\n'.join([
+        visit(1, '2023-01-01'), visit(1, '2024-06-01'),
+        visit(2, '2023-03-01'), visit(2, '2022-12-01'),
+        visit(3, '2024-01-01'),
+        visit(4, '2023-12-31'),
+    ]) + '\n')
+    return str(path)
+
+
+def test_last_visit_before_reads_the_day_column(fileName, monkeypatch):
+    patients = main.readPatientsFromFile(fileName)
+
+    def noVisits(self, row):
+        raise AssertionError("a Visit was built")
+
+    monkeypatch.setattr(VisitStore, 'visit', noVisits)
+    result = main.deletePatients(patients, fileName, [1], main.lastVisitBefore('2024-01-01'))
+
+    assert result == main.BulkDelete(3, 5, 5)
+    assert sorted(patients.index) == [3]
+    with open(fileName) as file:
+        assert file.read() == visit(3, '2024-01-01') + '\n'
+
+
+def test_last_visit_before_on_a_dictionary(fileName):
+    patients = {patientId: [list(visit) for visit in visits]
+                for patientId, visits in main.readPatientsFromFile(fileName).items()}
+    main.deletePatients(patients, fileName, predicate=main.lastVisitBefore('2024-01-01'))
+    assert sorted(patients) == [1, 3]
+
+
+def test_last_visit_before_on_sqlite(fileName, tmp_path):
+    migrateFromText(fileName, str(tmp_path / 'patients.db'))
+    store = SqliteStore(str(tmp_path / 'patients.db'))
+    try:
+        result = main.deletePatients(store, fileName, predicate=main.lastVisitBefore('2024-01-01'))
+        assert (result.patients, result.visits) == (2, 3)
+        assert sorted(store) == [1, 3]
+    finally:
+        store.close()
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from filetail import PatientFileTail
+import main
+from patientlog import appendTombstone, compactPatientFile, visitLine
+from visitstore import toDay
+
+
+def visit(patientId, date, hr=70):
+    return visitLine(patientId, toDay(date), 37.0, hr, 16, 120, 80, 97)
+
+
+def contents(patients):
+    return {patientId: [list(visit) for visit in visits] for patientId, visits in patients.items()}
+
+
+def appendForeign(fileName, lines):
+    # another process appending, which doesn't record its writes in this process
+    with open(fileName, 'a') as file:
+        file.write(''.join(line + '\n' for line in lines))
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text(''.join(visit(number % 5 + 1, f"2024-01-{number % 28 + 1:02d}") + '\n' for number in range(30)))
+    return str(path)
+
+
+@pytest.fixture
+def tail(fileName):
+    tail = PatientFileTail(fileName, main.readPatientsFromFile(fileName))
+    yield tail
+    tail.close()
+
+
+def test_own_bulk_delete_does_not_reload(fileName, tail):
+    appendForeign(fileName, [visit(6, '2024-02-01')])
+    assert tail.poll().visits == 1
+
+    main.deletePatients(tail.patients, fileName, [2, 6])
+    result = tail.poll()
+    assert (result.visits, result.reloaded) == (0, False)
+
+    appendForeign(fileName, [visit(7, '2024-02-02')])
+    result = tail.poll()
+    assert (result.visits, result.reloaded) == (1, False)
+    assert contents(tail.patients) == contents(main.readPatientsFromFile(fileName))
+
+
+def test_own_compaction_does_not_reload(fileName, tail):
+    for patientId in (1, 3):
+        appendTombstone(fileName, patientId)
+        tail.patients.deletePatient(patientId)
+    compactPatientFile(fileName)
+    # a second rewrite before the next poll is followed as well
+    main.deletePatients(tail.patients, fileName, [4])
+
+    result = tail.poll()
+    assert (result.visits, result.reloaded) == (0, False)
+    appendForeign(fileName, [visit(1, '2024-03-01')])
+    result = tail.poll()
+    assert (result.visits, result.reloaded) == (1, False)
+    assert contents(tail.patients) == contents(main.readPatientsFromFile(fileName))
+
+
+def test_unread_records_before_an_own_rewrite_reload(fileName, tail):
+    # the rewrite drops a record the tail hasn't read yet, so only a reload gets it right
+    appendForeign(fileName, [visit(2, '2024-02-01'), visit(8, '2024-02-02')])
+    main.deletePatients(tail.patients, fileName, [2])
+
+    assert tail.poll().reloaded
+    assert contents(tail.patients) == contents(main.readPatientsFromFile(fileName))
+    assert sorted(tail.patients) == [1, 3, 4, 5, 8]
+
+
+def test_foreign_rewrite_reloads(fileName, tail):
+    with open(fileName) as file:
+        lines = file.read().splitlines()
+    with open(fileName + '.other', 'w') as file:
+        file.write(''.join(line + '\n' for line in lines if not line.startswith('5,')))
+    os.replace(fileName + '.other', fileName)
+
+    assert tail.poll().reloaded
+    assert 5 not in tail.patients
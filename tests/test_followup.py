@@ -0,0 +1,71 @@
+import pytest
+
+from followup import DEFAULT_RULES, FollowUpEngine, Rule
+import main
+from patientlog import visitLine
+from snapshot import loadSnapshot, writeSnapshot
+from visitstore import toDay
+
+
+FEVER = Rule('fever', 'temp', '>', 37.2)
+
+
+def visit(patientId, date, temp=36.8, hr=70):
+    return visitLine(patientId, toDay(date), temp, hr, 16, 120, 80, 97)
+
+
+@pytest.fixture
+def patients(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text('\n'.join([
+        # patient 1: an old fast heart rate, normal since
+        visit(1, '2024-01-01', hr=110),
+        visit(1, '2024-02-01'),
+        visit(1, '2024-03-01'),
+        # patient 2: normal, then a fever at exactly the threshold and one above it, out of date order
+        visit(2, '2024-03-01', temp=37.5),
+        visit(2, '2024-01-01'),
+        visit(2, '2024-02-01', temp=37.2),
+        # patient 3: a slow heart rate on the latest of two visits
+        visit(3, '2024-01-01'),
+        visit(3, '2024-02-01', hr=50),
+        # patient 4: always normal
+        visit(4, '2024-01-01'),
+    ]) + '\n')
+    return main.readPatientsFromFile(str(path))
+
+
+def flagged(store, **arguments):
+    return {followUp.patientId: followUp.findings for followUp in FollowUpEngine(**arguments).screen(store)}
+
+
+def test_any_policy_reports_the_first_firing_visit(patients):
+    result = flagged(patients, rules=DEFAULT_RULES + (FEVER,))
+    assert sorted(result) == [1, 2, 3]
+    assert result[1] == [('2024-01-01', ['high heart rate'])]
+
+
+def test_latest_policy_only_looks_at_the_latest_visit(patients):
+    result = flagged(patients, rules=DEFAULT_RULES + (FEVER,), policy='latest')
+    assert result == {2: [('2024-03-01', ['fever'])], 3: [('2024-02-01', ['low heart rate'])]}
+
+
+def test_last_policy_needs_n_of_the_last_m_visits(patients):
+    # 37.2 is stored as a float32, but must not count as above a threshold of 37.2
+    assert flagged(patients, rules=(FEVER,), policy='last', n=2, m=2) == {}
+    result = flagged(patients, rules=(FEVER,), policy='last', n=1, m=2)
+    assert result == {2: [('2024-03-01', ['fever'])]}
+
+
+def test_snapshot_store_flags_the_same_patients(patients, tmp_path):
+    writeSnapshot(patients, str(tmp_path / 'patients.snap'))
+    mapped = loadSnapshot(str(tmp_path / 'patients.snap'))
+    for policy in ('any', 'latest', 'last'):
+        rules = DEFAULT_RULES + (FEVER,)
+        assert flagged(mapped, rules=rules, policy=policy, n=1, m=2) == \
+            flagged(patients, rules=rules, policy=policy, n=1, m=2)
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        FollowUpEngine(policy='sometimes')
@@ -0,0 +1,74 @@
+import pytest
+
+from lazystore import LazyStore, indexFileName
+import main
+from patientlog import appendLines, compactPatientFile, visitLine
+from synthdata import generatePatientsFile
+from vitalstats import statsEngineOf
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    fileName = str(tmp_path / 'patients.txt')
+    generatePatientsFile(fileName, patients=30, visitsPerPatient=5, seed=11)
+    return fileName
+
+
+@pytest.fixture
+def lazy(fileName):
+    # a cap this small keeps only the patient used last, so every lookup evicts another
+    store = LazyStore(fileName, cacheBytes=1, workers=2)
+    yield store
+    store.close()
+
+
+def contents(store):
+    return sorted((patientId, [list(visit) for visit in store[patientId]]) for patientId in store)
+
+
+def test_patients_match_the_loaded_file(lazy, fileName):
+    patients = main.readPatientsFromFile(fileName)
+    assert len(lazy) == len(patients)
+    assert contents(lazy) == contents(patients)
+    # the visits of a patient are parsed again after it was evicted
+    assert contents(lazy) == contents(patients)
+    assert len(lazy.cache) == 1
+
+
+def test_appends_are_indexed_and_the_index_is_read_back(lazy, fileName):
+    lazy.append(1, 738000, 37.0, 70, 16, 120, 80, 97)
+    lazy.append(1000, 738001, 37.0, 70, 16, 120, 80, 97)
+    lazy.close()
+
+    reopened = LazyStore(fileName, cacheBytes=1)
+    try:
+        assert contents(reopened) == contents(main.readPatientsFromFile(fileName))
+        assert 1000 in reopened
+    finally:
+        reopened.close()
+
+
+def test_foreign_appends_and_deletions_are_picked_up(lazy, fileName):
+    lazy.segmentOf(2)
+    appendLines(fileName, [visitLine(2, 738000, 38.5, 110, 16, 120, 80, 97)])
+    lazy.deletePatient(3)
+    assert contents(lazy) == contents(main.readPatientsFromFile(fileName))
+    assert 3 not in lazy and lazy[2][-1][1] == 38.5
+
+
+def test_the_index_is_built_again_after_a_compaction(lazy, fileName):
+    lazy.loaded()
+    lazy.deletePatient(4)
+    compactPatientFile(fileName)
+    lazy.refresh()
+    assert contents(lazy) == contents(main.readPatientsFromFile(fileName))
+    assert len(lazy.findVisits()) == main.readPatientsFromFile(fileName).rowCount
+
+
+def test_queries_match_the_loaded_store(lazy, fileName):
+    patients = main.readPatientsFromFile(fileName)
+    assert lazy.summary(0).count == statsEngineOf(patients).summary(0).count
+    assert lazy.summary(5).total == statsEngineOf(patients).summary(5).total
+    assert sorted(followUp.patientId for followUp in lazy.followUps()) == \
+        sorted(main.findPatientsWhoNeedFollowUp(patients))
+    assert indexFileName(fileName) != fileName
@@ -0,0 +1,192 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from bulkload import bulkLoadPatients
+from filetail import PatientFileTail
+import main
+import patientlog
+from patientlog import appendLines, appendTombstone, compactPatientFile, rewriteFile, rewriteWithout, visitLine
+from visitstore import toDay
+
+
+def visit(patientId, date, hr=70):
+    return visitLine(patientId, toDay(date), 37.0, hr, 16, 120, 80, 97)
+
+
+def writeFile(path, lines, ending='\n'):
+    path.write_text('\n'.join(lines) + ending)
+    return str(path)
+
+
+def contents(patients):
+    return {patientId: [list(visit) for visit in visits] for patientId, visits in patients.items()}
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    return writeFile(tmp_path / 'patients.txt', [
+        visit(1, '2024-01-01'),
+        visit(2, '2024-01-02'),
+        visit(1, '2024-01-03'),
+        visit(3, '2024-01-04'),
+    ])
+
+
+def test_tombstone_deletes_earlier_visits_only(fileName):
+    appendTombstone(fileName, 1)
+    appendLines(fileName, [visit(1, '2024-02-01', hr=80)])
+
+    patients = main.readPatientsFromFile(fileName)
+    assert sorted(patients) == [1, 2, 3]
+    assert contents(patients)[1] == [['2024-02-01', 37.0, 80, 16, 120, 80, 97]]
+
+    loaded, report = bulkLoadPatients(fileName, workers=1)
+    assert contents(loaded) == contents(patients)
+    assert len(report) == 0
+
+
+def test_tombstone_of_every_visit_removes_the_patient(fileName):
+    appendTombstone(fileName, 2)
+    patients = main.readPatientsFromFile(fileName)
+    assert 2 not in patients
+    assert sorted(patients) == [1, 3]
+
+
+def test_compaction_keeps_only_live_records(fileName):
+    appendTombstone(fileName, 1)
+    appendLines(fileName, [visit(1, '2024-02-01')])
+    before = contents(main.readPatientsFromFile(fileName))
+
+    kept, dropped = compactPatientFile(fileName)
+
+    assert (kept, dropped) == (3, 3)
+    with open(fileName) as file:
+        assert not any(line.startswith(patientlog.TOMBSTONE) for line in file)
+    assert contents(main.readPatientsFromFile(fileName)) == before
+
+
+def test_compaction_copies_records_appended_meanwhile(fileName, monkeypatch):
+    appendTombstone(fileName, 1)
+    appended = [visit(1, '2024-03-01', hr=90), patientlog.tombstoneLine(3), visit(4, '2024-03-02')]
+
+    def appendThenRewrite(*args):
+        # another process appends between the two passes of the compaction
+        with open(fileName, 'a') as file:
+            file.write(''.join(line + '\n' for line in appended))
+        return rewriteFile(*args)
+
+    monkeypatch.setattr(patientlog, 'rewriteFile', appendThenRewrite)
+    kept, dropped = compactPatientFile(fileName)
+
+    assert (kept, dropped) == (2, 3)
+    with open(fileName) as file:
+        assert file.read().splitlines() == [visit(2, '2024-01-02'), visit(3, '2024-01-04')] + appended
+    patients = main.readPatientsFromFile(fileName)
+    assert sorted(patients) == [1, 2, 4]
+    assert contents(patients)[1] == [['2024-03-01', 37.0, 90, 16, 120, 80, 97]]
+
+
+def test_rewrite_without_removes_every_record_of_the_patients(fileName):
+    appendTombstone(fileName, 2)
+    kept, dropped = rewriteWithout(fileName, {1, 2})
+    assert (kept, dropped) == (1, 4)
+    with open(fileName) as file:
+        assert file.read() == visit(3, '2024-01-04') + '\n'
+    assert not os.path.exists(fileName + '.rewrite')
+
+
+def test_bulk_load_matches_sequential_read(tmp_path):
+    lines = []
+    for number in range(600):
+        patientId = number % 37 + 1
+        lines.append(visit(patientId, f"2023-{number % 12 + 1:02d}-{number % 28 + 1:02d}", hr=50 + number % 60))
+        if number % 97 == 0:
+            lines.append(patientlog.tombstoneLine(patientId))
+        if number % 151 == 0:
+            lines.append(f"{patientId},2023-13-01,37.0,70,16,120,80,97")
+    fileName = writeFile(tmp_path / 'patients.txt', lines, ending='')
+
+    patients = main.readPatientsFromFile(fileName)
+    # small chunks so tombstones and their visits end up in different workers
+    loaded, report = bulkLoadPatients(fileName, workers=4, chunkSize=512)
+
+    assert contents(loaded) == contents(patients)
+    assert len(report) == 4
+
+
+def test_tail_skips_its_own_appends(fileName):
+    patients = main.readPatientsFromFile(fileName)
+    tail = PatientFileTail(fileName, patients)
+    try:
+        appendLines(fileName, [visit(5, '2024-02-01')])
+        patients.append(5, toDay('2024-02-01'), 37.0, 70, 16, 120, 80, 97)
+        result = tail.poll()
+        assert (result.visits, result.tombstones, len(result.rejects)) == (0, 0, 0)
+
+        # a record appended by another process is picked up
+        with open(fileName, 'a') as file:
+            file.write(visit(6, '2024-02-02') + '\n')
+        result = tail.poll()
+        assert (result.visits, result.reloaded) == (1, False)
+        assert sorted(patients) == [1, 2, 3, 5, 6]
+    finally:
+        tail.close()
+
+
+def test_tail_skips_the_line_ending_it_completes(tmp_path):
+    fileName = writeFile(tmp_path / 'patients.txt', [visit(1, '2024-01-01')], ending='')
+    patients = main.readPatientsFromFile(fileName)
+    tail = PatientFileTail(fileName, patients)
+    try:
+        appendLines(fileName, [visit(1, '2024-01-02')])
+        patients.append(1, toDay('2024-01-02'), 37.0, 70, 16, 120, 80, 97)
+        result = tail.poll()
+        assert (result.visits, len(result.rejects), result.reloaded) == (0, 0, False)
+        assert len(patients[1]) == 2
+    finally:
+        tail.close()
+
+
+def test_appender_in_another_process_waits_for_compaction(fileName, monkeypatch):
+    appendTombstone(fileName, 1)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = ("import sys; sys.path.insert(0, sys.argv[1]); from patientlog import appendLines; "
+              "appendLines(sys.argv[2], [sys.argv[3]])")
+    late = visit(5, '2024-04-01')
+    appender = []
+
+    def rewriteWhileAppending(*args):
+        appender.append(subprocess.Popen([sys.executable, '-c', script, root, fileName, late]))
+        # the appender blocks on the lock until the compaction replaced the file
+        time.sleep(0.5)
+        assert appender[0].poll() is None
+        return rewriteFile(*args)
+
+    monkeypatch.setattr(patientlog, 'rewriteFile', rewriteWhileAppending)
+    compactPatientFile(fileName)
+    assert appender[0].wait(timeout=10) == 0
+
+    with open(fileName) as file:
+        assert file.read().splitlines() == [visit(2, '2024-01-02'), visit(3, '2024-01-04'), late]
+
+
+def test_rewrite_copies_records_appended_just_before_the_replace(fileName, monkeypatch):
+    late = visit(6, '2024-04-02')
+    replace = os.replace
+
+    def appendThenReplace(source, target):
+        # a writer that doesn't take the lock appends to the old file at the last moment
+        if target == fileName:
+            with open(fileName, 'a') as file:
+                file.write(late + '\n')
+        replace(source, target)
+
+    monkeypatch.setattr(os, 'replace', appendThenReplace)
+    rewriteWithout(fileName, {2})
+
+    with open(fileName) as file:
+        assert file.read().splitlines() == [visit(1, '2024-01-01'), visit(1, '2024-01-03'), visit(3, '2024-01-04'), late]
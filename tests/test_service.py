@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from patientlog import visitLine
+from service import QueryService
+from visitstore import toDay
+
+
+@pytest.fixture
+def service(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text(''.join(visitLine(number % 4 + 1, toDay(f"2024-01-{number + 1:02d}"), 37.0, 70 + number, 16,
+                                      120, 80, 97) + '\n' for number in range(12)))
+    return QueryService(main.readPatientsFromFile(str(path)), str(path))
+
+
+def handle(service, request):
+    return asyncio.run(service.handle(request))
+
+
+@pytest.mark.parametrize('request_', [
+    {'op': ['display']},
+    {'op': {'name': 'display'}},
+    {'op': None},
+    {'op': 'nothing'},
+    ['display'],
+    'display',
+    42,
+])
+def test_malformed_requests_get_an_error_response(service, request_):
+    response = handle(service, request_)
+    assert response['ok'] is False and response['error']
+
+
+def test_handler_errors_get_an_error_response(service):
+    assert handle(service, {'op': 'trends', 'vital': 'bogus'}) == {'ok': False, 'error': "Unknown vital sign: bogus"}
+    assert handle(service, {'op': 'display', 'unknown': 1})['ok'] is False
+    assert handle(service, {'op': 'stats', 'patientId': 1})['ok'] is True
+
+
+def test_connection_survives_malformed_requests(service, tmp_path):
+    socketPath = str(tmp_path / 'service.sock')
+
+    async def exchange():
+        server = await asyncio.start_unix_server(service.serveClient, path=socketPath)
+        async with server:
+            reader, writer = await asyncio.open_unix_connection(socketPath)
+            responses = []
+            for line in (b'{"op": ["display"]}', b'[1, 2]', b'not json', b'{"op": "visits", "year": 2024}'):
+                writer.write(line + b'\n')
+                await writer.drain()
+                responses.append(json.loads(await reader.readline()))
+            writer.close()
+            await writer.wait_closed()
+        return responses
+
+    responses = asyncio.run(exchange())
+    assert [response['ok'] for response in responses] == [False, False, False, True]
+    assert len(responses[-1]['result']) == 12
@@ -0,0 +1,46 @@
+import pytest
+
+from cohort import parseQuery
+from dateindex import DateIndex, dateIndexOf
+import main
+from shards import ShardedStore
+from synthdata import generatePatientsFile
+from vitalstats import StatsEngine, VitalDistributions, distributionsOf
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    fileName = str(tmp_path / 'patients.txt')
+    generatePatientsFile(fileName, patients=60, visitsPerPatient=6, seed=3)
+    return fileName
+
+
+@pytest.fixture
+def sharded(fileName):
+    store = ShardedStore(fileName, shards=3, workers=2)
+    yield store
+    store.close()
+
+
+def test_derived_indexes_are_built_before_forking(sharded):
+    for segment in sharded.segments:
+        for kind in (StatsEngine, DateIndex, VitalDistributions):
+            assert segment.findListener(kind) is not None
+
+
+def test_workers_see_visits_added_after_the_first_fork(sharded):
+    before = len(sharded.findVisits(1990))
+    # the indexes are updated in this process and the next pool forks them with the new visit
+    sharded.append(9999, 726468, 37.0, 70, 16, 120, 80, 97)
+    assert len(sharded.findVisits(1990)) == before + 1
+    assert sharded.histogram('hr').count == sharded.rowCount
+
+
+def test_queries_match_the_unsharded_store(sharded, fileName):
+    patients = main.readPatientsFromFile(fileName)
+    assert sorted((id, list(visit)) for id, visit in sharded.findVisits(2022)) == \
+        sorted((id, list(visit)) for id, visit in dateIndexOf(patients).find(2022, None))
+    query = parseQuery("hr > 90 or spo2 < 92")
+    assert sorted((id, list(visit)) for id, visit in sharded.query(query)) == \
+        sorted((id, list(visit)) for id, visit in main.queryVisits(patients, query))
+    assert sharded.histogram('sbp').bins == distributionsOf(patients).histogram('sbp').bins
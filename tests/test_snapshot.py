@@ -0,0 +1,74 @@
+import pytest
+
+from dateindex import dateIndexOf
+import main
+from patientlog import appendTombstone, visitLine
+from snapshot import loadSnapshot, writeSnapshot
+from visitstore import toDay
+
+
+def contents(patients):
+    return {patientId: [list(visit) for visit in visits] for patientId, visits in patients.items()}
+
+
+@pytest.fixture
+def patients(tmp_path):
+    path = tmp_path / 'patients.txt'
+    lines = [visitLine(number % 9 + 1, toDay(f"2024-{number % 12 + 1:02d}-{number % 28 + 1:02d}"),
+                       36.0 + number % 20 / 10, 60 + number % 40, 16, 120, 80, 97) for number in range(200)]
+    path.write_text('\n'.join(lines) + '\n')
+    appendTombstone(str(path), 4)
+    return main.readPatientsFromFile(str(path))
+
+
+@pytest.fixture
+def snapshotName(patients, tmp_path):
+    name = str(tmp_path / 'patients.snap')
+    writeSnapshot(patients, name)
+    return name
+
+
+def test_round_trip_keeps_every_visit(patients, snapshotName):
+    mapped = loadSnapshot(snapshotName, verify=True)
+    assert mapped.rowCount == patients.rowCount
+    assert 4 not in mapped
+    assert contents(mapped) == contents(patients)
+
+
+def test_round_trip_keeps_the_date_index(patients, snapshotName):
+    mapped = loadSnapshot(snapshotName)
+    for year, month in [(2024, None), (None, 3), (2024, 7), (2023, None)]:
+        expected = sorted((patientId, list(visit)) for patientId, visit in dateIndexOf(patients).find(year, month))
+        actual = sorted((patientId, list(visit)) for patientId, visit in dateIndexOf(mapped).find(year, month))
+        assert actual == expected
+
+
+def test_adding_to_a_mapped_store_copies_the_columns(snapshotName):
+    mapped = loadSnapshot(snapshotName)
+    mapped.append(50, toDay('2025-01-01'), 37.0, 70, 16, 120, 80, 97)
+    assert [list(visit) for visit in mapped[50]] == [['2025-01-01', 37.0, 70, 16, 120, 80, 97]]
+
+
+def test_empty_file_is_rejected(tmp_path):
+    name = tmp_path / 'patients.snap'
+    name.write_bytes(b'')
+    with pytest.raises(ValueError):
+        loadSnapshot(str(name))
+
+
+def test_truncated_file_is_rejected(snapshotName):
+    with open(snapshotName, 'r+b') as file:
+        file.truncate(file.seek(0, 2) - 8)
+    with pytest.raises(ValueError):
+        loadSnapshot(snapshotName)
+
+
+def test_damaged_file_fails_verification(snapshotName):
+    with open(snapshotName, 'r+b') as file:
+        file.seek(-3, 2)
+        value = file.read(1)
+        file.seek(-3, 2)
+        file.write(bytes([value[0] ^ 0xFF]))
+    loadSnapshot(snapshotName)
+    with pytest.raises(ValueError):
+        loadSnapshot(snapshotName, verify=True)
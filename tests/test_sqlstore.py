@@ -0,0 +1,78 @@
+import pytest
+
+from cohort import parseQuery
+from dateindex import dateIndexOf
+import main
+from sqlstore import SqliteStore, migrateFromText
+from synthdata import generatePatientsFile
+from visitstore import VITALS
+from vitalstats import distributionsOf, statsEngineOf
+
+
+@pytest.fixture
+def fileName(tmp_path):
+    fileName = str(tmp_path / 'patients.txt')
+    generatePatientsFile(fileName, patients=40, visitsPerPatient=6, seed=7)
+    return fileName
+
+
+@pytest.fixture
+def store(fileName, tmp_path):
+    databaseName = str(tmp_path / 'patients.db')
+    migrateFromText(fileName, databaseName)
+    store = SqliteStore(databaseName)
+    yield store
+    store.close()
+
+
+def visits(pairs):
+    return sorted((patientId, list(visit)) for patientId, visit in pairs)
+
+
+def test_visits_match_the_loaded_store(store, fileName):
+    patients = main.readPatientsFromFile(fileName)
+    assert len(store) == len(patients) and store.rowCount == patients.rowCount
+    assert sorted(store) == sorted(patients)
+    for patientId in patients:
+        assert [list(visit) for visit in store[patientId]] == [list(visit) for visit in patients[patientId]]
+
+
+def test_migrating_again_does_not_duplicate_visits(store, fileName, tmp_path):
+    rows = store.rowCount
+    store.close()
+    migrateFromText(fileName, str(tmp_path / 'patients.db'))
+    reopened = SqliteStore(str(tmp_path / 'patients.db'))
+    try:
+        assert reopened.rowCount == rows
+    finally:
+        reopened.close()
+
+
+@pytest.mark.parametrize('patientId', [0, 1, 17])
+def test_summaries_match_the_stats_engine(store, fileName, patientId):
+    expected = statsEngineOf(main.readPatientsFromFile(fileName)).summary(patientId)
+    summary = store.summary(patientId)
+    assert summary.count == expected.count
+    assert summary.total == pytest.approx(expected.total)
+    assert summary.squares == pytest.approx(expected.squares)
+    # the loaded store keeps temperatures as float32, the database as double
+    assert summary.low == pytest.approx(expected.low) and summary.high == pytest.approx(expected.high)
+
+
+def test_date_queries_match_the_date_index(store, fileName):
+    index = dateIndexOf(main.readPatientsFromFile(fileName))
+    for year, month in [(2021, None), (None, 6), (2022, 2), (None, None), (1800, None)]:
+        found = store.findVisits(year, month)
+        assert visits(found) == visits(index.find(year, month))
+        assert [visit[0] for _, visit in found] == sorted(visit[0] for _, visit in found)
+
+
+def test_cohort_queries_follow_ups_and_histograms_match(store, fileName):
+    patients = main.readPatientsFromFile(fileName)
+    for text in ["hr > 90 or spo2 < 92", "date 2021-01-01 2021-12-31 and temp >= 38", "patient 5 20 and rr < 20"]:
+        query = parseQuery(text)
+        assert visits(store.query(query)) == visits(main.queryVisits(patients, query))
+    assert sorted(followUp.patientId for followUp in store.followUps()) == \
+        sorted(main.findPatientsWhoNeedFollowUp(patients))
+    for vital in VITALS:
+        assert store.histogram(vital, 2022).bins == distributionsOf(patients).histogram(vital, 2022).bins
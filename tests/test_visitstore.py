@@ -0,0 +1,45 @@
+import pickle
+
+import pytest
+
+import main
+from visitstore import VisitList, VisitStore, toDay
+
+
+@pytest.fixture
+def patients():
+    store = VisitStore()
+    store.append(1, toDay('2024-01-01'), 37.0, 70, 16, 120, 80, 97)
+    store.append(1, toDay('2024-01-02'), 37.5, 72, 17, 122, 81, 96)
+    return store
+
+
+@pytest.mark.parametrize('change', [
+    lambda visits: visits.append(['2024-01-03', 37.0, 70, 16, 120, 80, 97]),
+    lambda visits: visits.extend([]),
+    lambda visits: visits.pop(),
+    lambda visits: visits.clear(),
+    lambda visits: visits.sort(),
+    lambda visits: visits.__setitem__(0, None),
+    lambda visits: visits.__delitem__(0),
+    lambda visits: visits.__iadd__([]),
+])
+def test_changing_the_visits_of_a_store_raises(patients, change):
+    with pytest.raises(TypeError):
+        change(patients[1])
+    assert patients.visitCount(1) == 2
+
+
+def test_visits_still_behave_like_a_list(patients):
+    visits = patients[1]
+    assert isinstance(visits, list) and isinstance(visits, VisitList)
+    assert visits == [['2024-01-01', 37.0, 70, 16, 120, 80, 97], ['2024-01-02', 37.5, 72, 17, 122, 81, 96]]
+    assert sorted(visits, key=lambda visit: visit[1], reverse=True)[0][1] == 37.5
+    assert pickle.loads(pickle.dumps(visits)) == visits
+
+
+def test_add_patient_data_still_appends_to_dictionaries(tmp_path):
+    patients = {1: []}
+    main.addPatientData(patients, 1, '2024-01-03', 37.0, 70, 16, 120, 80, 97, str(tmp_path / 'patients.txt'))
+    main.addPatientData(patients, 2, '2024-01-04', 37.0, 70, 16, 120, 80, 97, str(tmp_path / 'patients.txt'))
+    assert len(patients[1]) == 1 and len(patients[2]) == 1
@@ -0,0 +1,208 @@
+from array import array
+from collections import namedtuple
+from itertools import islice
+import operator
+
+from visitstore import VITALS, fromDay, toTemp
+
+
+# the trend of one vital sign of a patient over a window of their latest visits: the number of
+# visits in the window and their mean, the least squares slope per day, the change the slope adds
+# up to over the window, and the latest value minus the patient's baseline
+Trend = namedtuple('Trend', ['patientId', 'vital', 'count', 'mean', 'slope', 'change', 'delta'])
+
+
+def leastSquares(xs, ys):
+    """
+    Returns the slope of the least squares line through a set of points, or 0.0 if every x is the same.
+
+    xs, ys: The coordinates of the points.
+    """
+    n = len(xs)
+    sx, sy = sum(xs), sum(ys)
+    denominator = n * sum(map(operator.mul, xs, xs)) - sx * sx
+    if denominator == 0:
+        return 0.0
+    return (n * sum(map(operator.mul, xs, ys)) - sx * sy) / denominator
+
+
+class TrendEngine:
+    """
+    Date-sorted timelines of the visits of every patient of a VisitStore, for trend queries.
+
+    timelines maps every patient ID to an array of their row numbers in date order. The engine is
+    registered as a listener of the store, so a new visit is inserted into the timeline of its
+    patient and only that patient's cached trends are dropped. A trend only reads the rows of its
+    window, so the trends of a whole ward are O(patients) rather than O(visits).
+    """
+
+    def __init__(self, store, baseline=1):
+        """
+        store: The VisitStore to follow.
+        baseline: The number of earliest visits of a patient whose mean is their baseline.
+        """
+        self.store = store
+        self.baseline = baseline
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Builds the timeline of every patient from the store columns.
+        """
+        store = self.store
+        day = store.day
+        self.timelines = {}
+        # the trends of a patient, keyed by (vital, visits, days)
+        self.cache = {}
+        for patientId, ranges in store.index.items():
+            if len(ranges) == 1:
+                start, stop = ranges[0]
+                rows = array('q', range(start, stop))
+                days = day[start:stop]
+            else:
+                rows = array('q', store.rows(patientId))
+                days = [day[row] for row in rows]
+            # the visits of a patient are usually already in date order
+            if not all(map(operator.le, days, islice(days, 1, None))):
+                rows = array('q', sorted(rows, key=day.__getitem__))
+            self.timelines[patientId] = rows
+
+    def visitsAdded(self, store, start, stop):
+        pid, day = store.pid, store.day
+        for row in range(start, stop):
+            patientId = pid[row]
+            timeline = self.timelines.get(patientId)
+            if timeline is None:
+                self.timelines[patientId] = array('q', [row])
+            else:
+                # new visits are usually the latest ones, which only need an append
+                position = len(timeline)
+                while position and day[timeline[position - 1]] > day[row]:
+                    position -= 1
+                timeline.insert(position, row)
+            self.cache.pop(patientId, None)
+
+    def patientDeleted(self, store, patientId, ranges):
+        self.timelines.pop(patientId, None)
+        self.cache.pop(patientId, None)
+
+    def storeCompacted(self, store):
+        # the timelines hold row numbers, which compact changes
+        self.rebuild()
+
+    def values(self, vital, rows):
+        """
+        Returns the values of a vital sign for a list of rows.
+
+        vital: The name of the vital sign, one of VITALS.
+        rows: The row numbers.
+        """
+        column = getattr(self.store, vital)
+        if vital == 'temp':
+            return [toTemp(column[row]) for row in rows]
+        return [column[row] for row in rows]
+
+    def window(self, patientId, visits=3, days=None):
+        """
+        Returns the row numbers of the latest visits of a patient in date order.
+
+        patientId: The ID of the patient.
+        visits: The maximum number of visits, or None for no limit.
+        days: Only visits within this many days of the latest visit, or None for no limit.
+        """
+        timeline = self.timelines.get(patientId)
+        if not timeline:
+            return []
+        rows = timeline if visits is None else timeline[-visits:]
+        if days is not None:
+            day = self.store.day
+            first = day[timeline[-1]] - days
+            position = len(rows)
+            while position and day[rows[position - 1]] > first:
+                position -= 1
+            rows = rows[position:]
+        return list(rows)
+
+    def trend(self, patientId, vital, visits=3, days=None):
+        """
+        Returns the Trend of one vital sign of a patient.
+
+        patientId: The ID of the patient.
+        vital: The name of the vital sign, one of VITALS.
+        visits: The number of latest visits in the window, or None for every visit.
+        days: Only visits within this many days of the latest visit, or None for no limit.
+        return: The Trend, or None if the patient has no visits.
+        """
+        key = (vital, visits, days)
+        cached = self.cache.get(patientId)
+        if cached is not None and key in cached:
+            return cached[key]
+        rows = self.window(patientId, visits, days)
+        if not rows:
+            return None
+        day = self.store.day
+        ys = self.values(vital, rows)
+        xs = [day[row] - day[rows[0]] for row in rows]
+        slope = leastSquares(xs, ys)
+        earliest = self.values(vital, self.timelines[patientId][:self.baseline])
+        result = Trend(patientId, vital, len(rows), sum(ys) / len(ys), slope, slope * xs[-1],
+                       ys[-1] - sum(earliest) / len(earliest))
+        self.cache.setdefault(patientId, {})[key] = result
+        return result
+
+    def trends(self, patientId, visits=3, days=None):
+        """
+        Returns the Trend of every vital sign of a patient, in the order of VITALS, or an empty
+        list if the patient has no visits.
+        """
+        if patientId not in self.timelines:
+            return []
+        return [self.trend(patientId, vital, visits, days) for vital in VITALS]
+
+    def rollingMeans(self, patientId, vital, size=3):
+        """
+        Generates the rolling mean of a vital sign over every window of consecutive visits of a patient.
+
+        patientId: The ID of the patient.
+        vital: The name of the vital sign, one of VITALS.
+        size: The number of visits per window.
+        return: (date, mean) tuples, one for every visit from the size-th visit on.
+        """
+        timeline = self.timelines.get(patientId, ())
+        values = self.values(vital, timeline)
+        day = self.store.day
+        total = sum(values[:size - 1])
+        for position in range(size - 1, len(values)):
+            total += values[position]
+            yield fromDay(day[timeline[position]]), total / size
+            total -= values[position - size + 1]
+
+    def ward(self, vital, visits=3, days=None, patientIds=None, minChange=None):
+        """
+        Generates the trends of one vital sign for many patients.
+
+        vital: The name of the vital sign, one of VITALS.
+        visits, days: The window of every trend, see trend.
+        patientIds: The IDs of the patients, or None for every patient.
+        minChange: Only trends whose change over the window is at least this large in either
+        direction, or None for every trend.
+        """
+        for patientId in self.timelines if patientIds is None else patientIds:
+            result = self.trend(patientId, vital, visits, days)
+            if result is None:
+                continue
+            if minChange is None or abs(result.change) >= minChange:
+                yield result
+
+
+def trendsOf(store):
+    """
+    Returns the trend engine of a VisitStore, building and registering it on first use.
+
+    store: The VisitStore to follow.
+    """
+    engine = store.findListener(TrendEngine)
+    if engine is None:
+        engine = TrendEngine(store)
+        store.addListener(engine)
+    return engine
@@ -0,0 +1,599 @@
+from array import array
+from functools import lru_cache
+import datetime
+import re
+
+
+# names of the vital sign columns, in the same order as a visit list
+VITALS = ('temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2')
+
+# names and array type codes of all columns of a VisitStore
+COLUMNS = ('pid', 'day') + VITALS
+TYPECODES = 'qifBBBBB'
+
+# the only date shape toDay accepts; fromisoformat also takes '20240105' and '2024-W01-1' since Python 3.11
+DATE = re.compile(r'\d{4}-\d{2}-\d{2}', re.ASCII)
+
+
+@lru_cache(maxsize=65536)
+def toDay(date):
+    """
+    Converts a 'yyyy-mm-dd' date string to an integer day ordinal.
+
+    Visits cluster on a limited number of days, so every distinct date string is parsed only once;
+    invalid dates raise every time and are not cached.
+    date: The date string to convert.
+    return: The proleptic Gregorian ordinal of the date. Raises ValueError for invalid dates.
+    """
+    if not DATE.fullmatch(date):
+        raise ValueError(f"Invalid isoformat string: {date!r}")
+    return datetime.date.fromisoformat(date).toordinal()
+
+
+@lru_cache(maxsize=65536)
+def fromDay(day):
+    """
+    Converts an integer day ordinal back to a 'yyyy-mm-dd' date string.
+
+    day: The day ordinal to convert.
+    return: The date string used for display and for writing the patients file.
+    """
+    return datetime.date.fromordinal(day).isoformat()
+
+
+@lru_cache(maxsize=4096)
+def toTemp(value):
+    """
+    Converts a stored single precision temperature back to the value that was read.
+
+    value: The temperature as stored in the temperature column.
+    return: The temperature as a float without float32 rounding noise (37.2 rather than 37.200000762939453).
+    """
+    return float('%.7g' % value)
+
+
+def float32(value):
+    """
+    Rounds a value like the temperature column rounds the values it stores, e.g. for comparing
+    a threshold with the stored temperatures.
+    """
+    return array('f', [value])[0]
+
+
+def typecodeOf(column):
+    """
+    Returns the type code of a column, which is an array or, in a store loaded from a snapshot,
+    a memoryview with a format instead of a typecode.
+    """
+    return getattr(column, 'typecode', None) or column.format
+
+
+# one object per patient ID, shared by every Visit of the patient
+patientIds = {}
+
+
+def internId(patientId):
+    """
+    Returns the shared int object for a patient ID, so the visits of a patient don't each hold a copy.
+    """
+    return patientIds.setdefault(patientId, patientId)
+
+
+class Visit:
+    """
+    A single visit of a patient, with typed fields instead of a list indexed by position.
+
+    The date is the 'yyyy-mm-dd' string, temp is a float and the other vital signs are ints.
+    Strings, temperatures and patient IDs are shared between visits, so a Visit only costs its
+    slots. For code written against visit lists, a Visit also behaves like the sequence
+    [date, temp, hr, rr, sbp, dbp, spo2]: it can be indexed, unpacked and compared to a list.
+    """
+
+    __slots__ = ('patientId', 'date', 'temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2')
+
+    FIELDS = ('date', 'temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2')
+
+    def __init__(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        self.patientId = patientId
+        self.date = date
+        self.temp = temp
+        self.hr = hr
+        self.rr = rr
+        self.sbp = sbp
+        self.dbp = dbp
+        self.spo2 = spo2
+
+    @property
+    def day(self):
+        return toDay(self.date)
+
+    def __iter__(self):
+        yield self.date
+        yield self.temp
+        yield self.hr
+        yield self.rr
+        yield self.sbp
+        yield self.dbp
+        yield self.spo2
+
+    def __len__(self):
+        return 7
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return list(self)[position]
+        return getattr(self, self.FIELDS[position])
+
+    def __eq__(self, other):
+        if isinstance(other, (Visit, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Visit({self.patientId}, {list(self)!r})"
+
+
+class InvalidVisit(ValueError):
+    """
+    Raised by parseVisit for a line that does not hold a valid visit.
+
+    reason: A short name for the failed check, e.g. 'fields', 'patient_id', 'temp' or 'date'.
+    message: The message readPatientsFromFile prints for the line.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+
+
+# valid range of every vital sign, in the order readPatientsFromFile checks them
+LIMITS = (
+    ('temp', 35, 42, 'temperature'),
+    ('hr', 30, 180, 'heart rate'),
+    ('rr', 5, 40, 'respiratory rate'),
+    ('sbp', 70, 200, 'systolic blood pressure'),
+    ('dbp', 40, 120, 'diastolic blood pressure'),
+    ('spo2', 70, 100, 'oxygen saturation'),
+)
+
+
+def parseVisit(line):
+    """
+    Parses and validates a single line of the patients file.
+
+    line: The line to parse, in the format 'patientId,date,temp,hr,rr,sbp,dbp,spo2'.
+    return: A (patientId, day, temp, hr, rr, sbp, dbp, spo2) tuple. Raises InvalidVisit for invalid lines.
+    """
+    # spliting data
+    field = line.strip().split(",")
+
+    # Checking number of field
+    if len(field) != 8:
+        raise InvalidVisit('fields', f"Invalid number of fields {len(field)} in line: {line}")
+
+    # Check the format of the patient ID
+    try:
+        patient_id = int(field[0])
+    except ValueError:
+        raise InvalidVisit('patient_id', f"Invalid patient ID in line: {line}")
+    # the patient ID column holds 64 bit integers
+    if not -2 ** 63 <= patient_id < 2 ** 63:
+        raise InvalidVisit('patient_id', f"Invalid patient ID in line: {line}")
+
+    # Check the format of the other data values
+    try:
+        values = (float(field[2]), int(field[3]), int(field[4]), int(field[5]), int(field[6]), int(field[7]))
+    except ValueError:
+        raise InvalidVisit('type', f"Invalid data type in line: {line}")
+
+    #implementing condtion to find the invalid data
+    for value, (name, low, high, label) in zip(values, LIMITS):
+        if not low <= value <= high:
+            raise InvalidVisit(name, f"Invalid {label} value ({value}) in line: {line}")
+
+    # dates are stored as day ordinals, so they have to be valid
+    try:
+        day = toDay(field[1])
+    except ValueError:
+        raise InvalidVisit('date', f"Invalid date value ({field[1]}) in line: {line}")
+
+    return (patient_id, day) + values
+
+
+# messages addPatientData prints for a vital sign outside of its valid range
+RANGE_MESSAGES = (
+    "Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.",
+    "Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.",
+    "Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.",
+    "Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.",
+    "Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.",
+    "Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.",
+)
+
+
+def checkPatientId(patientId):
+    """
+    Validates the ID of a new visit that is given as a number, e.g. by a device feed.
+
+    patientId: The patient ID.
+    return: The patient ID. Raises InvalidVisit unless it is an integer that fits the 64 bit patient ID column.
+    """
+    if isinstance(patientId, bool) or not isinstance(patientId, int) or not -2 ** 63 <= patientId < 2 ** 63:
+        raise InvalidVisit('patient_id', f"Invalid patient ID: {patientId!r}")
+    return patientId
+
+
+def checkVisit(date, temp, hr, rr, sbp, dbp, spo2):
+    """
+    Validates the values of a new visit the same way addPatientData does.
+
+    date: The date of the visit in the format 'yyyy-mm-dd'.
+    temp, hr, rr, sbp, dbp, spo2: The vital signs of the visit.
+    return: A (day, temp, hr, rr, sbp, dbp, spo2) tuple. Raises InvalidVisit with the message addPatientData prints.
+    """
+    # Checking if date format is valid
+    try:
+        day = toDay(date)
+    except (ValueError, TypeError):
+        try:
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').toordinal()
+        except (ValueError, TypeError):
+            raise InvalidVisit('date', "Invalid date format. Please enter date in the format 'yyyy-mm-dd'.")
+
+    try:
+        values = (float(temp), int(hr), int(rr), int(sbp), int(dbp), int(spo2))
+    except (ValueError, TypeError):
+        raise InvalidVisit('type', "Invalid input. Please enter valid data.")
+
+    # Checking every vital sign against its valid range
+    for value, (name, low, high, _), message in zip(values, LIMITS, RANGE_MESSAGES):
+        if not low <= value <= high:
+            raise InvalidVisit(name, message)
+
+    return (day,) + values
+
+
+class VisitList(list):
+    """
+    The visits of a patient as returned by VisitStore[patientId].
+
+    The list is built from the columns on every lookup, so changing it would not change the store;
+    every method that changes it raises TypeError instead of losing the change without notice.
+    """
+
+    def readOnly(self, *args, **kwargs):
+        raise TypeError("The visits of a VisitStore can't be changed through store[patientId]; "
+                        "use VisitStore.append or VisitStore.deletePatient.")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = readOnly
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = readOnly
+
+    def __reduce__(self):
+        # unpickling a list subclass would add the items one by one with append or extend
+        return VisitList, (list(self),)
+
+
+class VisitStore:
+    """
+    Columnar store of patient visits.
+
+    Every vital sign is kept in its own typed array, dates are kept as integer day ordinals and
+    the visits of a patient are found through an offset index of row ranges:
+    {
+        patientId (int): [[start (int), stop (int)], ...],
+        ...
+    }
+    The store can also be used like the dictionary returned by readPatientsFromFile, where
+    store[patientId] is a read-only VisitList of Visit records, which also behave like [date,
+    temperature, heart rate, respiratory rate, systolic blood pressure, diastolic blood pressure,
+    oxygen saturation] lists.
+    """
+
+    def __init__(self):
+        self.pid = array('q')
+        self.day = array('i')
+        self.temp = array('f')
+        self.hr = array('B')
+        self.rr = array('B')
+        self.sbp = array('B')
+        self.dbp = array('B')
+        self.spo2 = array('B')
+        # 1 for every row that still belongs to a patient, 0 for deleted rows
+        self.alive = bytearray()
+        self.index = {}
+        self.dead = 0
+        # derived indexes that are told about every change, see addListener
+        self.listeners = []
+        # the memory map the columns are read from, while they are still read-only views of it
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, patientId):
+        return patientId in self.index
+
+    def __getitem__(self, patientId):
+        if patientId not in self.index:
+            raise KeyError(patientId)
+        return VisitList(self.visit(row) for row in self.rows(patientId))
+
+    def __setitem__(self, patientId, visits):
+        self.deletePatient(patientId)
+        for date, temp, hr, rr, sbp, dbp, spo2 in visits:
+            self.append(patientId, toDay(str(date)), float(temp), int(hr), int(rr), int(sbp), int(dbp), int(spo2))
+
+    def __delitem__(self, patientId):
+        if not self.deletePatient(patientId):
+            raise KeyError(patientId)
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return [self[patientId] for patientId in self.index]
+
+    def items(self):
+        return [(patientId, self[patientId]) for patientId in self.index]
+
+    def get(self, patientId, default=None):
+        if patientId not in self.index:
+            return default
+        return self[patientId]
+
+    def ensureWritable(self):
+        """
+        Copies columns that are read-only views of a memory-mapped snapshot into arrays, so they
+        can be changed.
+        """
+        if self.mapped is None:
+            return
+        for name, typecode in zip(COLUMNS, TYPECODES):
+            column = getattr(self, name)
+            if not isinstance(column, array):
+                copy = array(typecode)
+                copy.frombytes(column.tobytes())
+                setattr(self, name, copy)
+        self.mapped = None
+
+    def addListener(self, listener):
+        """
+        Registers an object that keeps derived data up to date with the store.
+
+        listener: An object with visitsAdded(store, start, stop), patientDeleted(store, patientId, ranges)
+        and storeCompacted(store) methods, which are called after rows are appended, after a
+        patient is deleted and after compact renumbers the rows, and a rebuild() method, which
+        is called after replace swaps in every row.
+        """
+        self.listeners.append(listener)
+
+    def findListener(self, kind):
+        """
+        Returns the registered listener of the given class, or None if there is none.
+
+        kind: The class of the listener.
+        """
+        for listener in self.listeners:
+            if isinstance(listener, kind):
+                return listener
+        return None
+
+    def replace(self, other):
+        """
+        Replaces every visit of the store with the visits of another store, in place, so
+        references to the store and its registered listeners stay valid.
+
+        other: The VisitStore to take the columns and the index from.
+        """
+        for name in COLUMNS:
+            setattr(self, name, getattr(other, name))
+        self.alive = other.alive
+        self.index = other.index
+        self.dead = other.dead
+        self.mapped = other.mapped
+        for listener in self.listeners:
+            listener.rebuild()
+
+    @property
+    def rowCount(self):
+        """
+        Number of visits that still belong to a patient.
+        """
+        return len(self.pid) - self.dead
+
+    def append(self, patientId, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends a single visit to the end of the columns.
+
+        patientId: The ID of the patient the visit belongs to.
+        day: The day ordinal of the visit date.
+        temp, hr, rr, sbp, dbp, spo2: The validated vital signs of the visit.
+        return: The row number of the new visit.
+        """
+        if self.mapped is not None:
+            self.ensureWritable()
+        row = len(self.pid)
+        self.pid.append(patientId)
+        self.day.append(day)
+        self.temp.append(temp)
+        self.hr.append(hr)
+        self.rr.append(rr)
+        self.sbp.append(sbp)
+        self.dbp.append(dbp)
+        self.spo2.append(spo2)
+        self.alive.append(1)
+
+        # extending the last range of the patient when the rows are contiguous
+        ranges = self.index.get(patientId)
+        if ranges is None:
+            self.index[patientId] = [[row, row + 1]]
+        elif ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+        for listener in self.listeners:
+            listener.visitsAdded(self, row, row + 1)
+        return row
+
+    def extend(self, pid, day, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends many visits at once from already validated columns.
+
+        pid, day, temp, hr, rr, sbp, dbp, spo2: Arrays (or iterables) of equal length, one per column.
+        return: The row number of the first new visit.
+        """
+        self.ensureWritable()
+        first = len(self.pid)
+        self.pid.extend(pid)
+        self.day.extend(day)
+        self.temp.extend(temp)
+        self.hr.extend(hr)
+        self.rr.extend(rr)
+        self.sbp.extend(sbp)
+        self.dbp.extend(dbp)
+        self.spo2.extend(spo2)
+        self.alive.extend(b'\x01' * (len(self.pid) - first))
+
+        # indexing the new rows, extending the last range of a patient when the rows are contiguous
+        index = self.index
+        for row, patientId in enumerate(self.pid[first:], first):
+            ranges = index.get(patientId)
+            if ranges is None:
+                index[patientId] = [[row, row + 1]]
+            elif ranges[-1][1] == row:
+                ranges[-1][1] = row + 1
+            else:
+                ranges.append([row, row + 1])
+        for listener in self.listeners:
+            listener.visitsAdded(self, first, len(self.pid))
+        return first
+
+    def rows(self, patientId):
+        """
+        Generates the row numbers of all visits of a patient in the order they were added.
+
+        patientId: The ID of the patient.
+        """
+        for start, stop in self.index.get(patientId, ()):
+            yield from range(start, stop)
+
+    def ranges(self, patientId=0):
+        """
+        Returns the row ranges of a patient, or of every patient if patientId is 0.
+
+        patientId: The ID of the patient to return ranges for.
+        return: A list of (start, stop) tuples.
+        """
+        if patientId != 0:
+            return [tuple(r) for r in self.index.get(patientId, ())]
+        # the whole column is one range as long as nothing was deleted
+        if self.dead == 0:
+            return [(0, len(self.pid))] if len(self.pid) else []
+        return [tuple(r) for ranges in self.index.values() for r in ranges]
+
+    def visitCount(self, patientId):
+        """
+        Returns the number of visits of a patient.
+
+        patientId: The ID of the patient.
+        """
+        return sum(stop - start for start, stop in self.index.get(patientId, ()))
+
+    def lastDay(self, patientId):
+        """
+        Returns the day ordinal of the latest visit of a patient, read from the day column.
+
+        patientId: The ID of the patient, who has to have visits.
+        """
+        return max(max(self.day[start:stop]) for start, stop in self.index[patientId])
+
+    def visit(self, row):
+        """
+        Returns a single visit as a Visit record.
+
+        row: The row number of the visit.
+        """
+        return Visit(internId(self.pid[row]), fromDay(self.day[row]), toTemp(self.temp[row]), self.hr[row],
+                     self.rr[row], self.sbp[row], self.dbp[row], self.spo2[row])
+
+    def deletePatient(self, patientId, compact=True):
+        """
+        Removes all visits of a patient from the index and marks their rows as deleted.
+
+        patientId: The ID of the patient to delete.
+        compact: False to leave compacting the columns to the caller, e.g. when deleting many patients.
+        return: The number of visits that were deleted.
+        """
+        ranges = self.index.pop(patientId, None)
+        if ranges is None:
+            return 0
+        removed = 0
+        for start, stop in ranges:
+            self.alive[start:stop] = bytes(stop - start)
+            removed += stop - start
+        self.dead += removed
+        for listener in self.listeners:
+            listener.patientDeleted(self, patientId, ranges)
+
+        # reclaiming the space once most of the columns are deleted rows
+        if compact and self.dead > len(self.pid) // 2:
+            self.compact()
+        return removed
+
+    def deletePatients(self, patientIds):
+        """
+        Deletes many patients and compacts the columns at most once afterwards.
+
+        patientIds: The IDs of the patients to delete.
+        return: A (number of patients, number of visits) tuple of what was deleted.
+        """
+        patients = visits = 0
+        for patientId in patientIds:
+            removed = self.deletePatient(patientId, compact=False)
+            if removed:
+                patients += 1
+                visits += removed
+        if self.dead > len(self.pid) // 2:
+            self.compact()
+        return patients, visits
+
+    def compact(self):
+        """
+        Rewrites the columns without deleted rows, so every patient has a single row range.
+        """
+        self.ensureWritable()
+        new = {name: array(typecode) for name, typecode in zip(COLUMNS, TYPECODES)}
+        index = {}
+        for patientId, ranges in self.index.items():
+            start = len(new['pid'])
+            for a, b in ranges:
+                for name in COLUMNS:
+                    new[name].extend(getattr(self, name)[a:b])
+            index[patientId] = [[start, len(new['pid'])]]
+        for name in COLUMNS:
+            setattr(self, name, new[name])
+        self.alive = bytearray(b'\x01') * len(self.pid)
+        self.index = index
+        self.dead = 0
+        for listener in self.listeners:
+            listener.storeCompacted(self)
+
+
+def toVisitStore(patients):
+    """
+    Returns patients as a VisitStore, converting a dictionary of visit lists if needed.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    """
+    if isinstance(patients, VisitStore):
+        return patients
+    store = VisitStore()
+    for patientId, visits in patients.items():
+        store[patientId] = visits
+    return store
@@ -0,0 +1,417 @@
+from collections import Counter
+import datetime
+from functools import lru_cache
+from itertools import compress
+import math
+import operator
+
+from visitstore import VITALS, LIMITS, toTemp
+
+
+class Summary:
+    """
+    Running aggregates of the six vital signs over a set of visits.
+
+    count is the number of visits, while total, squares, low and high hold the sum, the sum of
+    squares, the minimum and the maximum of every vital sign, in the order of VITALS.
+    """
+
+    __slots__ = ('count', 'total', 'squares', 'low', 'high')
+
+    def __init__(self):
+        self.count = 0
+        self.total = [0.0] * len(VITALS)
+        self.squares = [0.0] * len(VITALS)
+        self.low = [math.inf] * len(VITALS)
+        self.high = [-math.inf] * len(VITALS)
+
+    def add(self, values):
+        """
+        Adds a single visit.
+
+        values: The six vital signs of the visit.
+        """
+        self.count += 1
+        for i, value in enumerate(values):
+            self.total[i] += value
+            self.squares[i] += value * value
+            if value < self.low[i]:
+                self.low[i] = value
+            if value > self.high[i]:
+                self.high[i] = value
+
+    def addColumns(self, columns, start, stop):
+        """
+        Adds the visits in a row range of the store columns.
+
+        columns: The six vital sign columns.
+        start, stop: The row range to add.
+        """
+        if stop <= start:
+            return
+        self.count += stop - start
+        for i, column in enumerate(columns):
+            values = column[start:stop]
+            self.total[i] += sum(values)
+            self.squares[i] += sum(value * value for value in values)
+            self.low[i] = min(self.low[i], min(values))
+            self.high[i] = max(self.high[i], max(values))
+
+    def merge(self, other):
+        """
+        Adds the aggregates of another summary to this one.
+
+        other: The summary to add.
+        """
+        self.count += other.count
+        for i in range(len(VITALS)):
+            self.total[i] += other.total[i]
+            self.squares[i] += other.squares[i]
+            self.low[i] = min(self.low[i], other.low[i])
+            self.high[i] = max(self.high[i], other.high[i])
+
+    def subtract(self, other):
+        """
+        Removes the visits of another summary from this one. The minimum and maximum can't be
+        recovered this way and have to be recomputed by the caller.
+
+        other: The summary of the visits to remove.
+        """
+        self.count -= other.count
+        for i in range(len(VITALS)):
+            self.total[i] -= other.total[i]
+            self.squares[i] -= other.squares[i]
+
+    def mean(self, vital):
+        return self.total[VITALS.index(vital)] / self.count
+
+    def stddev(self, vital):
+        i = VITALS.index(vital)
+        mean = self.total[i] / self.count
+        return math.sqrt(max(self.squares[i] / self.count - mean * mean, 0.0))
+
+    def minimum(self, vital):
+        return self.low[VITALS.index(vital)]
+
+    def maximum(self, vital):
+        return self.high[VITALS.index(vital)]
+
+
+class VitalHistogram:
+    """
+    Fixed-bin histogram of one vital sign over its valid range.
+
+    Every heart rate, respiratory rate, blood pressure and oxygen saturation has its own bin;
+    temperatures are binned to a tenth of a degree.
+    """
+
+    def __init__(self, low, high, step=1):
+        self.low = low
+        self.step = step
+        self.bins = [0] * (round((high - low) / step) + 1)
+        self.count = 0
+
+    def binOf(self, value):
+        return min(max(round((value - self.low) / self.step), 0), len(self.bins) - 1)
+
+    def valueOf(self, position):
+        return round(self.low + position * self.step, 1)
+
+    def add(self, value, count=1):
+        self.bins[self.binOf(value)] += count
+        self.count += count
+
+    def remove(self, value, count=1):
+        self.bins[self.binOf(value)] -= count
+        self.count -= count
+
+    def merge(self, other):
+        for position, count in enumerate(other.bins):
+            self.bins[position] += count
+        self.count += other.count
+
+    def items(self):
+        """
+        Returns the (value, count) of every non-empty bin, in ascending order of value.
+        """
+        return [(self.valueOf(position), count) for position, count in enumerate(self.bins) if count]
+
+    def countBetween(self, above=None, below=None):
+        """
+        Returns the number of values that are greater than above and less than below.
+
+        above, below: The exclusive bounds, or None for no bound.
+        """
+        # the first bin above the lower bound and the first bin not below the upper bound, with
+        # a little slack for the rounding of bounds that fall on a bin
+        first = 0 if above is None else math.floor((above - self.low) / self.step + 1e-9) + 1
+        last = len(self.bins) if below is None else math.ceil((below - self.low) / self.step - 1e-9)
+        first = min(max(first, 0), len(self.bins))
+        last = min(max(last, 0), len(self.bins))
+        return sum(self.bins[first:last])
+
+    def percentile(self, q):
+        """
+        Returns the nearest-rank percentile of the histogram.
+
+        q: The percentile, between 0 and 100.
+        """
+        if self.count == 0:
+            return None
+        rank = max(math.ceil(q / 100 * self.count), 1)
+        seen = 0
+        for position, count in enumerate(self.bins):
+            seen += count
+            if seen >= rank:
+                return self.valueOf(position)
+        return self.valueOf(len(self.bins) - 1)
+
+
+def newHistograms():
+    """
+    Returns one empty VitalHistogram per vital sign, in the order of VITALS.
+    """
+    return [VitalHistogram(low, high, 0.1 if name == 'temp' else 1) for name, low, high, _ in LIMITS]
+
+
+def percentileOf(values, q):
+    """
+    Returns the nearest-rank percentile of a list of values.
+
+    values: The values.
+    q: The percentile, between 0 and 100.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)), 1) - 1]
+
+
+class StatsEngine:
+    """
+    Running aggregates of the vital signs of every patient and of all patients of a VisitStore.
+
+    The engine is registered as a listener of the store, so adding visits and deleting patients
+    update the aggregates in place and the statistics of one or all patients are O(1). Percentiles
+    over all patients come from the monthly histograms of VitalDistributions.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.rebuild()
+
+    def columns(self):
+        store = self.store
+        return [store.temp, store.hr, store.rr, store.sbp, store.dbp, store.spo2]
+
+    def rebuild(self):
+        """
+        Computes the aggregates of every patient from the store columns.
+        """
+        columns = self.columns()
+        self.patients = {}
+        self.total = Summary()
+        for patientId, ranges in self.store.index.items():
+            summary = Summary()
+            for start, stop in ranges:
+                # slicing only pays off for longer runs of visits
+                if stop - start > 8:
+                    summary.addColumns(columns, start, stop)
+                else:
+                    for row in range(start, stop):
+                        summary.add([column[row] for column in columns])
+            self.patients[patientId] = summary
+            self.total.merge(summary)
+        self.stale = False
+
+    def visitsAdded(self, store, start, stop):
+        columns = self.columns()
+        for row in range(start, stop):
+            values = [column[row] for column in columns]
+            patientId = store.pid[row]
+            if patientId not in self.patients:
+                self.patients[patientId] = Summary()
+            self.patients[patientId].add(values)
+            self.total.add(values)
+
+    def patientDeleted(self, store, patientId, ranges):
+        summary = self.patients.pop(patientId, None)
+        if summary is None:
+            return
+        self.total.subtract(summary)
+        # the overall minimum or maximum may have belonged to the deleted patient
+        if any(map(operator.eq, summary.low, self.total.low)) or \
+                any(map(operator.eq, summary.high, self.total.high)):
+            self.stale = True
+
+    def storeCompacted(self, store):
+        # the aggregates don't depend on row numbers
+        pass
+
+    def summary(self, patientId=0):
+        """
+        Returns the Summary of a patient, or of all patients if patientId is 0.
+
+        patientId: The ID of the patient.
+        return: The Summary, or None if the patient has no visits.
+        """
+        if patientId != 0:
+            return self.patients.get(patientId)
+        if self.stale:
+            # recomputing the overall minimum and maximum from the per patient aggregates
+            self.total.low = [math.inf] * len(VITALS)
+            self.total.high = [-math.inf] * len(VITALS)
+            for summary in self.patients.values():
+                self.total.low = list(map(min, self.total.low, summary.low))
+                self.total.high = list(map(max, self.total.high, summary.high))
+            self.stale = False
+        return self.total if self.total.count else None
+
+    def percentile(self, vital, q, patientId=0):
+        """
+        Returns a percentile of a vital sign for a patient, or for all patients if patientId is 0.
+
+        vital: The name of the vital sign, one of VITALS.
+        q: The percentile, between 0 and 100.
+        patientId: The ID of the patient.
+        """
+        i = VITALS.index(vital)
+        if patientId == 0:
+            return distributionsOf(self.store).histogram(vital).percentile(q)
+        # a single patient has few visits, so they are simply sorted
+        column = self.columns()[i]
+        value = percentileOf([column[row] for row in self.store.rows(patientId)], q)
+        return toTemp(value) if vital == 'temp' and value is not None else value
+
+
+@lru_cache(maxsize=65536)
+def monthOf(day):
+    """
+    Returns the (year, month) of a day ordinal.
+    """
+    date = datetime.date.fromordinal(day)
+    return date.year, date.month
+
+
+class VitalDistributions:
+    """
+    Fixed-bin histograms of every vital sign for every calendar month of a VisitStore.
+
+    The histograms are mergeable sketches: the distribution over any set of months is the sum of
+    their histograms, so percentiles and shares over the whole population or any year or month
+    take O(months x bins) no matter how many visits there are. The sketches are registered as a
+    listener of the store and are updated as visits are added and patients deleted.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.rebuild()
+
+    def columns(self):
+        store = self.store
+        return [store.temp, store.hr, store.rr, store.sbp, store.dbp, store.spo2]
+
+    def rebuild(self):
+        """
+        Computes the histograms of every month from the store columns.
+        """
+        store = self.store
+        self.months = {}
+        alive = store.alive if store.dead else None
+        months = [monthOf(day) for day in store.day]
+        for i, column in enumerate(self.columns()):
+            # counting every distinct (month, value) pair once instead of binning row by row
+            pairs = zip(months, column)
+            counts = Counter(compress(pairs, alive) if alive is not None else pairs)
+            for (month, value), count in counts.items():
+                self.histogramsOf(month)[i].add(value, count)
+
+    def histogramsOf(self, month):
+        histograms = self.months.get(month)
+        if histograms is None:
+            histograms = self.months[month] = newHistograms()
+        return histograms
+
+    def visitsAdded(self, store, start, stop):
+        columns = self.columns()
+        day = store.day
+        for row in range(start, stop):
+            for histogram, column in zip(self.histogramsOf(monthOf(day[row])), columns):
+                histogram.add(column[row])
+
+    def patientDeleted(self, store, patientId, ranges):
+        columns = self.columns()
+        day = store.day
+        for start, stop in ranges:
+            for row in range(start, stop):
+                for histogram, column in zip(self.months[monthOf(day[row])], columns):
+                    histogram.remove(column[row])
+
+    def storeCompacted(self, store):
+        # the histograms don't depend on row numbers
+        pass
+
+    def histogram(self, vital, year=None, month=None):
+        """
+        Returns the merged histogram of a vital sign over a year, a month of every year, both or everything.
+
+        vital: The name of the vital sign, one of VITALS.
+        year: The year to include, or None for every year.
+        month: The month to include, or None for every month.
+        """
+        i = VITALS.index(vital)
+        name, low, high, _ = LIMITS[i]
+        merged = VitalHistogram(low, high, 0.1 if name == 'temp' else 1)
+        for (y, m), histograms in self.months.items():
+            if (year is None or y == year) and (month is None or m == month):
+                merged.merge(histograms[i])
+        return merged
+
+    def percentiles(self, vital, qs=(50, 90, 99), year=None, month=None):
+        """
+        Returns the nearest-rank percentiles of a vital sign, e.g. {50: 72, 90: 88, 99: 104}.
+
+        qs: The percentiles, between 0 and 100.
+        year, month: The months to include, see histogram.
+        """
+        histogram = self.histogram(vital, year, month)
+        return {q: histogram.percentile(q) for q in qs}
+
+    def share(self, vital, above=None, below=None, year=None, month=None):
+        """
+        Returns the share of visits whose vital sign is greater than above and less than below,
+        e.g. share('sbp', above=140), or None if there are no visits.
+
+        above, below: The exclusive bounds, or None for no bound.
+        year, month: The months to include, see histogram.
+        """
+        histogram = self.histogram(vital, year, month)
+        if histogram.count == 0:
+            return None
+        return histogram.countBetween(above, below) / histogram.count
+
+
+def distributionsOf(store):
+    """
+    Returns the monthly vital sign histograms of a VisitStore, building and registering them on first use.
+
+    store: The VisitStore to follow.
+    """
+    sketches = store.findListener(VitalDistributions)
+    if sketches is None:
+        sketches = VitalDistributions(store)
+        store.addListener(sketches)
+    return sketches
+
+
+def statsEngineOf(store):
+    """
+    Returns the stats engine of a VisitStore, building and registering it on first use.
+
+    store: The VisitStore to aggregate.
+    """
+    engine = store.findListener(StatsEngine)
+    if engine is None:
+        engine = StatsEngine(store)
+        store.addListener(engine)
+    return engine